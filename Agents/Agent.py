@@ -1,31 +1,263 @@
-from Agents.LLMConnector import LLMConnector
+from Agents.LLMConnector import LLMConnector, TOKEN_BUDGETS, DEFAULT_TOKEN_BUDGET
+from Helpers.KnowledgeIndex import getKnowledgeIndex
+from Helpers.MetricsRecorder import getMetrics
 import json
-from pydantic import BaseModel
+import time
+from pydantic import BaseModel, ValidationError
+from Helpers.ResponseRepair import repairJson, validateElements, listField, elementRepairPrompt, fieldGuide, schemaTokensSaved, estimateTokens
 from abc import ABC, abstractmethod
 from typing import Optional, Type
 import pandas as pd
 import os
 
 
+PROVIDERS = ['ollama', 'gemini']
+
+def parseCascadeModel(cascade_model, default_provider):
+    '''
+    Cascade models are given as "model" or "provider:model" e.g. gemini-2.5-flash or ollama:gpt-oss:20b
+    '''
+    provider, _, model = cascade_model.partition(':')
+    if provider in PROVIDERS and model:
+        return provider, model
+    return default_provider, cascade_model
+
+
+def mergeResults(results):
+    '''
+    Merges the results of the parts of a split prompt. List fields are joined, text fields are joined by lines
+    and the other fields are taken from the first part
+    '''
+    merged = dict(results[0])
+    for key, value in merged.items():
+        if isinstance(value, list):
+            merged[key] = [element for result in results for element in result.get(key, [])]
+        elif isinstance(value, str):
+            merged[key] = '\n'.join(dict.fromkeys(result[key] for result in results if result.get(key)))
+    return merged
+
+
+class KeepPlaceholders(dict):
+    #Placeholders without a value are left in the template for the values of each item
+    def __missing__(self, key):
+        return '{' + key + '}'
+
+def itemPrompt(values):
+    '''
+    Prompt of an item when the role and task template are in the static instructions. Only the values of the placeholders are sent
+    '''
+    return 'Do the task in your instructions for these values of its placeholders\n' + '\n'.join(f'{{{name}}}: {value}' for name, value in values.items())
+
+
 class LLMClient:
     '''
     This class acts as a common Client to connect with LLMs using LLMConnector for perform content generation or upload of files
+    When cascade models are given, the cheaper models are tried first and the request escalates to the next model
+    only when the response fails schema validation or the local check provided by the caller
+    List responses are validated element by element and only the invalid elements are asked again
+    Prompts are checked against the token budget of each model before they are sent. Tiers whose budget is too small
+    are skipped and prompts of splittable inputs are split to fit the budget of the configured model
     '''
-    def __init__(self, provider, model, knowledge_base_path, test_module, role='generator'):
+    def __init__(self, provider, model, knowledge_base_path, test_module, role='generator', cascade_models=None, stage=None):
         # print(provider, model)
         self.llm_connector = LLMConnector(provider, model, knowledge_base_path, test_module, role)
+        self.stage = stage if stage else role
+        self.cascade_connectors = []
+        for cascade_model in (cascade_models or []):
+            cascade_provider, cascade_model = parseCascadeModel(cascade_model, provider)
+            self.cascade_connectors.append(LLMConnector(cascade_provider, cascade_model, knowledge_base_path, test_module, role))
+        #Cheapest model first and the configured model is the last tier
+        self.tiers = self.cascade_connectors + [self.llm_connector]
+        for connector in self.tiers:
+            connector.stage = self.stage
+        self.last_connector, self.last_context = self.llm_connector, None
+
+    def use_compact_schemas(self, response_schemas):
+        '''
+        Calls with these response models carry compact schemas and their field guides are sent once as static instructions.
+        An empty list turns the compact mode off
+        '''
+        schema_guide = '\n\n'.join(fieldGuide(response_schema) for response_schema in response_schemas)
+        for connector in self.tiers:
+            connector.compact_schema, connector.schema_guide = bool(response_schemas), schema_guide
+        for response_schema in response_schemas:
+            print(f'Compact schema for {response_schema.__name__} saves about {schemaTokensSaved(response_schema)} tokens per call. '
+                  f'Its field guide of about {estimateTokens(fieldGuide(response_schema))} tokens is cached once per stage for gemini '
+                  f'and sent with every request otherwise')
+
+    def set_static_prefix(self, static_prefix):
+        '''
+        The role and task instructions of the stage, sent once as static instructions. An empty prefix turns it off
+        '''
+        for connector in self.tiers:
+            connector.static_prefix = static_prefix
+        if static_prefix:
+            print(f'Static prefix of about {estimateTokens(static_prefix)} tokens is cached once per stage for gemini '
+                  f'and is the stable start of every request otherwise for {self.stage}')
+
+    def set_hedging(self, hedge):
+        '''
+        Hedges the slow requests of every tier with a policy of its own, as each model has its own latencies. None turns it off
+        '''
+        for connector in self.tiers:
+            connector.set_hedging(hedge)
+
+    def set_token_budget(self, token_budget):
+        '''
+        Input token budget of the configured model. None is the budget of the model in TOKEN_BUDGETS
+        '''
+        model = self.llm_connector.model
+        self.llm_connector.token_budget = token_budget if token_budget else TOKEN_BUDGETS.get(model, DEFAULT_TOKEN_BUDGET)
 
     def upload_files(self):
+        for connector in self.cascade_connectors:
+            if connector.provider == 'gemini':
+                connector.upload_files()
         self.llm_connector.upload_files()
 
-    def generate_content(self, prompt, response_schema=None, session = 'new'):
-        response = self.llm_connector.chat(prompt, response_schema, session)
+    def generate_content(self, prompt, response_schema=None, session = 'new', check = None, tier = 0, context = None):
+        '''
+        tier is the level of the cascade to start from. Callers pass their retry count so that a response
+        rejected by the verifier is regenerated by a stronger model
+        context is the retrieved part of the knowledge base to send instead of the full knowledge base
+        '''
+        metrics = getMetrics()
+        tiers = self.tiers[min(tier, len(self.tiers)-1):]
+        metrics.increment(self.stage, 'calls')
+        for level, connector in enumerate(tiers):
+            is_last_tier = level == len(tiers) - 1
+            estimated_tokens = connector.estimate_tokens(prompt, context)
+            if estimated_tokens > connector.token_budget:
+                #Rejected before the round trip instead of failing or being truncated by the model
+                reason = f'prompt of about {estimated_tokens} tokens is over the budget of {connector.token_budget} tokens of {connector.model}'
+                metrics.increment(self.stage, 'over_token_budget')
+                if is_last_tier:
+                    raise Exception(f'The {reason}')
+                print(f'Skipping {connector.model} because the {reason}')
+                continue
+            start_time = time.perf_counter()
+            try:
+                response = connector.chat(prompt, response_schema, session, context)
+                self.last_connector, self.last_context = connector, context
+                result = self._parse_response(response, response_schema, prompt)
+                if is_last_tier or check is None or check(result):
+                    metrics.observe(self.stage, f'latency_{connector.model}', time.perf_counter() - start_time)
+                    metrics.increment(self.stage, f'answered_by_{connector.model}')
+                    return result
+                reason = 'local check failed'
+            except Exception as e:
+                if is_last_tier:
+                    raise
+                reason = f'{type(e).__name__}: {e}'
+            metrics.observe(self.stage, f'latency_{connector.model}', time.perf_counter() - start_time)
+            metrics.increment(self.stage, 'escalations')
+            metrics.event(self.stage, 'escalation', model = connector.model, reason = reason)
+            print(f'Escalating from {connector.model} because {reason}')
+
+    def generate_split(self, render, items, response_schema, merge = mergeResults, context = None, **kwargs):
+        '''
+        Generates for a splittable input e.g. a batch of scenarios or the values of a dimension. render(items) builds the prompt
+        for a part of the items. A prompt over the token budget of the configured model is halved till every part fits,
+        the parts are generated one by one and merge(results) combines their results
+        '''
+        parts = self.split_items(render, items, context)
+        if len(parts) == 1:
+            return self.generate_content(render(items), response_schema, context = context, **kwargs)
+        metrics = getMetrics()
+        metrics.increment(self.stage, 'split_prompts')
+        metrics.observe(self.stage, 'split_parts', len(parts))
+        print(f'Prompt of {len(items)} items is over the token budget of {self.llm_connector.model} and is sent in {len(parts)} parts')
+        return merge([self.generate_content(render(part), response_schema, context = context, **kwargs) for part in parts])
+
+    def split_items(self, render, items, context = None):
+        if len(items) <= 1 or self.llm_connector.estimate_tokens(render(items), context) <= self.llm_connector.token_budget:
+            return [items]
+        middle = len(items) // 2
+        return self.split_items(render, items[:middle], context) + self.split_items(render, items[middle:], context)
+
+    def _parse_response(self, response, response_schema, prompt):
         if response_schema:
-            return json.loads(response)
+            try:
+                result = json.loads(response)
+            except json.JSONDecodeError:
+                result = json.loads(repairJson(response))
+            #Validate against the schema so that a malformed response is repaired or escalates instead of failing downstream
+            try:
+                response_schema.model_validate(result)
+                return result
+            except ValidationError:
+                _, errors = validateElements(response_schema, result)
+                if not errors:
+                    raise
+            repaired = self.repair_elements(prompt, response_schema, result, errors)
+            if repaired is None:
+                raise Exception(f'{len(errors)} elements of the response could not be repaired')
+            return repaired
         else:
-            return response        
+            return response
+
+    def repair_elements(self, prompt, response_schema, result, errors, rounds = 2):
+        '''
+        Asks the model that produced the result to correct only the elements in errors ({index: error}) and merges
+        them into the result. Also used for the elements rejected by a verifier. Returns the merged result or None
+        '''
+        metrics = getMetrics()
+        field_name, _ = listField(response_schema)
+        if field_name is None:
+            return None
+        connector = self.last_connector
+        elements = list(result[field_name])
+        metrics.observe(self.stage, 'elements_total', len(elements))
+        for round_num in range(rounds):
+            metrics.increment(self.stage, 'element_repairs')
+            metrics.observe(self.stage, 'elements_in_error', len(errors))
+            print(f'Asking {connector.model} to correct {len(errors)} of {len(elements)} elements')
+            repair_prompt = elementRepairPrompt({field_name: elements}, errors, field_name)
+            try:
+                if connector.provider == 'gemini':
+                    #The chat session already holds the request and the response
+                    response = connector.chat(repair_prompt, response_schema, 'continue')
+                else:
+                    response = connector.chat(prompt + f'\n\nYour previous response: {json.dumps({field_name: elements})}\n\n' + repair_prompt,
+                                              response_schema, context = self.last_context)
+                corrected = json.loads(repairJson(response))
+            except Exception as e:
+                print(f'Element repair failed: {type(e).__name__}: {e}')
+                continue
+            corrected_elements, corrected_errors = validateElements(response_schema, corrected)
+            if corrected_elements is None or len(corrected_elements) != len(errors):
+                metrics.increment(self.stage, 'element_repair_mismatch')
+                continue
+            remaining = {}
+            for (index, error), element, corrected_error in zip(errors.items(), corrected_elements, 
+                                                                 [corrected_errors.get(position) for position in range(len(errors))]):
+                if element is None:
+                    remaining[index] = corrected_error
+                else:
+                    elements[index] = element
+            metrics.increment(self.stage, 'elements_repaired', len(errors) - len(remaining))
+            errors = remaining
+            if not errors:
+                merged = dict(result)
+                merged[field_name] = elements
+                #Non list fields like reason are taken from the repair response when the original lacks them
+                for key, value in corrected.items():
+                    if key != field_name and key not in merged:
+                        merged[key] = value
+                try:
+                    response_schema.model_validate(merged)
+                    return merged
+                except ValidationError:
+                    return None
+        return None
+
+    def escalation_rate(self):
+        return getMetrics().rate(self.stage, 'escalations', 'calls')
     
     def cleanup_files(self):
+        for connector in self.cascade_connectors:
+            if connector.provider == 'gemini':
+                connector.cleanup_files()
         self.llm_connector.cleanup_files()
 
 
@@ -38,6 +270,17 @@ class ModelConfig(BaseModel):
     output_format: Type[BaseModel]
     provider: str
     model: str
+    cascade_models: list[str] = []
+    #Number of knowledge base chunks retrieved per item. 0 sends the full knowledge base
+    retrieval_k: int = 0
+    #Send the output format without field descriptions on each call and the descriptions once per stage
+    compact_schema: bool = False
+    #Send the role and task template once per stage and only the values of the placeholders on each call
+    static_prefix: bool = False
+    #Hedging policy spec for slow requests e.g. "p95" or "20:0.05". None sends each request once
+    hedge: Optional[str] = None
+    #Input token budget of the model. None uses the budget of the model in TOKEN_BUDGETS
+    token_budget: Optional[int] = None
 
 class TextResponse(BaseModel):
     text: str
@@ -49,6 +292,7 @@ class PipelineStepAgent(ABC):
     '''
     generate_model_config:ModelConfig
     verify_model_config:ModelConfig
+    progress_callback = None
 
     @abstractmethod
     def __init__(self, test_module):
@@ -78,6 +322,62 @@ class PipelineStepAgent(ABC):
     def execute(self):
         pass
 
+    def report_progress(self, item_id, status, **data):
+        '''
+        Reports the outcome of an item (scenario, test case, sheet or step) to the progress callback if one is set e.g. by the job service
+        '''
+        if self.progress_callback:
+            self.progress_callback(item_id = str(item_id), status = status, **data)
+
+    def reset_run_state(self):
+        '''
+        Agents kept warm across runs drop the per-run state (e.g. open workbooks) here before the next run
+        '''
+        pass
+
+    def copy_model_configs(self):
+        '''
+        The model configs are class level defaults. Each agent works on its own copy so that agents of
+        different modules in the same process do not overwrite each other's module, paths and tasks
+        '''
+        self.generate_model_config = self.generate_model_config.model_copy()
+        self.verify_model_config = self.verify_model_config.model_copy()
+
+    def configure_clients(self, stage_values = None):
+        '''
+        Applies the options of the model configs that change the static instructions of the clients.
+        Called in execute before the knowledge base is uploaded with those instructions.
+        stage_values are the values of the generator task placeholders that are the same for every item of the run
+        '''
+        for llm_client, model_config, values in [(self.generate_llm_client, self.generate_model_config, stage_values),
+                                                 (self.verify_llm_client, self.verify_model_config, None)]:
+            llm_client.use_compact_schemas([model_config.output_format] if model_config.compact_schema else [])
+            llm_client.set_static_prefix(self.static_prefix(model_config, values) if model_config.static_prefix else '')
+            llm_client.set_hedging(model_config.hedge)
+            llm_client.set_token_budget(model_config.token_budget)
+
+    def static_prefix(self, model_config, stage_values = None):
+        task = model_config.task_template.format_map(KeepPlaceholders(stage_values or {}))
+        return (model_config.role + '\nYour task instructions follow. The values of the placeholders in braces are given with each request\n' +
+                '\n'.join(line.strip() for line in task.strip().splitlines()))
+
+    def item_prompt(self, model_config, stage_values = None, **item_values):
+        '''
+        Sets the task of the item and returns its prompt: role and task, or only the item values when the stage has a static prefix
+        '''
+        model_config.task = model_config.task_template.format(**(stage_values or {}), **item_values)
+        if model_config.static_prefix:
+            return itemPrompt(item_values)
+        return model_config.role + '\n' + model_config.task
+
+    def retrieve_context(self, model_config, query):
+        '''
+        Knowledge base chunks relevant to the query when the model config opts in to retrieval, else None for the full knowledge base
+        '''
+        if model_config.retrieval_k <= 0:
+            return None
+        return getKnowledgeIndex(model_config.knowledge_base_path).context(query, model_config.retrieval_k)
+
     
 
 
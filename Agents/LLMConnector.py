@@ -1,11 +1,39 @@
-from google import genai
-from google.genai import types
 import os
 import requests
-from datetime import datetime
 import json
-from tenacity import retry, wait_exponential, stop_after_attempt, retry_if_exception_type
-from google.genai.errors import ClientError
+import time
+from tenacity import retry, wait_exponential, stop_after_attempt, retry_if_exception
+from pydantic import ValidationError
+from Helpers.MetricsRecorder import getMetrics
+from Helpers.Profiler import span
+from Helpers.CacheRegistry import CacheRegistry, cacheKey, holderId
+from Helpers.CacheKeepAlive import getKeepAlive
+from Helpers.HedgingPolicy import HedgingPolicy
+from Helpers.ResponseRepair import stripMarkdown, repairJson, validateElements, jsonSchema, compactSchema, schemaTokensSaved, estimateTokens
+
+
+CACHE_TTL_SECONDS = 1800
+#The TTL of the caches in use is extended in the background at this interval
+CACHE_REFRESH_SECONDS = CACHE_TTL_SECONDS // 3
+
+#Input token budget of the models: the context window less the tokens kept for the response
+TOKEN_BUDGETS = {'gemini-2.5-pro': 1048576 - 65536, 'gemini-2.5-flash': 1048576 - 65536, 'gpt-oss:20b': 131072 - 8192}
+DEFAULT_TOKEN_BUDGET = 32768 - 8192
+
+SYSTEM_INSTRUCTION = "You are an expert tester who must analyze the provided documents and help generate test cases, test steps, test data and expected output"
+
+
+def isGeminiClientError(exception):
+    #google.genai is imported only by gemini connectors, so it is already loaded when one of its errors is raised
+    from google.genai.errors import ClientError
+    return isinstance(exception, ClientError)
+
+def isCacheExpiredError(exception):
+    #The cached content of the turn expired or was deleted on the server. Retrying the same turn cannot succeed
+    return isGeminiClientError(exception) and getattr(exception, 'code', None) in (400, 403, 404) and 'cache' in str(exception).lower()
+
+def isRetryableGeminiError(exception):
+    return isGeminiClientError(exception) and not isCacheExpiredError(exception)
 
 
 class LLMConnector:
@@ -15,40 +43,134 @@ class LLMConnector:
             self.ollama_api_key= os.getenv('OLLAMA_API_KEY')
             self.ollama_knowledge_id = self._find_or_create_knowledge(test_module) 
         elif provider == "gemini":
+            #Imported here as google.genai takes most of the start-up time and ollama runs do not need it
+            from google import genai
             if role == 'generator':
                 self.gemini_api_key = os.getenv('GOOGLE_API_KEY_GEN')
                 self.gemini_client = genai.Client(api_key = self.gemini_api_key)
             else:
                 self.gemini_api_key = os.getenv('GOOGLE_API_KEY_VER')
                 self.gemini_client = genai.Client(api_key = self.gemini_api_key)
-            self.cache_directory = f'{role}_cache'
+            #Context caches are shared through the registry by the processes working on the same module, model and knowledge base
+            self.cache_registry, self.holder = CacheRegistry(), holderId(self)
+            self.cache, self.cache_key = None, None
         else:
             raise Exception('Invalid provider: {provider}')
         self.chat_session = None
         self.provider, self.model, self.knowledge_base_path = provider, model, knowledge_base_path
+        self.test_module, self.role = test_module, role
+        #Metrics stage, set by the LLMClient that owns the connector
+        self.stage = role
+        #With compact_schema the calls carry schemas without field documentation, which is sent once in the schema guide
+        self.compact_schema, self.schema_guide = False, ''
+        #Role and task instructions of the stage sent once instead of with every prompt
+        self.static_prefix = ''
+        #HedgingPolicy that duplicates requests slower than its threshold and its spec. None sends each request once
+        self.hedging, self.hedge_spec = None, None
+        self.token_budget = TOKEN_BUDGETS.get(model, DEFAULT_TOKEN_BUDGET)
+        self.knowledge_tokens, self.last_prompt_tokens = None, None
 
 #---------------------------------------Main Chat and file management functions-------------------------
-    def chat(self, prompt, response_schema, session = 'new'):
+    def chat(self, prompt, response_schema, session = 'new', context = None):
+        '''
+        context is the part of the knowledge base retrieved for the prompt. When given it is sent instead of the full knowledge base
+        '''
+        cached = self.instructions_cached(response_schema, context)
+        if self.compact_schema and response_schema:
+            saved = schemaTokensSaved(response_schema)
+            if not cached:
+                #The field guide goes with every request that is not served from the cache, so only the net saving is counted
+                saved -= estimateTokens(self.schema_guide)
+            getMetrics().increment(self.stage, 'schema_tokens_saved', saved)
+        if self.static_prefix:
+            #Only a prefix served from the cache is no longer sent. Otherwise it is the stable start of every request
+            metric = 'static_prefix_tokens' if cached else 'stable_prefix_tokens'
+            getMetrics().increment(self.stage, metric, estimateTokens(self.static_prefix))
+        estimated_tokens, self.last_prompt_tokens = self.estimate_tokens(prompt, context), None
         if self.provider == 'ollama':
             self.files = [os.path.join(self.knowledge_base_path, f) for f in os.listdir(self.knowledge_base_path) 
                 if os.path.isfile(os.path.join(self.knowledge_base_path, f))]
-            response = self._chat_ollama(prompt, response_schema)
+            if self.hedging:
+                with span('llm_wait'):
+                    response = self.hedging.run(lambda: self._chat_ollama(prompt, response_schema, context = context))
+            else:
+                response = self._chat_ollama(prompt, response_schema, context = context)
         elif self.provider == 'gemini':
-            response = self._chat_gemini(prompt, response_schema, session)
+            with span('llm_wait'):
+                try:
+                    response = self._send_gemini(prompt, response_schema, session, context)
+                except Exception as e:
+                    if self.cache is None or not isCacheExpiredError(e):
+                        raise
+                    #The cache is rebuilt and the request is retried once
+                    print(f'Context cache {self.cache.name} expired during the run and is rebuilt: {e}')
+                    getMetrics().increment(self.stage, 'cache_rebuilds')
+                    self._rebuild_cache_gemini()
+                    response = self._send_gemini(prompt, response_schema, session, context)
         else:
             raise Exception(f"{self.provider} is an invalid provider. It can only be ollama or gemini")
+        self._record_tokens(estimated_tokens)
         return response
 
+    def estimate_tokens(self, prompt, context = None):
+        '''
+        Local estimate of the input tokens of a request: static instructions, prompt and the retrieved context or the full knowledge base
+        '''
+        if context is not None:
+            knowledge_tokens = estimateTokens(context)
+        else:
+            if self.knowledge_tokens is None:
+                #From the file sizes, as the knowledge base does not change during a run
+                files = [os.path.join(self.knowledge_base_path, f) for f in os.listdir(self.knowledge_base_path)] if self.knowledge_base_path else []
+                self.knowledge_tokens = sum(os.path.getsize(f) for f in files if os.path.isfile(f)) // 4
+            knowledge_tokens = self.knowledge_tokens
+        return estimateTokens(prompt) + estimateTokens(self.instructions()) + knowledge_tokens
+
+    def _record_tokens(self, estimated_tokens):
+        #The actual count of a continued gemini session includes the earlier turns
+        metrics = getMetrics()
+        metrics.observe(self.stage, 'prompt_tokens_estimated', estimated_tokens)
+        if self.last_prompt_tokens:
+            metrics.observe(self.stage, 'prompt_tokens_actual', self.last_prompt_tokens)
+            metrics.observe(self.stage, 'token_estimate_ratio', self.last_prompt_tokens / max(estimated_tokens, 1))
+
+    def instructions(self):
+        '''
+        Static instructions of the stage. Part of the context cache for gemini and a stable system message for ollama
+        '''
+        return '\n\n'.join(filter(None, [self.static_prefix, self.schema_guide]))
+
+    def instructions_cached(self, response_schema, context = None):
+        '''
+        True when the static instructions of a request are served from the gemini context cache instead of being sent with it.
+        Ollama requests and gemini turns with retrieved context carry them in their system message
+        '''
+        return self.provider == 'gemini' and context is None and bool(response_schema)
+
+    def set_hedging(self, hedge):
+        '''
+        hedge is a HedgingPolicy spec e.g. "p95" or "20:0.05", or None to turn hedging off.
+        The policy is kept while the spec is unchanged, so that its latencies and budget carry over stage runs and service jobs
+        '''
+        if self.hedging is not None and hedge == self.hedge_spec:
+            return
+        self.hedging, self.hedge_spec = HedgingPolicy.resolve(hedge, self.stage), hedge
+
+    def response_json_schema(self, response_schema):
+        return compactSchema(response_schema) if self.compact_schema else jsonSchema(response_schema)
+
     def upload_files(self):
 
         self.files = [os.path.join(self.knowledge_base_path, f) for f in os.listdir(self.knowledge_base_path) 
                 if os.path.isfile(os.path.join(self.knowledge_base_path, f))]
         self.uploaded_files = []
         if self.provider == 'ollama':
-            results = self._upload_files_ollama(self.files)
+            with span('llm_wait'):
+                results = self._upload_files_ollama(self.files)
             # print(results)
         elif self.provider == 'gemini':
-            self._upload_files_gemini(self.files)
+            with span('llm_wait'):
+                self._upload_files_gemini(self.files)
         else:
             raise Exception(f"{self.provider} is an invalid provider. It can only be ollama or gemini")
 
@@ -64,24 +186,23 @@ class LLMConnector:
 
 # -----------------------------------Ollama helper functions-------------------------------------------
 
-    def _chat_ollama(self, prompt, response_schema = None, tries = 3):
+    def _chat_ollama(self, prompt, response_schema = None, tries = 3, context = None):
 
-        response_schema_json = response_schema.model_json_schema()
+        #Static instructions and the full knowledge base come first in a system message, so every request of the stage
+        #starts with the same prefix that the server can reuse. Only the prompt and retrieved context of the item follow
+        system = self.instructions()
+        if context is not None:
+            prompt = prompt + "Here are the parts of the knowledge base relevant to your task \n" + context + '\n'
+        else:
+            knowledge = "Here is the knowledge base to refer to do your task \n"
+            for file_path in self.files:
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    knowledge += f.read() + '\n'
+            system = '\n\n'.join(filter(None, [system, knowledge]))
 
-        knowledge = "Here is the knowledge base to refer to do your task \n"
-        
-        for file_path in self.files:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                knowledge += f.read() + '\n'
-        
         if response_schema:
-            json_instruction = (
-            f"\n\nYou must respond ONLY with valid JSON matching the given schema {response_schema_json}"
-            "Do not include any explanatory text, markdown formatting, or code blocks. "
-            "Return raw JSON only. Do not even have any preceding json markdown"
-        )
-    
-        prompt = prompt + knowledge + json_instruction
+            #The schema is passed as a structured output constraint so that decoding is restricted to it
+            prompt += "\n\nRespond with raw JSON only, in the required format."
         headers = {
             'Authorization': f'Bearer {self.ollama_api_key}',
             'Content-Type': 'application/json'
@@ -100,27 +221,79 @@ class LLMConnector:
             'num_predict': 8192
             }
         }
-        success = False
+        if system:
+            data['messages'].insert(0, {'role': 'system', 'content': system})
+        if context is not None:
+            #The retrieved context replaces the knowledge collection attached to the request
+            data.pop('files')
+        if response_schema:
+            data['response_format'] = {
+                'type': 'json_schema',
+                'json_schema': {'name': response_schema.__name__, 'schema': self.response_json_schema(response_schema), 'strict': True}
+            }
+        metrics = getMetrics()
+        reason = None
         for i in range(tries):
             print(f'Run #{i+1} to generate content')
-            response = requests.post(self.ollama_url+'chat/completions', headers=headers, json=data)
-            # print(response.json())
-            if response.status_code == 200:
-                result = response.json().get("choices", [{}])[0].get("message", {}).get("content", "")
-                # print(result)
-                try:
-                    if response_schema:
-                        result = self._cleanup_json(result)
-                    validated_model = response_schema.model_validate_json(result)
-                    success = True
-                    return validated_model.model_dump_json(indent=2)
-                except:
-                    success = False
-            # else:
-            #     raise Exception("Invalid response status from model")
-        if not success:
-            raise Exception('Ollama response: LLM unable to produce the necessary output')
-
+            result, reason = self._post_ollama(headers, data)
+            if result is None:
+                self._record_failure(reason)
+                continue
+            if not response_schema:
+                return result
+            validated_result, reason = self._validate_ollama(result, response_schema)
+            if validated_result:
+                if i > 0:
+                    metrics.increment(self.stage, 'ollama_regenerated')
+                return validated_result
+            #Full regeneration is the last resort
+            self._record_failure(reason)
+        raise Exception(f'Ollama response: LLM unable to produce the necessary output. Last failure: {reason}')
+
+    def _post_ollama(self, headers, data):
+        try:
+            with span('llm_wait'):
+                response = requests.post(self.ollama_url+'chat/completions', headers=headers, json=data)
+        except requests.RequestException as e:
+            return None, f'request_error: {type(e).__name__}'
+        if response.status_code != 200:
+            return None, f'http_{response.status_code}'
+        result = response.json()
+        self.last_prompt_tokens = (result.get('usage') or {}).get('prompt_tokens')
+        return result.get("choices", [{}])[0].get("message", {}).get("content", ""), None
+
+    def _validate_ollama(self, result, response_schema):
+        '''
+        Validates the response and, when that fails, repairs the JSON locally (truncated or trailing text).
+        A list response with some invalid elements is returned as is for the LLMClient to ask again for those elements only.
+        Returns (response json, failure reason)
+        '''
+        metrics = getMetrics()
+        try:
+            return response_schema.model_validate_json(self._cleanup_json(result)).model_dump_json(indent=2), None
+        except ValidationError:
+            pass
+        try:
+            parsed = json.loads(repairJson(result))
+        except json.JSONDecodeError:
+            return None, 'unparseable_json'
+        try:
+            validated_model = response_schema.model_validate(parsed)
+            metrics.increment(self.stage, 'ollama_repaired_locally')
+            return validated_model.model_dump_json(indent=2), None
+        except ValidationError as e:
+            validation_error = e
+        elements, errors = validateElements(response_schema, parsed)
+        if errors and len(errors) < len(elements):
+            metrics.increment(self.stage, 'ollama_partial_responses')
+            return json.dumps(parsed), None
+        return None, f'schema_validation: {validation_error.error_count()} errors'
+
+    def _record_failure(self, reason):
+        print(f'Ollama response rejected: {reason}')
+        metrics = getMetrics()
+        metrics.increment(self.stage, 'ollama_failures')
+        metrics.increment(self.stage, f"ollama_failure_{reason.split(':')[0]}")
 
     def _upload_files_ollama(self, files):
         results = []
@@ -205,119 +378,227 @@ class LLMConnector:
         return response.json()    
     
 # -----------------------------------Gemini helper functions-------------------------------------------
+    def _send_gemini(self, prompt, response_schema, session, context):
+        '''
+        Sends a turn and keeps its chat session for the turns that continue it. Only new sessions are hedged,
+        each attempt in a session of its own, and the session of the response that wins is kept.
+        The losing attempt keeps running _chat_gemini with its retries in the background, outside the hedging budget
+        '''
+        if self.hedging is None or session != 'new':
+            text, self.chat_session = self._chat_gemini(prompt, response_schema, session, context)
+            return text
+        if context is None and response_schema:
+            #Loaded before the attempts start so that they do not both upload the knowledge base
+            self._load_cache_gemini()
+        text, self.chat_session = self.hedging.run(lambda: self._chat_gemini(prompt, response_schema, session, context),
+                                                   valid = lambda response: bool(response[0]))
+        return text
+
     @retry(
     wait=wait_exponential(multiplier=1, min=4, max=30),
     stop=stop_after_attempt(10),
-    retry=retry_if_exception_type(ClientError)
+    retry=retry_if_exception(isRetryableGeminiError)
     )
-    def _chat_gemini(self, prompt, response_schema = None, session = 'new'):
-        self._load_cache_gemini()
-
+    def _chat_gemini(self, prompt, response_schema = None, session = 'new', context = None):
+        from google.genai import types
         turn_config = None
-        if response_schema:
+        if context is not None:
+            #Only the retrieved context is sent and the cached documents are not attached to the turn
+            prompt = prompt + "\nHere are the parts of the knowledge base relevant to your task \n" + context
+            if response_schema:
+                turn_config = types.GenerateContentConfig(
+                    system_instruction=self.instructions() or None,
+                    response_mime_type='application/json',
+                    **self._gemini_schema(response_schema)
+                )
+        elif response_schema:
+            self._load_cache_gemini()
+            #Every connector using a live cache keeps it alive, whichever path attached it
+            if not self._keep_alive().touch(self.cache_key, self.holder):
+                self._keep_cache_alive()
             turn_config = types.GenerateContentConfig(
                 cached_content=self.cache.name,
                 response_mime_type='application/json',
-                response_schema=response_schema
+                **self._gemini_schema(response_schema)
             )
 
         if not self.chat_session or session == 'new':
-            self.chat_session = self.gemini_client.chats.create(
+            chat_session = self.gemini_client.chats.create(
                 model=self.model
             )
+        else:
+            chat_session = self.chat_session
 
-        response = self.chat_session.send_message(message=prompt, config=turn_config)
-        return response.text
+        response = chat_session.send_message(message=prompt, config=turn_config)
+        if response.usage_metadata:
+            self.last_prompt_tokens = response.usage_metadata.prompt_token_count
+        return response.text, chat_session
     
 
-    def _upload_files_gemini(self, files, role = 'generator'):
-        try:
-            self._load_cache_gemini()
-            #Extending the cache time 
-            self.gemini_client.caches.update(
-                    name = self.cache.name,
-            config  = types.UpdateCachedContentConfig(
-                ttl='1800s'
-                    )
-                )
-        except:
-            print('Cache unavailable and hence uploading documents')
-            for file_path in files:
-                print(f"Uploading file: {file_path}...")
-                # mime_type = 'application/text-plain'
-
-                file_obj = self.gemini_client.files.upload(
-                    file=file_path
-                )
-                self.uploaded_files.append(file_obj)
-                print(f"Uploaded: {file_obj.display_name} ({file_obj.name})")
-
-            cache_contents = [f for f in self.uploaded_files]
-            # 5. Define system instructions for the combined document analysis
-            SYSTEM_INSTRUCTION = "You are an expert tester who must analyze the provided documents and help generate test cases, test steps, test data and expected output"
-
-            # 6. Create the single cache containing all uploaded files
-            print("\nCreating context cache for all documents...")
-            self.cache = self.gemini_client.caches.create(
-                model=self.model,
-                config=types.CreateCachedContentConfig(
-                    display_name="Requirements documents",
-                    system_instruction=SYSTEM_INSTRUCTION,
-                    contents=cache_contents,  # Pass the list of all uploaded File objects
-                    ttl='1800s',  # E.g., cache for 30 minutes
+    def _gemini_schema(self, response_schema):
+        #The compact schema is passed as JSON schema, the response model is converted with its descriptions by the SDK
+        return {'response_json_schema': compactSchema(response_schema)} if self.compact_schema else {'response_schema': response_schema}
+
+    def _upload_files_gemini(self, files):
+        '''
+        Uses the live cache of the same module, model, role and knowledge base from the cache registry or creates it.
+        While another process is creating the cache, this one waits for it instead of uploading again
+        '''
+        cache_key = cacheKey(self.test_module, self.model, self.role, self.knowledge_base_path, self.instructions())
+        if self.cache_key and self.cache_key != cache_key:
+            #The instructions changed since the last upload e.g. a warm agent running with other options
+            self._delete_files_gemini()
+        self.cache_key = cache_key
+        while True:
+            state, entry = self.cache_registry.acquire(self.cache_key, self.holder)
+            if state == 'live':
+                try:
+                    self._attach_cache_gemini(entry['cache_name'])
+                except Exception as e:
+                    #Rate limits and other transient errors were retried and are raised. The registry is left alone,
+                    #as expiring it would make the next holder delete a cache that other processes still use
+                    if not isCacheExpiredError(e):
+                        raise
+                    #The cache is gone on the server side and is created again
+                    print(f'Cache {entry["cache_name"]} unavailable: {e}')
+                    self.cache_registry.expire(self.cache_key, entry['cache_name'])
+                    continue
+                self.cache_registry.extend(self.cache_key, CACHE_TTL_SECONDS)
+                self._keep_cache_alive()
+                print(f'Using cache {self.cache.name} shared by {len(entry["holders"])} holders')
+                return
+            if state == 'wait':
+                time.sleep(2)
+                continue
+            if entry:
+                self._delete_cache_entry(entry)
+            try:
+                self._create_cache_gemini(files)
+            except Exception:
+                self.cache_registry.abandon(self.cache_key, self.holder)
+                raise
+            return
+
+    @retry(
+    wait=wait_exponential(multiplier=1, min=4, max=30),
+    stop=stop_after_attempt(5),
+    retry=retry_if_exception(isRetryableGeminiError),
+    reraise=True
+    )
+    def _attach_cache_gemini(self, cache_name):
+        from google.genai import types
+        self.cache = self.gemini_client.caches.get(name=cache_name)
+        #Extending the cache time 
+        self.gemini_client.caches.update(
+                name = self.cache.name,
+        config  = types.UpdateCachedContentConfig(
+            ttl=f'{CACHE_TTL_SECONDS}s'
                 )
             )
-            self._save_cache_gemini()
 
-            print(f"Cache created: {self.cache.name}")
-            print(f"Total cached tokens: {self.cache.usage_metadata.total_token_count}")
+    def _create_cache_gemini(self, files):
+        from google.genai import types
+        print('Cache unavailable and hence uploading documents')
+        for file_path in files:
+            print(f"Uploading file: {file_path}...")
+            # mime_type = 'application/text-plain'
 
-    def _save_cache_gemini(self):
-        # Save cache name to file
-        cache_info = {
-            'cache_name': self.cache.name,  # e.g., "cachedContents/abc123"
-            'created_at': datetime.now().isoformat(),
-            'ttl': '1800s'
-        }
+            file_obj = self.gemini_client.files.upload(
+                file=file_path
+            )
+            self.uploaded_files.append(file_obj)
+            print(f"Uploaded: {file_obj.display_name} ({file_obj.name})")
+
+        cache_contents = [f for f in self.uploaded_files]
+
+        # 6. Create the single cache containing all uploaded files
+        print("\nCreating context cache for all documents...")
+        self.cache = self.gemini_client.caches.create(
+            model=self.model,
+            config=types.CreateCachedContentConfig(
+                display_name="Requirements documents",
+                system_instruction='\n\n'.join(filter(None, [SYSTEM_INSTRUCTION, self.instructions()])),
+                contents=cache_contents,  # Pass the list of all uploaded File objects
+                ttl=f'{CACHE_TTL_SECONDS}s',  # E.g., cache for 30 minutes
+            )
+        )
+        self._save_cache_gemini()
 
-        os.makedirs(self.cache_directory, exist_ok=True)
+        print(f"Cache created: {self.cache.name}")
+        print(f"Total cached tokens: {self.cache.usage_metadata.total_token_count}")
 
-        with open(f'{self.cache_directory}/cache_info.json', 'w') as f:
-            json.dump(cache_info, f)
-        
+    def _save_cache_gemini(self):
         file_metadata = [{'name': f.name, 'display_name': f.display_name} 
                  for f in self.uploaded_files]
-        json.dump(file_metadata, open(f'{self.cache_directory}/uploaded_files.json', 'w'))
+        self.cache_registry.register(self.cache_key, self.holder, self.cache.name, file_metadata, CACHE_TTL_SECONDS)
+        self._keep_cache_alive()
+
+    def _keep_alive(self):
+        return getKeepAlive(CACHE_REFRESH_SECONDS, CACHE_TTL_SECONDS)
+
+    def _keep_cache_alive(self):
+        key, cache_name = self.cache_key, self.cache.name
+        self._keep_alive().track(key, self.holder, lambda: self._refresh_cache_gemini(key, cache_name))
+
+    def _refresh_cache_gemini(self, key, cache_name):
+        from google.genai import types
+        from google.genai.errors import ClientError
+        try:
+            self.gemini_client.caches.update(name = cache_name, config = types.UpdateCachedContentConfig(ttl=f'{CACHE_TTL_SECONDS}s'))
+        except ClientError as e:
+            #Only a cache that is gone is reported as such. Transient errors are raised and the next interval tries again
+            if isCacheExpiredError(e):
+                return False
+            raise
+        self.cache_registry.extend(key, CACHE_TTL_SECONDS)
+        return True
+
+    def _rebuild_cache_gemini(self):
+        #Processes that still hold the expired cache find it marked expired in the registry and move to the new one
+        self.cache_key = self.cache_key if self.cache_key else cacheKey(self.test_module, self.model, self.role, self.knowledge_base_path, self.instructions())
+        self.cache_registry.expire(self.cache_key, self.cache.name)
+        self.cache = None
+        self.upload_files()
 
     def _load_cache_gemini(self):
-        with open(f'{self.cache_directory}/cache_info.json', 'r') as f:
-            cache_info = json.load(f)
-        self.cache = self.gemini_client.caches.get(name=cache_info['cache_name'])
+        #Attaching goes through the registry as a holder, so that other processes do not delete the cache while it is used.
+        #The cache is created on first use e.g. for a verifier whose stage did not upload the knowledge base
+        if self.cache is None:
+            self.upload_files()
 
     def _delete_files_gemini(self):
-        # 8. Clean up (Important for cost management)
+        # 8. Clean up (Important for cost management). The cache is deleted only when no other process uses it
+        if self.cache_key is None:
+            return
+        self._keep_alive().untrack(self.cache_key, self.holder)
+        entry = self.cache_registry.release(self.cache_key, self.holder)
+        self.cache, self.cache_key = None, None
+        if entry:
+            self._delete_cache_entry(entry)
+
+    def _delete_cache_entry(self, entry):
         try:
-            self._load_cache_gemini()
-            file_metadata = json.load(open(f'{self.cache_directory}/uploaded_files.json', 'r'))
-            self.gemini_client.caches.delete(name=self.cache.name)
-            for file_info in file_metadata:
-                self.gemini_client.files.delete(name=file_info['name'])
+            self.gemini_client.caches.delete(name=entry['cache_name'])
         except Exception as e:
             print(e)
-        finally:
-            os.remove(f'{self.cache_directory}/uploaded_files.json')
-            os.remove(f'{self.cache_directory}/cache_info.json')
-            print("\nClean-up complete. Cache and individual files deleted.")
+        for file_info in entry.get('files', []):
+            try:
+                self.gemini_client.files.delete(name=file_info['name'])
+            except Exception as e:
+                print(e)
+        print(f"\nClean-up complete. Cache {entry['cache_name']} and individual files deleted.")
+
+    def purge_caches(self):
+        '''
+        Deletes the caches of this role that are expired or not used by any live process
+        '''
+        for entry in self.cache_registry.purge(self.role):
+            self._delete_cache_entry(entry)
    
 #------------------------------General helper functions-------------------------
     def _cleanup_json(self, result):
-        # Clean markdown artifacts
-            result = result.strip()
-            if result.startswith('```json'):
-                result = result.split('```json')[1].split('```')[0].strip()
-            elif result.startswith('```'):
-                result = result.split('```')[1].split('```')[0].strip()
-            return result
+        return stripMarkdown(result)
+
 
 
     
@@ -3,8 +3,14 @@ from Helpers.KnowledgeBaseProvider import getKnowledgeBasePath
 from pydantic import BaseModel, Field
 import pandas as pd
 import os
-from Helpers.OutputManager import CsvManager as csv
-import yaml
+from Helpers.IntermediateStore import JsonlStore, getStorePath
+from Helpers.ArtifactStore import ArtifactStore
+from Helpers.Deduplicator import NearDuplicateDetector, reportAvoidedWork
+from Helpers.CoverageAnalyzer import CoverageAnalyzer
+from Helpers.Traceability import knowledgeBaseDigests, resolveSources
+from Agents.TestDimensionsAgent import TestDimension
+from Agents.TestScenariosAgent import TestComboSet
+from Helpers.VerificationPolicy import VerificationPolicy
 import time
 
 class TestCase(BaseModel):
@@ -21,6 +27,7 @@ class TestCase(BaseModel):
                           **This HAS to be in a descriptive text format and not a structured format**''')
   then: str = Field(description="This is the expected result after the event is or events are processed")
   memberCode: str = Field(description="Use the same memberCode as that of the Scenario for which the Test Case is generated. **DO NOT CHANGE THE MEMBERCODE**")
+  traceability: str = Field(default = '', description='''This gives the references (comma separated) to the requirement documents by file name and the sections within them on which the test case is based''')
 
 class TestCaseList(BaseModel):
     output: list[TestCase]
@@ -28,6 +35,17 @@ class TestCaseList(BaseModel):
 class TestCaseVerification(BaseModel):
     isCorrect: bool = Field(description = 'Is the output correct or not. Verify the sequence of steps, the collateral types and the amounts used to verify')
     correction: str = Field(description = 'If the output is incorrect, the describe what should be corrected. If the output is correct, this will be blank')
+    incorrect_elements: list[int] = Field(default = [], description = 'If the output is incorrect, the row numbers (starting at 0) of the test cases that are incorrect')
+
+def rejectedElements(verify_response, num_elements, flag = 'isCorrect'):
+    '''
+    {index: correction} of the elements the verifier rejected. Empty when the verifier did not name the elements 
+    or rejected all of them, in which case the whole response is regenerated
+    '''
+    indices = {index for index in verify_response.get('incorrect_elements', []) if 0 <= index < num_elements}
+    if verify_response[flag] or not indices or len(indices) == num_elements:
+        return {}
+    return {index: verify_response['correction'] for index in sorted(indices)}
 
 class TestCaseAgent(PipelineStepAgent):
     generate_model_config = ModelConfig(
@@ -61,7 +79,8 @@ class TestCaseAgent(PipelineStepAgent):
                         task = '',
                         output_format = TestCaseList,
                         provider = 'gemini',
-                        model = 'gemini-2.5-pro' #'deepseek-r1:14b' #'qwen-coder:30b'#
+                        model = 'gemini-2.5-pro', #'deepseek-r1:14b' #'qwen-coder:30b'#
+                        cascade_models = ['gemini-2.5-flash']
                         )
     
     verify_model_config = ModelConfig(
@@ -80,6 +99,7 @@ class TestCaseAgent(PipelineStepAgent):
                                 4. Verify if the amounts used in {when_steps} is correct or not
                                 5. Verify if {then} is correct or not
                                 If all of these are correct then respond in the format required
+                                If any test case is incorrect, list its row number in incorrect_elements
                                 '''  ,
                         task = '',
                         output_format = TestCaseVerification,
@@ -88,38 +108,80 @@ class TestCaseAgent(PipelineStepAgent):
                         )
 
     def __init__(self, test_module):
+        self.copy_model_configs()
         self.generate_model_config.test_module = test_module
         self.generate_model_config.knowledge_base_path = getKnowledgeBasePath(test_module)
         self.verify_model_config.test_module = test_module
         self.verify_model_config.knowledge_base_path = getKnowledgeBasePath(test_module)
-        self.generate_llm_client = LLMClient(self.generate_model_config.provider, self.generate_model_config.model, self.generate_model_config.knowledge_base_path, test_module) #**self.generate_model_config.model_dump())
+        self.generate_llm_client = LLMClient(self.generate_model_config.provider, self.generate_model_config.model, self.generate_model_config.knowledge_base_path, test_module,
+                                             cascade_models = self.generate_model_config.cascade_models, stage = 'cas.generator') #**self.generate_model_config.model_dump())
         self.verify_llm_client = LLMClient(self.verify_model_config.provider, self.verify_model_config.model, self.verify_model_config.knowledge_base_path, test_module) #**self.verify_model_config.model_dump())
+        self.artifact_store = ArtifactStore()
+
 
+    def load_input_data(self, start = 1, end = -1, gaps_only = False, scenario_ids = None):
+        #Indexed range read from the artifact store, the typed store is used for outputs produced before the store existed
+        if scenario_ids:
+            self.scenarios = self.artifact_store.readScenarios(scenario_ids = scenario_ids)
+        else:
+            self.scenarios = (self.artifact_store.readScenarios(start, end) or 
+                              JsonlStore(getStorePath('TEST_SCENARIOS_FILE'), TestComboSet).read(start = start, end = end))
+        self.dimensions = JsonlStore(getStorePath('TEST_DIMENSIONS_FILE'), TestDimension).read(columns = ['dim_id', 'dimension', 'description', 'dim_type', 'values'])
+        if gaps_only:
+            self.scenarios = self.gap_scenarios()
 
-    def load_input_data(self):
-        self.input_df = pd.read_csv(f"{os.getenv('TEST_SCENARIOS_FILE')}")
-        with open(os.getenv('TEST_DIMENSIONS_FILE'), 'r') as f:
-            self.dimensions = yaml.safe_load(f)
-        f.close()
+    def gap_scenarios(self):
+        #Scenarios without test cases that close the dimension value and pair gaps of the existing test cases
+        analyzer = CoverageAnalyzer(self.dimensions, self.scenarios)
+        covered_mask = analyzer.scenarioMask(self.artifact_store.scenarioIdsWithTestCases())
+        print(f'Test case coverage: {analyzer.report(covered_mask)}')
+        scenario_ids = set(analyzer.scenariosForGaps(covered_mask))
+        print(f'Generating test cases for {len(scenario_ids)} scenarios to close the coverage gaps')
+        return [scenario for scenario in self.scenarios if str(scenario['scenario_id']) in scenario_ids]
 
 
     def load_knowledge_base(self):
         self.generate_llm_client.upload_files()
         #self.verify_llm_client.upload_files()
 
-    def generate_content(self, prompt, response_schema=None):
-        return self.generate_llm_client.generate_content(prompt, response_schema)
+    def generate_content(self, prompt, response_schema=None, check=None, tier=0, context=None):
+        return self.generate_llm_client.generate_content(prompt, response_schema, check = check, tier = tier, context = context)
+
+    def local_check(self, response, scenario_id):
+        #Cheap checks on a generated response before it is accepted from a faster model
+        return len(response['output']) > 0 and all(str(case['test_scenario_id']) == str(scenario_id) and case['memberCode'].strip() 
+                                                   for case in response['output'])
+
+    def risk_flagged(self, response):
+        #Test cases without amounts in the steps or involving transfers and de-allocation are the ones the verifier usually corrects
+        for case in response['output']:
+            steps = case['given_steps'] + ' ' + case['when_steps']
+            if not any(char.isdigit() for char in steps) or 'transfer' in steps.lower() or 'de-alloc' in steps.lower():
+                return True
+        return False
     
     def verify_content(self, prompt, response_schema=None):
         return self.verify_llm_client.generate_content(prompt, response_schema)
     
-    def execute(self, start = 1, end = -1, gen_instruct = '', verify = False, tries = 3, wait = True):
+    def duplicate_detector(self):
+        #Test cases of different scenarios cover different dimension values however similar their steps, so they are only
+        #compared within their scenario. The stored test cases of a scenario in this run are replaced and are not compared
+        return NearDuplicateDetector('test_case_id', ['given_steps', 'when_steps'], group_function = lambda case: str(case['test_scenario_id']))
+
+    def execute(self, start = 1, end = -1, gen_instruct = '', verify = False, tries = 3, wait = True, dedup = 'drop', gaps_only = False, scenario_ids = None):
         inCorrectScenarios = []
+        verify_policy = VerificationPolicy.resolve(verify, 'cas.verifier')
+        self.load_input_data(start, end, gaps_only, scenario_ids)
+        #The dimensions and general instructions are the same for every scenario and are part of the static prefix
+        stage_values = {'test_dimensions': self.dimensions, 'general_instructions': gen_instruct}
+        self.configure_clients(stage_values)
         if self.generate_model_config.provider == 'gemini':
             self.load_knowledge_base()
 
-        self.load_input_data()
-        final_df = pd.DataFrame()
+        test_cases_store = JsonlStore(getStorePath('TEST_CASES_FILE'), TestCase)
+        digests = knowledgeBaseDigests(self.generate_model_config.knowledge_base_path)
+        cases_written, cases_dropped = 0, 0
+        detector = self.duplicate_detector() if dedup != 'off' else None
         knowledge_files = os.listdir(self.generate_model_config.knowledge_base_path)
         gen_prompt = f'''I have uploaded the following documents. You required to carefully understand the requirements, processing rules, static data, masters that have already been uploaded. 
         Can you confirm if you have the following documents in your cache?
@@ -127,43 +189,82 @@ class TestCaseAgent(PipelineStepAgent):
         '''
         turn1_response = self.generate_content(gen_prompt)
         print(turn1_response)
-        for record_num in range(start-1, (len(self.input_df) if end < 0 else min(end, len(self.input_df)))):
-            scenario = self.input_df.iloc[record_num]
+        for record_num, scenario in enumerate(self.scenarios, start = start-1):
 
-            verifier_feedback, verify_response = '', None
-            self.generate_model_config.task = self.generate_model_config.task_template.format(scenario_id = str(scenario['scenario_id']),scenario=str(scenario['scenario_description']), 
-                                                                                              dimensions = str(scenario['scenario_dimension']),
-                                                                                              general_instructions = gen_instruct, test_dimensions = self.dimensions)
+            verifier_feedback, verify_response, verify_item, rejected_elements = '', None, None, {}
+            generation_task = self.item_prompt(self.generate_model_config, stage_values, scenario_id = str(scenario['scenario_id']),
+                                               scenario = str(scenario['scenario_description']), dimensions = str(scenario['scenario_dimension']))
             print(f"\n Generating Test Cases for Scenario {record_num+1}")
+            context = self.retrieve_context(self.generate_model_config, f"{scenario['scenario_id']} {scenario['scenario_description']} {scenario['scenario_dimension']}")
             for i in range(tries):
-                #Generation
-                prompt = self.generate_model_config.role + '\n' + self.generate_model_config.task + '\n' + f'Verifier feedback: {verifier_feedback}'
-                generated_response = self.generate_content(prompt, self.generate_model_config.output_format)
+                #Generation. Only the test cases rejected by the verifier are corrected when the rest were accepted
+                repaired_response = None
+                if rejected_elements:
+                    repaired_response = self.generate_llm_client.repair_elements(generation_prompt, self.generate_model_config.output_format, 
+                                                                                 generated_response, rejected_elements)
+                if repaired_response:
+                    generated_response = repaired_response
+                else:
+                    generation_prompt = generation_task + '\n' + f'Verifier feedback: {verifier_feedback}'
+                    generated_response = self.generate_content(generation_prompt, self.generate_model_config.output_format, 
+                                                               check = lambda response: self.local_check(response, scenario['scenario_id']), tier = i,
+                                                               context = context)
                 output_df = pd.DataFrame(generated_response['output'])
                 
                 #Verification                
-                self.verify_model_config.task = self.verify_model_config.task_template.format(given_steps = output_df['given_steps'], when_steps = output_df['when_steps'], then = output_df['then'],
-                                                                                              scenario_id = str(scenario['scenario_id']), scenario=str(scenario['scenario_description']), 
-                                                                                              dimensions = str(scenario['scenario_dimension']))    
-                prompt = self.verify_model_config.role + '\n' + self.verify_model_config.task
-                if verify:
+                prompt = self.item_prompt(self.verify_model_config, given_steps = output_df['given_steps'], when_steps = output_df['when_steps'], then = output_df['then'],
+                                          scenario_id = str(scenario['scenario_id']), scenario = str(scenario['scenario_description']),
+                                          dimensions = str(scenario['scenario_dimension']))
+                if verify_item is None:
+                    verify_item = verify_policy.should_verify(scenario['scenario_id'], flagged = self.risk_flagged(generated_response))
+                if verify_item:
                     # time.sleep(2)
                     print(f'Verifying for the {i+1}th time')
                     verify_response = self.verify_content(prompt,self.verify_model_config.output_format)
+                    verify_policy.record_outcome(scenario['scenario_id'], verify_response['isCorrect'])
+                    for case in generated_response['output']:
+                        self.artifact_store.recordVerification('cas', case['test_case_id'], verify_response['isCorrect'], verify_response['correction'],
+                                                               scenario_id = str(scenario['scenario_id']), test_case_id = case['test_case_id'])
                     if verify_response['isCorrect']:
                         break
                     else:
                         verifier_feedback = verify_response['correction']
+                        rejected_elements = rejectedElements(verify_response, len(generated_response['output']))
+                else:
+                    break
 
-            if not verify or (verify_response and verify_response['isCorrect']):
-                if final_df.empty:
-                    final_df = output_df
+            if not verify_item or (verify_response and verify_response['isCorrect']):
+                test_cases = generated_response['output']
+                if detector:
+                    test_cases, duplicates = detector.filter(test_cases, mode = dedup, stage = 'cas.dedup')
+                    cases_dropped += len(generated_response['output']) - len(test_cases)
+                    if duplicates:
+                        print(f'Duplicate test cases ({dedup}) for Scenario {record_num+1}: {duplicates}')
+                if len(test_cases) == 0:
+                    self.report_progress(scenario['scenario_id'], 'skipped', reason = 'duplicate test cases', total = len(self.scenarios))
+                    continue
+                if scenario_ids:
+                    #Regenerated scenarios replace only their own test cases
+                    test_cases_store.replaceWhere(test_cases, 'test_scenario_id', scenario['scenario_id'])
                 else:
-                    final_df = pd.concat([final_df, output_df], ignore_index = True)
-                csv.writeDfToCsv(final_df, os.getenv('TEST_CASES_FILE'))
+                    #The first scenario of the run replaces the earlier output, the rest are appended. Gap runs always append
+                    test_cases_store.write(test_cases, append = gaps_only or cases_written > 0)
+                cases_written += len(test_cases)
+                self.artifact_store.writeTestCases(scenario['scenario_id'], test_cases, 
+                                                   status = 'cases_verified' if verify_item else 'cases_generated')
+                for case in test_cases:
+                    traceability = case.get('traceability') or scenario.get('traceability', '')
+                    self.artifact_store.recordSources('test_case', case['test_case_id'], resolveSources(traceability, digests), traceability)
+                self.report_progress(scenario['scenario_id'], 'done', test_cases = [case['test_case_id'] for case in test_cases], total = len(self.scenarios))
             else:
                 print(f'Unable to generate correct test case for Scenario {record_num+1} because {verifier_feedback}')
                 inCorrectScenarios.append(scenario['scenario_id'])
+                self.report_progress(scenario['scenario_id'], 'failed', reason = verifier_feedback, total = len(self.scenarios))
         
+        if cases_written > 0:
+            test_cases_store.exportCsv(os.getenv('TEST_CASES_FILE'))
+        #Each test case costs generation and verification in stp and per step in out
+        reportAvoidedWork('cas.dedup', cases_dropped, 2 + 2 * self.artifact_store.averageSteps())
+
         if len(inCorrectScenarios) > 0:
             print(f'Unable to generate correct test cases for {inCorrectScenarios}')
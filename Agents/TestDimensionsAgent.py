@@ -2,7 +2,8 @@ from Agents.Agent import PipelineStepAgent, ModelConfig, LLMClient
 from Helpers.KnowledgeBaseProvider import getKnowledgeBasePath
 from pydantic import BaseModel, Field
 import pandas as pd
-from Helpers.OutputManager import CsvManager as csv
+from Helpers.IntermediateStore import JsonlStore, getStorePath
+from Helpers.ArtifactStore import ArtifactStore
 import os
 
 
@@ -63,6 +64,7 @@ class TestDimensionAgent(PipelineStepAgent):
                         )
 
     def __init__(self, test_module):
+        self.copy_model_configs()
         self.generate_model_config.test_module = test_module
         self.generate_model_config.knowledge_base_path = getKnowledgeBasePath(test_module)
         self.verify_model_config.test_module = test_module
@@ -94,5 +96,8 @@ class TestDimensionAgent(PipelineStepAgent):
                 verify_response = self.verify_content(generated_response)
                 if verify_response['overall_score'] >= 70:
                     break
-        csv.writeDfToCsv(pd.DataFrame(generated_response['output']), os.getenv('TEST_DIMENSIONS_FILE'))
+        dimensions_store = JsonlStore(getStorePath('TEST_DIMENSIONS_FILE'), TestDimension)
+        dimensions_store.write(generated_response['output'])
+        dimensions_store.exportCsv(os.getenv('TEST_DIMENSIONS_FILE'))
+        ArtifactStore().writeDimensions(dimensions_store.read())
         #print(generated_response)
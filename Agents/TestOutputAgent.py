@@ -4,6 +4,10 @@ from pydantic import BaseModel, Field
 import pandas as pd
 import os
 from Helpers.OutputManager import ExcelManager
+from Helpers.IntermediateStore import JsonlStore, getStorePath
+from Helpers.ArtifactStore import ArtifactStore
+from Agents.TestCasesAgent import TestCase, rejectedElements
+from Helpers.VerificationPolicy import VerificationPolicy
 import json
 import sys
 
@@ -304,6 +308,7 @@ class ExpectedResult(BaseModel):
 class TestOutputVerification(BaseModel):
     correctness: bool = Field(default=True, description="Is the output correct?")
     correction: str = Field(default="", description="What needs correction")
+    incorrect_elements: list[int] = Field(default=[], description="Positions (starting at 0) of the current state lines that are incorrect")
 
 class TestOutputAgent(PipelineStepAgent):
     generate_model_config = ModelConfig(
@@ -325,7 +330,8 @@ class TestOutputAgent(PipelineStepAgent):
                         task = '' ,
                         output_format = ExpectedResult,
                         provider = 'gemini',
-                        model = 'gemini-2.5-pro' #'deepseek-r1:14b' #'qwen-coder:30b'#
+                        model = 'gemini-2.5-pro', #'deepseek-r1:14b' #'qwen-coder:30b'#
+                        cascade_models = ['gemini-2.5-flash']
                         )
     
     verify_model_config = ModelConfig(
@@ -339,7 +345,7 @@ class TestOutputAgent(PipelineStepAgent):
                                 Ensure the Allocated amount is equal to the total allocation that is permissible from the requested allocation details. 
                                 Note: Rows with keys of   step, memberCode,segment_group,segment,purpose_of_deposit,collateral_group, collateral_component,is_fungible,currency will be aggregated and there will only be one row for a combination of these fields. 
                                 **Verify only the current state** and you **DO NOT** have to validate the test case, previous state, step or allocation steps
-                                If the output is incorrect record the reasons.
+                                If the output is incorrect record the reasons and the positions (starting at 0) of the incorrect lines of the current state.
                                 ''',
                         task =  '' ,
                         output_format = TestOutputVerification,
@@ -348,40 +354,75 @@ class TestOutputAgent(PipelineStepAgent):
                         )
 
     def __init__(self, test_module):
+        self.copy_model_configs()
         self.generate_model_config.test_module = test_module
         self.generate_model_config.knowledge_base_path = getKnowledgeBasePath(test_module)
         self.verify_model_config.test_module = test_module
         self.verify_model_config.knowledge_base_path = getKnowledgeBasePath(test_module)
-        self.excel_handler = ExcelManager(mode = 'modify', filepath = os.getenv('TEST_DATA_FILE'))
-        self.generate_llm_client = LLMClient(self.generate_model_config.provider, self.generate_model_config.model, self.generate_model_config.knowledge_base_path, test_module, 'generator') #**self.generate_model_config.model_dump())
+        #The writable workbook is opened only when the first output is written. Inputs are read in read only mode
+        self.excel_handler = None
+        self.artifact_store = ArtifactStore()
+        self.generate_llm_client = LLMClient(self.generate_model_config.provider, self.generate_model_config.model, self.generate_model_config.knowledge_base_path, test_module, 'generator',
+                                             cascade_models = self.generate_model_config.cascade_models, stage = 'out.generator') #**self.generate_model_config.model_dump())
         self.verify_llm_client = LLMClient(self.verify_model_config.provider, self.verify_model_config.model, self.verify_model_config.knowledge_base_path, test_module, 'verifier') #**self.verify_model_config.model_dump())
         self.inCorrectSheetList = []
 
+    def preload_input_data(self, sheets):
+        #Test cases are keyed by id and the step blocks of only the requested sheets are extracted in one pass
+        test_cases = self.artifact_store.readTestCases(test_case_ids = sheets) if sheets else self.artifact_store.readTestCases()
+        self.test_cases = {case['test_case_id']: case for case in (test_cases or JsonlStore(getStorePath('TEST_CASES_FILE'), TestCase).read())}
+        self.sheet_blocks = ExcelManager.readSheetBlocks(os.getenv('TEST_DATA_FILE'), sheets)
+
     def load_input_data(self, sheetName):
-        test_cases_df = pd.read_csv(os.getenv('TEST_CASES_FILE'))
-        test_case_for_id = test_cases_df[test_cases_df['test_case_id'] == sheetName]
-        test_step_end_row, steps_df = self.excel_handler.excelToDfConverter(sheetName, "##Test Steps - Start", "##Test Steps - End")
-        allocation_end_row, allocation_df = self.excel_handler.excelToDfConverter(sheetName, "##allocation Steps - Start", "##allocation Steps - End")
+        test_case_for_id = pd.DataFrame([self.test_cases[sheetName]] if sheetName in self.test_cases else [])
+        blocks = self.sheet_blocks[sheetName]
+        test_step_end_row, steps_df = blocks["##Test Steps"]
+        allocation_end_row, allocation_df = blocks.get("##allocation Steps", (None, pd.DataFrame()))
         end_row = allocation_end_row if allocation_end_row else test_step_end_row
         return test_case_for_id, end_row, steps_df, allocation_df
 
+    def write_output(self, sheetName, output_df, end_row, startMarker, endMarker):
+        if self.excel_handler is None:
+            self.excel_handler = ExcelManager(mode = 'modify', filepath = os.getenv('TEST_DATA_FILE'))
+        # Delete the earlier output from Excel
+        self.excel_handler.deleteRange(sheetName, startMarker, endMarker)
+        self.excel_handler.writeDfToSheet(sheetName = sheetName, dfToWrite=output_df,
+                                          startRow=end_row+2, startMarker=startMarker, endMarker=endMarker)
+        # Save the workbook
+        self.excel_handler.save_wb()
+
+    def reset_run_state(self):
+        #The workbook may have been rewritten by the steps stage since the last run
+        self.excel_handler = None
+        self.inCorrectSheetList = []
+
     def load_generator_knowledge_base(self):
         self.generate_llm_client.upload_files()
 
     def load_verifier_knowledge_base(self):
         self.verify_llm_client.upload_files()
 
-    def generate_content(self, prompt, response_schema = None, session = 'new'):
-        return self.generate_llm_client.generate_content(prompt, response_schema, session)
+    def generate_content(self, prompt, response_schema = None, session = 'new', check = None, tier = 0, context = None):
+        return self.generate_llm_client.generate_content(prompt, response_schema, session, check = check, tier = tier, context = context)
+
+    def local_check(self, response, step):
+        #Every summary line should belong to the step being generated and no balance should go negative
+        return len(response['output']) > 0 and all(line['step'] == step and line['unallocated'] >= 0 for line in response['output'])
+
+    def risk_flagged(self, response):
+        #Allocations and sharing across segments are where the expected output usually goes wrong
+        return any(line['allocated'] > 0 or line['allocatedLent'] > 0 or line['mlnLentAmount'] > 0 for line in response['output'])
     
     def verify_content(self, prompt, response_schema = None, session = 'new'):
         return self.verify_llm_client.generate_content(prompt, response_schema, session)
     
     def execute(self, sheets, verify = False, tries = 3, startMarker = '##Expected Output - Start', endMarker = '##Expected Output - End', cleanup = True):
+        self.configure_clients()
+        verify_policy = VerificationPolicy.resolve(verify, 'out.verifier')
         if self.generate_model_config.provider == 'gemini':
             self.load_generator_knowledge_base()
 
-        if verify and self.verify_model_config.provider == 'gemini':
+        if verify_policy.enabled and self.verify_model_config.provider == 'gemini':
             self.load_verifier_knowledge_base()
 
         knowledge_files = os.listdir(self.generate_model_config.knowledge_base_path)
@@ -392,7 +433,7 @@ class TestOutputAgent(PipelineStepAgent):
         turn1_response = self.generate_content(prompt = gen_prompt, session = 'new')
         print(turn1_response)
         
-        if verify:
+        if verify_policy.enabled:
             gen_prompt = f'''I have uploaded the following documents. You required to carefully understand the requirements, processing rules, static data, masters that have already been uploaded. 
             Can you confirm if you have the following documents in your cache?
             {str(knowledge_files)}
@@ -400,20 +441,21 @@ class TestOutputAgent(PipelineStepAgent):
             turn1_response = self.verify_content(prompt = gen_prompt, session = 'new')
             print(turn1_response)
 
-        sheetNames = sheets if sheets else self.excel_handler.sheetnames #specific sheets if given as input, if not all sheets
+        self.preload_input_data(sheets)
+        #specific sheets if given as input, if not all sheets that have test steps
+        sheetNames = [sheetName for sheetName, blocks in self.sheet_blocks.items() if "##Test Steps" in blocks]
         #For each sheet
         for sheetName in sheetNames:
 
             # if (sheets is None) or (sheets is not None and sheetName in sheets):
             # Correct Output indicator
             isOutputCorrect = False
-            # Delete the range from Excel
-            self.excel_handler.deleteRange(sheetName, startMarker, endMarker)
-            # Convert to Dataframe
-            output_df = pd.DataFrame()
+            #Lines of the accepted steps, converted to a dataframe once the sheet is done
+            output_lines = []
             test_case, end_row, steps_df, allocation_df = self.load_input_data(sheetName)
             # Generate output given the current state and the transaction
             step_count, current_state, previous_state = len(steps_df), {}, {}
+            feedback = ''
 
             gen_prompt = f'''Now focus on this specific Test Case sheet. Here are the details of the test case
             {test_case}.
@@ -427,6 +469,7 @@ class TestOutputAgent(PipelineStepAgent):
             for step in range(1, step_count+1):
                 feedback = ''
                 actual_step = steps_df[steps_df['step'] == step ]
+                allocation_steps_json = ''
                 if len(allocation_df) > 0:
                     allocation_steps = allocation_df[allocation_df['step'] == step]
                     if len(allocation_steps) > 0:
@@ -436,44 +479,52 @@ class TestOutputAgent(PipelineStepAgent):
               
                 step_number = str(actual_step['step'].item()),
                 #Format Prompt
-                self.generate_model_config.task = self.generate_model_config.task_template.format(test_case = test_case.to_json(),
-                                                                                                    step = actual_step.to_json(),
-                                                                                                    allocation_steps = allocation_steps_json,
-                                                                                                    step_number = str(step),
-                                                                                                    current_state = str(current_state)
-                                                                                                    )
+                generation_task = self.item_prompt(self.generate_model_config, test_case = test_case.to_json(), step = actual_step.to_json(),
+                                                   allocation_steps = allocation_steps_json, step_number = str(step), current_state = str(current_state))
                 #Generate output
                 print(f"\nExpected Output being generated for {sheetName} - {step_number}")
+                verify_item, rejected_elements = None, {}
+                context = self.retrieve_context(self.generate_model_config, f'{test_case.to_json()} {actual_step.to_json()} {allocation_steps_json}')
                 for i in range(tries):
-                    prompt = self.generate_model_config.role + '\n' + self.generate_model_config.task + f'\n Verifier feedback: {feedback}'
-                    # print(f'here is the {prompt} for {step_number}')
-                    generated_response = self.generate_content(prompt,self.generate_model_config.output_format)
+                    #Only the lines rejected by the verifier are corrected when the rest were accepted
+                    repaired_response = None
+                    if rejected_elements:
+                        repaired_response = self.generate_llm_client.repair_elements(generation_prompt, self.generate_model_config.output_format,
+                                                                                     generated_response, rejected_elements)
+                    if repaired_response:
+                        generated_response = repaired_response
+                    else:
+                        generation_prompt = generation_task + f'\n Verifier feedback: {feedback}'
+                        # print(f'here is the {prompt} for {step_number}')
+                        generated_response = self.generate_content(generation_prompt,self.generate_model_config.output_format, 
+                                                                   check = lambda response: self.local_check(response, step), tier = i,
+                                                                   context = context)
                     current_state = generated_response['output']
                     # print(f'This is the current_state after Step {step_number} - {current_state}')
-                    if verify:
+                    if verify_item is None:
+                        verify_item = verify_policy.should_verify(f'{sheetName}:{step}', flagged = self.risk_flagged(generated_response))
+                    if verify_item:
                         print(f"\nVerifying Expected Output being generated for {sheetName} - {step_number}")
-                        self.verify_model_config.task = self.verify_model_config.task_template.format(test_case = test_case.to_json(),
-                                                                                                        previous_state = str(previous_state),
-                                                                                                        current_state = str(current_state),
-                                                                                                        step = actual_step.to_json(),
-                                                                                                        allocation_steps = allocation_steps_json
-                                                                                                        )
-                        prompt = self.verify_model_config.role + '\n' + self.verify_model_config.task
+                        prompt = self.item_prompt(self.verify_model_config, test_case = test_case.to_json(), previous_state = str(previous_state),
+                                                  current_state = str(current_state), step = actual_step.to_json(), allocation_steps = allocation_steps_json)
                         verify_response = self.verify_content(prompt, self.verify_model_config.output_format, session = 'new')
+                        verify_policy.record_outcome(f'{sheetName}:{step}', verify_response['correctness'])
+                        self.artifact_store.recordVerification('out', f'{sheetName}:{step}', verify_response['correctness'], verify_response['correction'],
+                                                               test_case_id = sheetName)
                         feedback = verify_response['correction']
                         if verify_response['correctness'] == True:
                             previous_state = current_state
                             break
+                        rejected_elements = rejectedElements(verify_response, len(current_state), 'correctness')
                     else: 
                         break
 
                 #State update for next iteration
-                if not verify or (verify_response['correctness'] == True):
+                if not verify_item or (verify_response['correctness'] == True):
                     isOutputCorrect = True
-                    if output_df.empty:
-                        output_df = pd.DataFrame(generated_response['output'])
-                    else:
-                        output_df = pd.concat([output_df, pd.DataFrame(generated_response['output'])], ignore_index=True)
+                    previous_state = current_state
+                    self.report_progress(f'{sheetName}:{step}', 'step_done', lines = len(current_state), steps = step_count)
+                    output_lines.extend(generated_response['output'])
                 else:
                     print(f'Unable to generate correct expected output for {sheetName}. Reason: {feedback}')
                     self.inCorrectSheetList.append(sheetName)
@@ -482,11 +533,13 @@ class TestOutputAgent(PipelineStepAgent):
 
             # Write the output to the sheet
             if isOutputCorrect:
-                curr_row = self.excel_handler.writeDfToSheet(sheetName = sheetName, dfToWrite=output_df,
-                                    startRow=end_row+2, startMarker="##Expected Output - Start", endMarker="##Expected Output - End")
-
-                # Save the workbook
-                self.excel_handler.save_wb()
+                output_df = pd.DataFrame(output_lines)
+                self.artifact_store.writeExpectedOutput(sheetName, output_lines)
+                self.write_output(sheetName, output_df, end_row, startMarker, endMarker)
+                self.report_progress(sheetName, 'done', total = len(sheetNames))
+            else:
+                self.artifact_store.updateStatus(sheetName, 'output_failed')
+                self.report_progress(sheetName, 'failed', reason = feedback, total = len(sheetNames))
         print(f'Here are the list of sheets for which correct output could not be produced: {self.inCorrectSheetList}')
 
         #Clean up uploaded files and delete cache
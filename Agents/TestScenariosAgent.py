@@ -1,10 +1,16 @@
-from Agents.Agent import PipelineStepAgent, ModelConfig, LLMClient
+from Agents.Agent import PipelineStepAgent, ModelConfig, LLMClient, mergeResults
 from Helpers.KnowledgeBaseProvider import getKnowledgeBasePath
 from pydantic import BaseModel, Field
 import pandas as pd
 import os
-from Helpers.OutputManager import CsvManager as csv
-import yaml
+from Helpers.IntermediateStore import JsonlStore, getStorePath
+from Helpers.ArtifactStore import ArtifactStore
+from Helpers.Deduplicator import NearDuplicateDetector, dimensionKey, reportAvoidedWork
+from Helpers.CoverageAnalyzer import CoverageAnalyzer
+from Helpers.Traceability import knowledgeBaseDigests, resolveSources
+from Agents.TestDimensionsAgent import TestDimension
+import json
+import re
 
 
 class TestComboValue(BaseModel):
@@ -15,6 +21,7 @@ class TestComboSet(BaseModel):
     scenario_id: str = Field(description = 'Unique identifier for the combination. The numbering follows SC-001, SC-002 pattern')
     scenario_description: str = Field (description = 'Comprehensive description of the scenario using the dimensions provided.')
     scenario_dimension: list[TestComboValue] = Field(description= 'The list of combination values of dimensions')
+    traceability: str = Field(default = '', description = '''This gives the references (comma separated) to the requirement documents by file name and the sections within them from which the scenario is derived''')
 
 class TestComboList(BaseModel):
     output: list[TestComboSet] = Field(description = 'Consists of all the Test Combination sets. ')
@@ -23,6 +30,12 @@ class TestComboVerification(BaseModel):
     overall_score: int = Field(description = 'Provides a score out of 100 in terms of correctness of the test combos')
 
 
+def nextScenarioNumber(scenarios):
+    #Scenarios dropped by the dedup leave gaps in the numbering, so new scenarios continue from the highest number
+    numbers = [int(match.group(1)) for match in (re.search(r'(\d+)$', str(scenario['scenario_id'])) for scenario in scenarios) if match]
+    return max(numbers, default = 0) + 1
+
+
 class TestScenarioAgent(PipelineStepAgent):
     generate_model_config = ModelConfig(
                         test_module = '',
@@ -61,7 +74,32 @@ class TestScenarioAgent(PipelineStepAgent):
                         model = 'gemini-2.5-pro'
                         )
 
+    gap_task_template = '''
+                                You required to carefully understand the requirements and the Test dimensions provided here 
+                                {dimensions}
+                                Scenarios have already been generated, but none of them cover the following dimension values and combinations of values
+                                {gaps}
+                             and do the following
+                                1. Create scenarios **ONLY** for the uncovered values and combinations listed above. **DO NOT** repeat the scenarios already generated.
+                                2. Use only the dimensions and the respective values available in the **Input**. **DO NOT** use any other dimensions.
+                                3. Continue the numbering of the scenario_id from SC-{next_id:03d}
+                                4. List them in the format required
+                                '''
+
+    regenerate_task_template = '''
+                                You required to carefully understand the requirements and the Test dimensions provided here 
+                                {dimensions}
+                                The requirement documents have changed since the following scenarios were generated
+                                {scenarios}
+                             and do the following
+                                1. Regenerate each of these scenarios as per the current requirements. **Keep the same scenario_id** for each of them.
+                                2. **DO NOT** generate any other scenarios.
+                                3. Use only the dimensions and the respective values available in the **Input**. **DO NOT** use any other dimensions.
+                                4. List them in the format required
+                                '''
+
     def __init__(self, test_module):
+        self.copy_model_configs()
         self.generate_model_config.test_module = test_module
         self.generate_model_config.knowledge_base_path = getKnowledgeBasePath(test_module)
         self.verify_model_config.test_module = test_module
@@ -71,10 +109,7 @@ class TestScenarioAgent(PipelineStepAgent):
 
 
     def load_input_data(self):
-        with open(os.getenv('TEST_DIMENSIONS_FILE'), 'r') as f:
-            self.dimensions = yaml.safe_load(f)
-        f.close()
-        # self.input_df = pd.read_csv(f"{os.getenv('TEST_DIMENSIONS_FILE')}")         
+        self.dimensions = JsonlStore(getStorePath('TEST_DIMENSIONS_FILE'), TestDimension).read()
 
     def load_knowledge_base(self):
         self.generate_llm_client.upload_files()
@@ -85,12 +120,52 @@ class TestScenarioAgent(PipelineStepAgent):
     def verify_content(self, output):
         return self.verify_llm_client.generate_content(input = output)
     
-    def execute(self, verify = False, tries = 1):
+    def render_prompt(self, task_template, **values):
+        self.generate_model_config.task = task_template.format(**values)
+        return self.generate_model_config.role + '\n' + self.generate_model_config.task
+
+    def largest_dimension(self):
+        #Position and values of the dimension with the most values, the one split when the prompt is over the token budget
+        position = max(range(len(self.dimensions)), key = lambda num: len(self.dimensions[num]['values']), default = None)
+        return position, (self.dimensions[position]['values'] if position is not None else [])
+
+    def with_values(self, position, values):
+        if position is None:
+            return self.dimensions
+        return [dict(dimension, values = values) if num == position else dimension for num, dimension in enumerate(self.dimensions)]
+
+    def merge_scenarios(self, results, next_id):
+        merged = mergeResults(results)
+        #The parts number their scenarios independently, so the merged list is numbered again from next_id, the number after
+        #the highest existing scenario. Combinations generated by more than one part are removed by the dedup
+        for num, scenario in enumerate(merged['output'], start = next_id):
+            scenario['scenario_id'] = f'SC-{num:03d}'
+        return merged
+
+    def record_sources(self, artifact_store, scenarios):
+        digests = knowledgeBaseDigests(self.generate_model_config.knowledge_base_path)
+        for scenario in scenarios:
+            artifact_store.recordSources('scenario', scenario['scenario_id'], resolveSources(scenario.get('traceability'), digests), scenario.get('traceability', ''))
+
+    def execute(self, verify = False, tries = 1, dedup = 'drop', gaps_only = False, scenario_ids = None):
+        self.configure_clients()
+        self.load_input_data()
+        artifact_store = ArtifactStore()
+        if scenario_ids:
+            return self.regenerate(artifact_store, scenario_ids)
+        existing_scenarios = []
+        if gaps_only:
+            #Only the dimension values and pairs that no scenario covers yet are generated and appended
+            existing_scenarios = artifact_store.readScenarios() or JsonlStore(getStorePath('TEST_SCENARIOS_FILE'), TestComboSet).read()
+            gaps = CoverageAnalyzer(self.dimensions, existing_scenarios).describeGaps()
+            if len(gaps) == 0:
+                print('All dimension values and pairs are already covered by the scenarios')
+                return
+            print(f'Generating scenarios for {len(gaps)} coverage gaps')
+
         if self.generate_model_config.provider == 'gemini':
             self.load_knowledge_base()
 
-        self.load_input_data()
-
         knowledge_files = os.listdir(self.generate_model_config.knowledge_base_path)
         gen_prompt = f'''I have uploaded the following documents. You required to carefully understand the requirements, processing rules, static data, masters that have already been uploaded. 
         Can you confirm if you have the following documents in your cache?
@@ -101,11 +176,22 @@ class TestScenarioAgent(PipelineStepAgent):
         
         scenarios_df = pd.DataFrame()
 
+        next_id = nextScenarioNumber(existing_scenarios)
         # for step_num in range(iterations):
         for i in range(tries):
-            self.generate_model_config.task = self.generate_model_config.task_template.format(dimensions = str(self.dimensions))
-            prompt = self.generate_model_config.role + '\n' + self.generate_model_config.task
-            generated_response = self.generate_content(prompt, self.generate_model_config.output_format)
+            #Prompts over the token budget are split. The gap list is halved till each part fits, and the combinations of the
+            #other dimensions are generated with each part of the values of the largest dimension
+            if gaps_only:
+                generated_response = self.generate_llm_client.generate_split(
+                    lambda part: self.render_prompt(self.gap_task_template, dimensions = json.dumps(self.dimensions), gaps = '\n'.join(part), next_id = next_id),
+                    gaps, self.generate_model_config.output_format, merge = lambda results: self.merge_scenarios(results, next_id))
+                #The numbering asked for in the prompt is not relied on, an id of an existing scenario would be overwritten
+                generated_response = self.merge_scenarios([generated_response], next_id)
+            else:
+                split_dimension, values = self.largest_dimension()
+                generated_response = self.generate_llm_client.generate_split(
+                    lambda part: self.render_prompt(self.generate_model_config.task_template, dimensions = json.dumps(self.with_values(split_dimension, part))),
+                    values, self.generate_model_config.output_format, merge = lambda results: self.merge_scenarios(results, next_id))
             response_df = pd.DataFrame(generated_response['output'])
             # print(f'Number of Scenarios generated in step {step_num+1} is {len(response_df)}')
             if verify:
@@ -119,5 +205,42 @@ class TestScenarioAgent(PipelineStepAgent):
         # if len(response_df) < 50: #Maximum of 50 combinations being generated at a time
         #     break
 
-        csv.writeDfToCsv(scenarios_df,os.getenv('TEST_SCENARIOS_FILE'))
+        #Scenarios with the same dimension values, whatever their wording, would otherwise go through every downstream stage
+        detector = NearDuplicateDetector('scenario_id', ['scenario_description'], key_function = lambda scenario: dimensionKey(scenario['scenario_dimension']))
+        for scenario in existing_scenarios:
+            detector.add(scenario)
+        scenarios, duplicates = detector.filter(scenarios_df.to_dict('records'), mode = dedup, stage = 'sen.dedup')
+        if duplicates:
+            print(f'Duplicate scenarios ({dedup}): {duplicates}')
+        #Each scenario costs generation and verification in cas and stp and per step in out
+        reportAvoidedWork('sen.dedup', len(scenarios_df) - len(scenarios), 4 + 2 * artifact_store.averageSteps())
+
+        scenarios_store = JsonlStore(getStorePath('TEST_SCENARIOS_FILE'), TestComboSet)
+        scenarios_store.write(scenarios, append = gaps_only)
+        scenarios_store.exportCsv(os.getenv('TEST_SCENARIOS_FILE'))
+        artifact_store.writeScenarios(scenarios_store.read(start = len(existing_scenarios) + 1), replace = not gaps_only)
+        self.record_sources(artifact_store, scenarios)
+        print(f'Scenario coverage: {CoverageAnalyzer(self.dimensions, scenarios_store.read()).report()}')
+        self.report_progress('scenarios', 'done', scenarios = len(scenarios), duplicates = len(duplicates))
         #print(generated_response)
+
+    def regenerate(self, artifact_store, scenario_ids):
+        '''
+        Regenerates only the given scenarios in place, e.g. after the requirement documents they trace to have changed
+        '''
+        if self.generate_model_config.provider == 'gemini':
+            self.load_knowledge_base()
+        scenarios = artifact_store.readScenarios(scenario_ids = scenario_ids)
+        #Batches over the token budget are regenerated in parts
+        generated_response = self.generate_llm_client.generate_split(
+            lambda part: self.render_prompt(self.regenerate_task_template, dimensions = json.dumps(self.dimensions), scenarios = json.dumps(part)),
+            scenarios, self.generate_model_config.output_format)
+        regenerated = [scenario for scenario in generated_response['output'] if str(scenario['scenario_id']) in set(map(str, scenario_ids))]
+        print(f'Regenerated {len(regenerated)} of {len(scenario_ids)} scenarios')
+
+        scenarios_store = JsonlStore(getStorePath('TEST_SCENARIOS_FILE'), TestComboSet)
+        scenarios_store.upsert(regenerated, 'scenario_id')
+        scenarios_store.exportCsv(os.getenv('TEST_SCENARIOS_FILE'))
+        artifact_store.upsertScenarios(regenerated)
+        self.record_sources(artifact_store, regenerated)
+        self.report_progress('scenarios', 'done', scenarios = len(regenerated))
@@ -3,9 +3,14 @@ from Helpers.KnowledgeBaseProvider import getKnowledgeBasePath
 from pydantic import BaseModel, Field
 import pandas as pd
 import os
-from Helpers.OutputManager import ExcelManager
-import time
+from Helpers.IntermediateStore import JsonlStore, getStorePath
+from Helpers.ArtifactStore import ArtifactStore
+from Agents.TestCasesAgent import TestCase
+from Helpers.VerificationPolicy import VerificationPolicy
 import sys
+import queue
+import threading
+from Helpers.Profiler import span
 
 class AllocationDetails(BaseModel):
   step: int = Field(description="This is the same step number as the test case step in which allocation data is generated")
@@ -107,7 +112,8 @@ class TestStepAgent(PipelineStepAgent):
                         task = '' ,
                         output_format = TestCaseSteps,
                         provider = 'gemini',
-                        model = 'gemini-2.5-pro' #'deepseek-r1:14b' #'qwen-coder:30b'#
+                        model = 'gemini-2.5-pro', #'deepseek-r1:14b' #'qwen-coder:30b'#
+                        cascade_models = ['gemini-2.5-flash']
                         )
     
     verify_model_config = ModelConfig(
@@ -137,16 +143,27 @@ class TestStepAgent(PipelineStepAgent):
                         )
 
     def __init__(self, test_module):
+        self.copy_model_configs()
         self.generate_model_config.test_module = test_module
         self.generate_model_config.knowledge_base_path = getKnowledgeBasePath(test_module)
         self.verify_model_config.test_module = test_module
         self.verify_model_config.knowledge_base_path = getKnowledgeBasePath(test_module)
-        self.excel_handler = ExcelManager(mode = 'new', filepath = os.getenv('TEST_DATA_FILE'))
-        self.generate_llm_client = LLMClient(self.generate_model_config.provider, self.generate_model_config.model, self.generate_model_config.knowledge_base_path, test_module, 'generator') #**self.generate_model_config.model_dump())
+        self.generate_llm_client = LLMClient(self.generate_model_config.provider, self.generate_model_config.model, self.generate_model_config.knowledge_base_path, test_module, 'generator',
+                                             cascade_models = self.generate_model_config.cascade_models, stage = 'stp.generator') #**self.generate_model_config.model_dump())
         self.verify_llm_client = LLMClient(self.verify_model_config.provider, self.verify_model_config.model, self.verify_model_config.knowledge_base_path, test_module, 'verifier') #**self.verify_model_config.model_dump())
+        self.artifact_store = ArtifactStore()
 
-    def load_input_data(self):
-        self.input_df = pd.read_csv(f"{os.getenv('TEST_CASES_FILE')}")
+    def load_input_data(self, start = 1, end = -1, test_case_ids = None):
+        if test_case_ids:
+            self.test_cases = self.artifact_store.readTestCases(test_case_ids = test_case_ids)
+        else:
+            self.test_cases = self.artifact_store.readTestCases(start, end)
+            if not self.test_cases:
+                #Test cases generated before the artifact store existed are added to it, the workbook is rendered from the store
+                self.test_cases = JsonlStore(getStorePath('TEST_CASES_FILE'), TestCase).read(start = start, end = end)
+                for scenario_id in dict.fromkeys(case['test_scenario_id'] for case in self.test_cases):
+                    self.artifact_store.writeTestCases(scenario_id, [case for case in self.test_cases if case['test_scenario_id'] == scenario_id],
+                                                       status = 'cases_generated')
 
     def load_generator_knowledge_base(self):
         self.generate_llm_client.upload_files()
@@ -154,20 +171,144 @@ class TestStepAgent(PipelineStepAgent):
     def load_verifier_knowledge_base(self):
         self.verify_llm_client.upload_files()
 
-    def generate_content(self, prompt, response_schema=None):
-        return self.generate_llm_client.generate_content(prompt, response_schema)
+    def generate_content(self, prompt, response_schema=None, check=None, tier=0, context=None):
+        return self.generate_llm_client.generate_content(prompt, response_schema, check = check, tier = tier, context = context)
+
+    def local_check(self, response):
+        #Steps should be present and numbered 1..n without gaps
+        steps = [step['step'] for step in response['output']]
+        return len(steps) > 0 and sorted(steps) == list(range(1, len(steps)+1))
+
+    def risk_flagged(self, response):
+        #Allocation sub steps, failing steps and reductions are where the generated steps usually go wrong
+        return any(len(step['allocation']) > 0 or step['pass_fail'] == 'FAIL' or step['addReduce'].lower().startswith('reduce')
+                   for step in response['output'])
     
     def verify_content(self, prompt, response_schema=None):
         return self.verify_llm_client.generate_content(prompt, response_schema)
     
-    def execute(self, start=1, end=-1, verify = True, tries = 2, cleanup = True):
+    def run_pipeline(self, verify_policy, tries, max_in_flight):
+        '''
+        Generation and verification run concurrently on threads of their own, so that the generator and the verifier work
+        on different test cases at the same time. A test case rejected by the verifier goes back to the generation queue with
+        its own feedback until it runs out of tries. At most max_in_flight test cases are in the queues at a time.
+        The results are written to the artifact store by this thread only. Returns the ids of the test cases written.
+        When the stage fails the workers stop before their next item and are joined, so that no LLM call of this run
+        is still using the clients when a warm agent runs its next job
+        '''
+        generation_queue, verification_queue, results = queue.Queue(), queue.Queue(), queue.Queue()
+        stop = threading.Event()
+        pending = iter(self.test_cases)
+        def admit():
+            input_data = next(pending, None)
+            if input_data is not None:
+                generation_queue.put({'input_data': input_data, 'attempt': 0, 'feedback': '', 'verify': None})
+        for _ in range(max_in_flight):
+            admit()
+        workers = [threading.Thread(target = self.generation_worker, args = (generation_queue, verification_queue, results, stop), daemon = True),
+                   threading.Thread(target = self.verification_worker, args = (verify_policy, tries, generation_queue, verification_queue, results, stop), daemon = True)]
+        for worker in workers:
+            worker.start()
+        written_test_case_ids, finished = [], 0
+        try:
+            while finished < len(self.test_cases):
+                #This thread waits on the workers, which mostly wait on the LLMs
+                with span('llm_wait'):
+                    status, item = results.get()
+                if status == 'error':
+                    raise item
+                input_data = item['input_data']
+                if status == 'verification':
+                    self.artifact_store.recordVerification('stp', input_data['test_case_id'], item['correctness'], item['correction'],
+                                                           scenario_id = str(input_data['test_scenario_id']), test_case_id = input_data['test_case_id'])
+                    continue
+                finished += 1
+                if status == 'done':
+                    generated_response = item['response']
+                    self.artifact_store.writeTestSteps(input_data['test_case_id'],
+                                                       [{key: value for key, value in step.items() if key != 'allocation'} for step in generated_response['output']],
+                                                       [allocation for step in generated_response['output'] for allocation in step['allocation']])
+                    written_test_case_ids.append(input_data['test_case_id'])
+                    self.report_progress(input_data['test_case_id'], 'done', steps = len(generated_response['output']), total = len(self.test_cases))
+                else:
+                    print(f"Unable to generate test steps correctly for {input_data['test_case_id']} because of {item['feedback']}")
+                    self.artifact_store.updateStatus(input_data['test_case_id'], 'steps_failed')
+                    self.report_progress(input_data['test_case_id'], 'failed', reason = item['feedback'], total = len(self.test_cases))
+                admit()
+        finally:
+            #Stops the workers after their current call, skipping the items still queued
+            stop.set()
+            generation_queue.put(None)
+            verification_queue.put(None)
+            for worker in workers:
+                worker.join()
+        return written_test_case_ids
+
+    def test_case_values(self, input_data):
+        return {'target_scenario': str(input_data["target_scenario"]), 'test_case_id': str(input_data["test_case_id"]),
+                'given': str(input_data["given"]) + '\n' + str(input_data["given_steps"]),
+                'when': str(input_data["when"]) + '\n' + str(input_data["when_steps"]),
+                'then': str(input_data["then"]), 'memberCode': str(input_data['memberCode'])}
+
+    def generation_worker(self, generation_queue, verification_queue, results, stop):
+        #Any failure is passed to the consumer, which would otherwise wait for the item forever
+        while (item := generation_queue.get()) is not None and not stop.is_set():
+            try:
+                input_data = item['input_data']
+                if 'context' not in item:
+                    item['context'] = self.retrieve_context(self.generate_model_config, ' '.join(str(input_data[field]) for field in
+                                                                                               ['target_scenario', 'given_steps', 'when_steps', 'memberCode']))
+                generation_prompt = self.item_prompt(self.generate_model_config, **self.test_case_values(input_data))
+                if item['feedback']:
+                    generation_prompt += f"\nVerifier feedback on your previous steps for this test case: {item['feedback']}"
+                item['response'] = self.generate_content(generation_prompt, self.generate_model_config.output_format, check = self.local_check,
+                                                         tier = item['attempt'], context = item['context'])
+                verification_queue.put(item)
+            except Exception as e:
+                results.put(('error', e))
+                return
+
+    def verification_worker(self, verify_policy, tries, generation_queue, verification_queue, results, stop):
+        #The verification policy is used by this thread only. Any failure is passed to the consumer as in generation_worker
+        while (item := verification_queue.get()) is not None and not stop.is_set():
+            try:
+                self.verify_item(item, verify_policy, tries, generation_queue, results)
+            except Exception as e:
+                results.put(('error', e))
+                return
+
+    def verify_item(self, item, verify_policy, tries, generation_queue, results):
+        input_data = item['input_data']
+        if item['verify'] is None:
+            item['verify'] = verify_policy.should_verify(input_data['test_case_id'], flagged = self.risk_flagged(item['response']))
+        if not item['verify']:
+            results.put(('done', item))
+            return
+        output_df_json = pd.DataFrame(item['response']['output']).to_json()
+        prompt = self.item_prompt(self.verify_model_config, **self.test_case_values(input_data), test_steps = str(output_df_json)) + f"\nVerifier feedback:{item['feedback']}"
+        verify_response = self.verify_content(prompt, self.verify_model_config.output_format)
+        verify_policy.record_outcome(input_data['test_case_id'], verify_response['correctness'])
+        results.put(('verification', {'input_data': input_data, **verify_response}))
+        if verify_response['correctness']:
+            print(verify_response)
+            results.put(('done', item))
+            return
+        item['feedback'], item['attempt'] = verify_response['correction'], item['attempt'] + 1
+        if item['attempt'] < tries:
+            generation_queue.put(item)
+        else:
+            results.put(('failed', item))
+
+    def execute(self, start=1, end=-1, verify = True, tries = 2, cleanup = True, test_case_ids = None, max_in_flight = 4):
+        self.configure_clients()
+        verify_policy = VerificationPolicy.resolve(verify, 'stp.verifier')
         if self.generate_model_config.provider == 'gemini':
             self.load_generator_knowledge_base()
 
-        if self.verify_model_config.provider == 'gemini':
+        if verify_policy.enabled and self.verify_model_config.provider == 'gemini':
             self.load_verifier_knowledge_base()
 
-        self.load_input_data()
+        self.load_input_data(start, end, test_case_ids)
         knowledge_files = os.listdir(self.generate_model_config.knowledge_base_path)
         gen_prompt = f'''I have uploaded the following documents. You required to carefully understand the requirements, processing rules, static data, masters that have already been uploaded. 
         Can you confirm if you have the following documents in your cache?
@@ -180,75 +321,17 @@ class TestStepAgent(PipelineStepAgent):
         Can you confirm if you have the following documents in your cache?
         {str(knowledge_files)}
         '''
-        turn1_response = self.verify_content(gen_prompt)
-        print(f'Verifier: {turn1_response}')
-
-        feedback = ''
-        for record_num in range(start-1, (len(self.input_df) if end < 0 else min(end, len(self.input_df)))):#len(self.input_df)):
-            input_data = self.input_df.iloc[record_num]
-            self.generate_model_config.task = self.generate_model_config.task_template.format(target_scenario = str(input_data["target_scenario"]),
-                                                                                              test_case_id = str(input_data["test_case_id"]), 
-                                                                                              given = str(input_data["given"]) + '\n' + str(input_data["given_steps"]),
-                                                                                              when = str(input_data["when"]) + '\n' + str(input_data["when_steps"]),
-                                                                                              then = str(input_data["then"]),
-                                                                                              memberCode = str(input_data['memberCode'])
-                                                                                             )
-            for i in range(tries):
-                prompt = self.generate_model_config.role + '\n' + self.generate_model_config.task
-                generated_response = self.generate_content(prompt, self.generate_model_config.output_format)
-                output_df = pd.DataFrame(generated_response['output'])
-                output_df_json = output_df.to_json()
-                if verify:
-                    time.sleep(2)
-                    self.verify_model_config.task = self.verify_model_config.task_template.format(target_scenario = str(input_data["target_scenario"]),
-                                                                                              test_case_id = str(input_data["test_case_id"]), 
-                                                                                              given = str(input_data["given"]) + '\n' + str(input_data["given_steps"]),
-                                                                                              when = str(input_data["when"]) + '\n' + str(input_data["when_steps"]),
-                                                                                              then = str(input_data["then"]),
-                                                                                              memberCode = str(input_data['memberCode']),
-                                                                                              test_steps = str(output_df_json))
-                    prompt = self.verify_model_config.role + '\n' + self.verify_model_config.task + f'\nVerifier feedback:{feedback}' #if feedback != '' else ''
-                    verify_response = self.verify_content(prompt, self.verify_model_config.output_format)
-
-                    if verify_response['correctness']:
-                        print(verify_response)
-                        break
-                    else:
-                        feedback = verify_response['correction']
-                else:
-                    break
-
-            if not verify or verify_response['correctness']:
-                self.excel_handler.createWorksheet(sheetName=input_data['test_case_id'])
-                objectToWrite = {'Test Case ID': (1,1),
-                                 str(input_data['test_case_id']): (1,2),
-                                 'Test Case description': (2,1),
-                                 str(input_data['target_scenario']): (2,2)
-                                 }
-                self.excel_handler.writeTextToSheet(input_data['test_case_id'],objectToWrite)
-                #Identify columns that have lists as its value. They will be written out separately on Excel
-                list_cols = [
-                            c for c in output_df.columns
-                            if output_df[c].apply(lambda x: isinstance(x, list)).any()
-                    ]
-                # print(f'Writing Test Steps to File for {record_num+1}')
-                curr_row = self.excel_handler.writeDfToSheet(sheetName = input_data['test_case_id'], dfToWrite=output_df.drop(columns=list_cols),
-                                                startRow=4, startMarker="##Test Steps - Start", endMarker="##Test Steps - End")
-                print(f'Written Test Steps to File for {record_num+1}')
-                #Writing Sub steps in a separate set of rows. E.g. Allocation Steps
-                # print(f'Writing Allocation Steps to File for {record_num+1}')
-                for col in list_cols:
-                    filtered_series = output_df.loc[output_df[col].str.len() > 0, col]
-                    print(filtered_series)
-                    sub_df = pd.DataFrame(filtered_series.explode().to_list())
-                    # print(sub_df)
-                    curr_row = self.excel_handler.writeDfToSheet(sheetName = input_data['test_case_id'], dfToWrite=sub_df,
-                                                startRow=curr_row+1, startMarker=f"##{col} Steps - Start", endMarker=f"##{col} Steps - End")
-                print(f'Written Allocation Steps to File for {record_num+1}')        
-                self.excel_handler.save_wb()
-            else:
-                print(f"Unable to generate test steps correctly for {input_data['test_case_id']} because of {feedback}")
-        
+        if verify_policy.enabled:
+            turn1_response = self.verify_content(gen_prompt)
+            print(f'Verifier: {turn1_response}')
+
+        written_test_case_ids = self.run_pipeline(verify_policy, tries, max_in_flight)
+
+        #The workbook is rendered once at the end. A run for given test cases keeps the sheets of the other test cases
+        if written_test_case_ids:
+            sheets = self.artifact_store.renderTestDataWorkbook(os.getenv('TEST_DATA_FILE'), None if test_case_ids else written_test_case_ids)
+            print(f"Written Test Steps of {sheets} test cases to {os.getenv('TEST_DATA_FILE')}")
+
         #Clean up uploaded files and delete cache
         if cleanup:
             self.generate_llm_client.cleanup_files()
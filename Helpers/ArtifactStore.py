@@ -0,0 +1,384 @@
+import os
+import json
+import sqlite3
+from contextlib import contextmanager, closing
+from Helpers.Profiler import span
+from datetime import datetime
+import pandas as pd
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dimensions (
+    dim_id TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    dimension TEXT,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS scenarios (
+    scenario_id TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_scenarios_seq ON scenarios(seq);
+CREATE TABLE IF NOT EXISTS test_cases (
+    test_case_id TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    test_scenario_id TEXT,
+    status TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_test_cases_seq ON test_cases(seq);
+CREATE INDEX IF NOT EXISTS idx_test_cases_scenario ON test_cases(test_scenario_id);
+CREATE INDEX IF NOT EXISTS idx_test_cases_status ON test_cases(status);
+CREATE TABLE IF NOT EXISTS test_steps (
+    test_case_id TEXT NOT NULL,
+    step INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (test_case_id, step)
+);
+CREATE TABLE IF NOT EXISTS allocation_steps (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    test_case_id TEXT NOT NULL,
+    step INTEGER,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_allocation_steps_test_case ON allocation_steps(test_case_id);
+CREATE TABLE IF NOT EXISTS expected_outputs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    test_case_id TEXT NOT NULL,
+    step INTEGER,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_expected_outputs_test_case ON expected_outputs(test_case_id);
+CREATE TABLE IF NOT EXISTS verification_results (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    stage TEXT NOT NULL,
+    item_id TEXT NOT NULL,
+    scenario_id TEXT,
+    test_case_id TEXT,
+    accepted INTEGER NOT NULL,
+    correction TEXT,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_verification_scenario ON verification_results(scenario_id, accepted);
+CREATE INDEX IF NOT EXISTS idx_verification_test_case ON verification_results(test_case_id, accepted);
+CREATE INDEX IF NOT EXISTS idx_verification_stage ON verification_results(stage, accepted);
+CREATE INDEX IF NOT EXISTS idx_verification_item ON verification_results(stage, item_id, id);
+CREATE TABLE IF NOT EXISTS artifact_sources (
+    artifact_type TEXT NOT NULL,
+    artifact_id TEXT NOT NULL,
+    knowledge_file TEXT NOT NULL,
+    file_digest TEXT NOT NULL,
+    requirement_refs TEXT,
+    PRIMARY KEY (artifact_type, artifact_id, knowledge_file)
+);
+CREATE INDEX IF NOT EXISTS idx_artifact_sources_file ON artifact_sources(knowledge_file, file_digest);
+'''
+
+TEST_STEPS_START, TEST_STEPS_END = '##Test Steps - Start', '##Test Steps - End'
+ALLOCATION_STEPS_START, ALLOCATION_STEPS_END = '##allocation Steps - Start', '##allocation Steps - End'
+EXPECTED_OUTPUT_START, EXPECTED_OUTPUT_END = '##Expected Output - Start', '##Expected Output - End'
+
+
+def getArtifactStorePath():
+    return os.getenv('ARTIFACT_DB', os.path.join(os.path.dirname(os.getenv('TEST_CASES_FILE', '')), 'artifacts.db'))
+
+
+class ArtifactStore:
+    '''
+    Embedded SQLite store for the artifacts of every stage. It sits beside the csv / Excel outputs, gives indexed access
+    by scenario, test case and status and the csv / Excel files can be rendered from it on demand.
+    Every write is done in a single transaction so a stage either records a whole item or nothing.
+    '''
+    def __init__(self, filepath = None):
+        self.filepath = filepath if filepath else getArtifactStorePath()
+        with self.transaction() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def transaction(self):
+        with span('io'), closing(sqlite3.connect(self.filepath, timeout = 30)) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            with conn:
+                yield conn
+
+    def count(self, table, where = None):
+        where = where if where else {}
+        clause = ' AND '.join(f'{key} = ?' for key in where)
+        with self.transaction() as conn:
+            return conn.execute(f'SELECT COUNT(*) FROM {table}' + (f' WHERE {clause}' if clause else ''), list(where.values())).fetchone()[0]
+
+#---------------------------------------Dimensions and Scenarios-------------------------
+    def writeDimensions(self, dimensions):
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM dimensions')
+            conn.executemany('INSERT INTO dimensions (dim_id, seq, dimension, data) VALUES (?, ?, ?, ?)',
+                             [(dim['dim_id'], seq, dim['dimension'], json.dumps(dim)) for seq, dim in enumerate(dimensions, start=1)])
+
+    def readDimensions(self):
+        with self.transaction() as conn:
+            return [json.loads(row[0]) for row in conn.execute('SELECT data FROM dimensions ORDER BY seq')]
+
+    def upsertScenarios(self, scenarios):
+        '''
+        Updates the given scenarios in place keeping their position, new scenarios are added at the end
+        '''
+        with self.transaction() as conn:
+            next_seq = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM scenarios').fetchone()[0] + 1
+            conn.executemany('''INSERT INTO scenarios (scenario_id, seq, data) VALUES (?, ?, ?)
+                                ON CONFLICT(scenario_id) DO UPDATE SET data = excluded.data''',
+                             [(scenario['scenario_id'], seq, json.dumps(scenario)) for seq, scenario in enumerate(scenarios, start=next_seq)])
+
+    def writeScenarios(self, scenarios, replace = True):
+        '''
+        Replaces all the scenarios or, with replace False, appends them. Appending a scenario_id that exists raises
+        '''
+        with self.transaction() as conn:
+            if replace:
+                conn.execute('DELETE FROM scenarios')
+            next_seq = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM scenarios').fetchone()[0] + 1
+            conn.executemany('INSERT INTO scenarios (scenario_id, seq, data) VALUES (?, ?, ?)',
+                             [(scenario['scenario_id'], seq, json.dumps(scenario)) for seq, scenario in enumerate(scenarios, start=next_seq)])
+
+    def readScenarios(self, start = 1, end = -1, scenario_ids = None):
+        '''
+        start and end are 1-based and inclusive positions like the ranges given on the command line
+        '''
+        return self._readRange('scenarios', 'scenario_id', start, end, scenario_ids)
+
+#---------------------------------------Test Cases-------------------------
+    def writeTestCases(self, scenario_id, test_cases, status):
+        '''
+        Replaces the test cases of the scenario with the newly generated ones. They take the place of the replaced test
+        cases so that the positions of the other test cases (the ranges of stp and of shards) do not move.
+        Test cases of a scenario that had none are added at the end
+        '''
+        with self.transaction() as conn:
+            first_seq, last_seq = conn.execute('SELECT MIN(seq), MAX(seq) FROM test_cases WHERE test_scenario_id = ?', (str(scenario_id),)).fetchone()
+            conn.execute('DELETE FROM test_cases WHERE test_scenario_id = ?', (str(scenario_id),))
+            if first_seq is None:
+                next_seq = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM test_cases').fetchone()[0] + 1
+            else:
+                next_seq = first_seq
+                #More test cases than before push the following ones back
+                shift = len(test_cases) - (last_seq - first_seq + 1)
+                if shift > 0:
+                    conn.execute('UPDATE test_cases SET seq = seq + ? WHERE seq > ?', (shift, last_seq))
+            conn.executemany('INSERT OR REPLACE INTO test_cases (test_case_id, seq, test_scenario_id, status, data) VALUES (?, ?, ?, ?, ?)',
+                             [(case['test_case_id'], seq, str(scenario_id), status, json.dumps(case))
+                              for seq, case in enumerate(test_cases, start=next_seq)])
+
+    def readTestCases(self, start = 1, end = -1, test_case_ids = None, status = None, scenario_ids = None):
+        if scenario_ids is not None:
+            return self._readRange('test_cases', 'test_scenario_id', start, end, scenario_ids, status)
+        return self._readRange('test_cases', 'test_case_id', start, end, test_case_ids, status)
+
+    def getTestCase(self, test_case_id):
+        cases = self.readTestCases(test_case_ids = [test_case_id])
+        return cases[0] if cases else None
+
+    def scenarioIdsWithTestCases(self):
+        with self.transaction() as conn:
+            return [row[0] for row in conn.execute('SELECT DISTINCT test_scenario_id FROM test_cases')]
+
+    def updateStatus(self, test_case_id, status):
+        with self.transaction() as conn:
+            conn.execute('UPDATE test_cases SET status = ? WHERE test_case_id = ?', (status, str(test_case_id)))
+
+    def _readRange(self, table, key, start = 1, end = -1, ids = None, status = None):
+        query, params = f'SELECT data FROM {table}', []
+        conditions = []
+        if ids is not None:
+            conditions.append(f'{key} IN ({",".join("?" * len(ids))})')
+            params += [str(item_id) for item_id in ids]
+        if status:
+            conditions.append('status = ?')
+            params.append(status)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY seq LIMIT ? OFFSET ?'
+        params += [end - start + 1 if end > 0 else -1, start - 1]
+        with self.transaction() as conn:
+            return [json.loads(row[0]) for row in conn.execute(query, params)]
+
+#---------------------------------------Test Steps and Expected Output-------------------------
+    def writeTestSteps(self, test_case_id, steps, allocation_steps, status = 'steps_generated'):
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM test_steps WHERE test_case_id = ?', (str(test_case_id),))
+            conn.execute('DELETE FROM allocation_steps WHERE test_case_id = ?', (str(test_case_id),))
+            #Expected output of the earlier steps is no longer valid
+            conn.execute('DELETE FROM expected_outputs WHERE test_case_id = ?', (str(test_case_id),))
+            conn.executemany('INSERT INTO test_steps (test_case_id, step, data) VALUES (?, ?, ?)',
+                             [(str(test_case_id), int(step['step']), json.dumps(step, default=str)) for step in steps])
+            conn.executemany('INSERT INTO allocation_steps (test_case_id, step, data) VALUES (?, ?, ?)',
+                             [(str(test_case_id), allocation.get('step'), json.dumps(allocation, default=str)) for allocation in allocation_steps])
+            conn.execute('UPDATE test_cases SET status = ? WHERE test_case_id = ?', (status, str(test_case_id)))
+
+    def deleteTestCases(self, test_case_ids):
+        '''
+        Deletes test cases that no longer exist (e.g. after their scenario was regenerated) with their steps, expected output and sources
+        '''
+        test_case_ids = [str(test_case_id) for test_case_id in test_case_ids]
+        placeholders = ','.join('?' * len(test_case_ids))
+        with self.transaction() as conn:
+            for table in ['test_cases', 'test_steps', 'allocation_steps', 'expected_outputs']:
+                conn.execute(f'DELETE FROM {table} WHERE test_case_id IN ({placeholders})', test_case_ids)
+            conn.execute(f"DELETE FROM artifact_sources WHERE artifact_type = 'test_case' AND artifact_id IN ({placeholders})", test_case_ids)
+
+    def readTestSteps(self, test_case_id):
+        '''
+        Returns the test steps and allocation steps of the test case as dataframes in the same shape as the Excel blocks
+        '''
+        with self.transaction() as conn:
+            steps = [json.loads(row[0]) for row in conn.execute('SELECT data FROM test_steps WHERE test_case_id = ? ORDER BY step', (str(test_case_id),))]
+            allocations = [json.loads(row[0]) for row in conn.execute('SELECT data FROM allocation_steps WHERE test_case_id = ? ORDER BY id', (str(test_case_id),))]
+        return pd.DataFrame(steps), pd.DataFrame(allocations)
+
+    def averageSteps(self, default = 5):
+        with self.transaction() as conn:
+            steps, cases = conn.execute('SELECT COUNT(*), COUNT(DISTINCT test_case_id) FROM test_steps').fetchone()
+        return steps / cases if cases else default
+
+    def writeExpectedOutput(self, test_case_id, output_lines, status = 'output_generated'):
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM expected_outputs WHERE test_case_id = ?', (str(test_case_id),))
+            conn.executemany('INSERT INTO expected_outputs (test_case_id, step, data) VALUES (?, ?, ?)',
+                             [(str(test_case_id), line.get('step'), json.dumps(line, default=str)) for line in output_lines])
+            conn.execute('UPDATE test_cases SET status = ? WHERE test_case_id = ?', (status, str(test_case_id)))
+
+    def readExpectedOutput(self, test_case_id):
+        with self.transaction() as conn:
+            return pd.DataFrame([json.loads(row[0]) for row in conn.execute('SELECT data FROM expected_outputs WHERE test_case_id = ? ORDER BY id', (str(test_case_id),))])
+
+#---------------------------------------Traceability-------------------------
+    def recordSources(self, artifact_type, artifact_id, sources, requirement_refs = ''):
+        '''
+        sources is {knowledge_file: digest} of the knowledge files the artifact was derived from
+        '''
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM artifact_sources WHERE artifact_type = ? AND artifact_id = ?', (artifact_type, str(artifact_id)))
+            conn.executemany('INSERT INTO artifact_sources (artifact_type, artifact_id, knowledge_file, file_digest, requirement_refs) VALUES (?, ?, ?, ?, ?)',
+                             [(artifact_type, str(artifact_id), file_name, digest, requirement_refs) for file_name, digest in sources.items()])
+
+    def changedSources(self, digests):
+        '''
+        Returns (artifact_type, artifact_id) of the artifacts whose knowledge files have a different digest now or no longer exist
+        '''
+        with self.transaction() as conn:
+            rows = conn.execute('SELECT DISTINCT artifact_type, artifact_id, knowledge_file, file_digest FROM artifact_sources').fetchall()
+        return sorted({(artifact_type, artifact_id) for artifact_type, artifact_id, file_name, digest in rows if digests.get(file_name) != digest})
+
+    def changedFiles(self, digests):
+        with self.transaction() as conn:
+            rows = conn.execute('SELECT DISTINCT knowledge_file, file_digest FROM artifact_sources').fetchall()
+        return sorted({file_name for file_name, digest in rows if digests.get(file_name) != digest})
+
+#---------------------------------------Verification results-------------------------
+    def recordVerification(self, stage, item_id, accepted, correction = '', scenario_id = None, test_case_id = None):
+        with self.transaction() as conn:
+            conn.execute('''INSERT INTO verification_results (stage, item_id, scenario_id, test_case_id, accepted, correction, created_at)
+                            VALUES (?, ?, ?, ?, ?, ?, ?)''', (stage, str(item_id), scenario_id, test_case_id, int(bool(accepted)), correction, datetime.now().isoformat()))
+
+    def failedVerifications(self, scenario_id = None, test_case_id = None, stage = None):
+        '''
+        Items whose last verification in a stage was rejected. Items accepted on a later retry are left out
+        '''
+        query, params = '''SELECT stage, item_id, scenario_id, test_case_id, correction, created_at FROM verification_results AS result
+                           WHERE accepted = 0 AND NOT EXISTS (SELECT 1 FROM verification_results AS later
+                           WHERE later.stage = result.stage AND later.item_id = result.item_id AND later.id > result.id)''', []
+        for column, value in [('scenario_id', scenario_id), ('test_case_id', test_case_id), ('stage', stage)]:
+            if value:
+                query += f' AND result.{column} = ?'
+                params.append(value)
+        with self.transaction() as conn:
+            return pd.read_sql_query(query + ' ORDER BY id', conn, params = params)
+
+#---------------------------------------Shards-------------------------
+    def snapshot(self, filepath):
+        '''
+        Copies the store for a shard worker, which reads its inputs from the copy and writes its outputs to it.
+        Verification results are cleared so that the copy holds only those of the shard
+        '''
+        if os.path.isfile(filepath):
+            os.remove(filepath)
+        with closing(sqlite3.connect(self.filepath, timeout = 30)) as source, closing(sqlite3.connect(filepath)) as target:
+            source.backup(target)
+        shard_store = ArtifactStore(filepath)
+        with shard_store.transaction() as conn:
+            conn.execute('DELETE FROM verification_results')
+        return shard_store
+
+    def mergeShard(self, shard_store, stage, start, end):
+        '''
+        Copies the output of a cas shard (test cases of the scenarios start..end) or a stp shard (steps of the test cases start..end)
+        into this store. Returns the ids of the merged scenarios or test cases
+        '''
+        if stage == 'cas':
+            scenario_ids = [str(scenario['scenario_id']) for scenario in shard_store.readScenarios(start, end)]
+            with shard_store.transaction() as conn:
+                rows = conn.execute(f'''SELECT test_scenario_id, status, data FROM test_cases WHERE test_scenario_id IN ({",".join("?" * len(scenario_ids))})
+                                        ORDER BY seq''', scenario_ids).fetchall()
+            for scenario_id in scenario_ids:
+                cases = [(status, json.loads(data)) for case_scenario_id, status, data in rows if case_scenario_id == scenario_id]
+                if cases:
+                    self.writeTestCases(scenario_id, [case for _, case in cases], cases[0][0])
+                    self._copySources(shard_store, 'test_case', [case['test_case_id'] for _, case in cases])
+            merged = scenario_ids
+        elif stage == 'stp':
+            merged = []
+            for case in shard_store.readTestCases(start, end):
+                steps_df, allocation_df = shard_store.readTestSteps(case['test_case_id'])
+                if steps_df.empty:
+                    if shard_store.count('test_cases', {'test_case_id': case['test_case_id'], 'status': 'steps_failed'}):
+                        self.updateStatus(case['test_case_id'], 'steps_failed')
+                    continue
+                self.writeTestSteps(case['test_case_id'], steps_df.to_dict('records'), allocation_df.to_dict('records'))
+                merged.append(case['test_case_id'])
+        else:
+            raise Exception(f'{stage} cannot be sharded. Only cas and stp can')
+        with shard_store.transaction() as conn:
+            verifications = conn.execute('SELECT stage, item_id, scenario_id, test_case_id, accepted, correction, created_at FROM verification_results ORDER BY id').fetchall()
+        with self.transaction() as conn:
+            conn.executemany('''INSERT INTO verification_results (stage, item_id, scenario_id, test_case_id, accepted, correction, created_at)
+                                VALUES (?, ?, ?, ?, ?, ?, ?)''', verifications)
+        return merged
+
+    def _copySources(self, shard_store, artifact_type, artifact_ids):
+        with shard_store.transaction() as conn:
+            rows = conn.execute(f'''SELECT artifact_id, knowledge_file, file_digest, requirement_refs FROM artifact_sources
+                                    WHERE artifact_type = ? AND artifact_id IN ({",".join("?" * len(artifact_ids))})''',
+                                [artifact_type] + [str(artifact_id) for artifact_id in artifact_ids]).fetchall()
+        for artifact_id in artifact_ids:
+            sources = [row for row in rows if row[0] == str(artifact_id)]
+            if sources:
+                self.recordSources(artifact_type, artifact_id, {row[1]: row[2] for row in sources}, sources[0][3])
+
+#---------------------------------------Rendering-------------------------
+    def renderTestCasesCsv(self, filepath):
+        df = pd.DataFrame(self.readTestCases())
+        df.to_csv(filepath, index=False)
+
+    def renderTestDataWorkbook(self, filepath, test_case_ids = None):
+        '''
+        Writes one sheet per test case with steps in a single constant memory pass. Returns the number of sheets written
+        '''
+        from Helpers.OutputManager import XlsxRenderer
+        renderer, sheets = XlsxRenderer(filepath), 0
+        try:
+            for case in self.readTestCases(test_case_ids = test_case_ids):
+                steps_df, allocation_df = self.readTestSteps(case['test_case_id'])
+                if steps_df.empty:
+                    continue
+                sheetName = case['test_case_id']
+                blocks = [(steps_df, TEST_STEPS_START, TEST_STEPS_END)]
+                if not allocation_df.empty:
+                    blocks.append((allocation_df, ALLOCATION_STEPS_START, ALLOCATION_STEPS_END))
+                output_df = self.readExpectedOutput(sheetName)
+                if not output_df.empty:
+                    blocks.append((output_df, EXPECTED_OUTPUT_START, EXPECTED_OUTPUT_END))
+                renderer.writeSheet(sheetName, {'Test Case ID': (1,1), str(sheetName): (1,2),
+                                                'Test Case description': (2,1), str(case['target_scenario']): (2,2)}, blocks)
+                sheets += 1
+        finally:
+            renderer.close()
+        return sheets
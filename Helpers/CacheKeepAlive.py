@@ -0,0 +1,71 @@
+import time
+import threading
+from Helpers.MetricsRecorder import getMetrics
+
+
+class CacheKeepAlive:
+    '''
+    Background thread that extends the TTL of the context caches used by this process while a run is active.
+    Each cache is refreshed once per interval however many connectors hold it. A cache that has not been used
+    for idle_seconds (e.g. a warm service worker without jobs) is no longer refreshed and is left to expire
+    '''
+    def __init__(self, interval_seconds, idle_seconds):
+        self.interval_seconds, self.idle_seconds = interval_seconds, idle_seconds
+        #key -> {'refresh': callable, 'holders': set, 'last_used': time}
+        self.caches = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def track(self, key, holder, refresh):
+        '''
+        refresh extends the TTL of the cache and returns False when the cache is gone. The latest holder's refresh is used
+        '''
+        with self.lock:
+            cache = self.caches.setdefault(key, {'holders': set(), 'last_used': time.time()})
+            cache['refresh'] = refresh
+            cache['holders'].add(holder)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target = self._run, daemon = True)
+                self.thread.start()
+
+    def untrack(self, key, holder):
+        with self.lock:
+            cache = self.caches.get(key)
+            if cache:
+                cache['holders'].discard(holder)
+                if not cache['holders']:
+                    self.caches.pop(key)
+
+    def touch(self, key, holder = None):
+        '''
+        Marks the cache as used. Returns False when the holder does not have the cache tracked
+        '''
+        with self.lock:
+            if key not in self.caches:
+                return False
+            self.caches[key]['last_used'] = time.time()
+            return holder is None or holder in self.caches[key]['holders']
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval_seconds)
+            with self.lock:
+                due = [(key, cache['refresh']) for key, cache in self.caches.items() if time.time() - cache['last_used'] < self.idle_seconds]
+            for key, refresh in due:
+                try:
+                    if refresh():
+                        getMetrics().increment('cache', 'keep_alive_refreshes')
+                        continue
+                    print(f'Context cache {key} is gone and will be rebuilt on its next use')
+                except Exception as e:
+                    print(f'Keep alive of context cache {key} failed: {type(e).__name__}: {e}')
+                getMetrics().increment('cache', 'keep_alive_failures')
+
+
+_keep_alive = None
+
+def getKeepAlive(interval_seconds, idle_seconds):
+    global _keep_alive
+    if _keep_alive is None:
+        _keep_alive = CacheKeepAlive(interval_seconds, idle_seconds)
+    return _keep_alive
@@ -0,0 +1,163 @@
+import os
+import json
+import time
+import socket
+import hashlib
+from contextlib import contextmanager
+from Helpers.Traceability import knowledgeBaseDigests
+
+
+def cacheKey(test_module, model, role, knowledge_base_path, instructions = ''):
+    '''
+    A context cache can be shared only for the same module, model, role, knowledge base contents and system instructions
+    '''
+    digests = knowledgeBaseDigests(knowledge_base_path) if knowledge_base_path and os.path.isdir(knowledge_base_path) else {}
+    kb_digest = hashlib.sha256(json.dumps(digests, sort_keys=True).encode()).hexdigest()[:16]
+    key = f'{test_module}|{model}|{role}|{kb_digest}'
+    if instructions:
+        key += '|' + hashlib.sha256(instructions.encode()).hexdigest()[:16]
+    return key
+
+
+def holderId(owner):
+    return f'{socket.gethostname()}:{os.getpid()}:{id(owner)}'
+
+
+def _holderAlive(holder):
+    #Holders of dead processes on this host are dropped. Holders on other hosts are kept till the cache expires
+    hostname, pid, _ = holder.rsplit(':', 2)
+    if hostname != socket.gethostname() or os.name != 'posix':
+        return True
+    try:
+        os.kill(int(pid), 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+class CacheRegistry:
+    '''
+    Registry of the live context caches shared by the processes on this machine. Every change is made under a lock file.
+    Each entry records the cache name, uploaded files, expiry and the holders (connectors using the cache).
+    A cache is deleted only when its last holder releases it or when it has expired.
+    '''
+    def __init__(self, filepath = None, lock_timeout = 60, creation_timeout = 300):
+        self.filepath = filepath if filepath else os.getenv('CACHE_REGISTRY', os.path.join('llm_cache', 'registry.json'))
+        self.lock_path = self.filepath + '.lock'
+        self.lock_timeout, self.creation_timeout = lock_timeout, creation_timeout
+
+    @contextmanager
+    def _locked(self):
+        os.makedirs(os.path.dirname(self.filepath) or '.', exist_ok=True)
+        while True:
+            try:
+                lock = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                #A lock left behind by a crashed process is broken after lock_timeout
+                try:
+                    if time.time() - os.path.getmtime(self.lock_path) > self.lock_timeout:
+                        os.remove(self.lock_path)
+                except FileNotFoundError:
+                    pass
+                time.sleep(0.05)
+        try:
+            entries = self._read()
+            yield entries
+            self._write(entries)
+        finally:
+            os.close(lock)
+            os.remove(self.lock_path)
+
+    def _read(self):
+        if not os.path.isfile(self.filepath):
+            return {}
+        with open(self.filepath, 'r') as f:
+            return json.load(f)
+
+    def _write(self, entries):
+        temp_path = self.filepath + f'.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(entries, f, indent=2)
+        os.replace(temp_path, self.filepath)
+
+    def _prune(self, entry):
+        entry['holders'] = {holder: acquired_at for holder, acquired_at in entry.get('holders', {}).items() if _holderAlive(holder)}
+
+    def acquire(self, key, holder):
+        '''
+        Returns ('live', entry) with the holder added when a live cache exists, ('create', stale entry or None) when
+        the caller has to create the cache, or ('wait', None) while another process is creating it
+        '''
+        with self._locked() as entries:
+            entry = entries.get(key)
+            if entry and entry.get('cache_name') and entry['expires_at'] > time.time():
+                self._prune(entry)
+                entry['holders'][holder] = time.time()
+                return 'live', dict(entry)
+            if entry and entry.get('creating') and _holderAlive(entry['creating']) and \
+                    time.time() - entry['creating_since'] < self.creation_timeout:
+                return 'wait', None
+            stale = entry if entry and entry.get('cache_name') else None
+            entries[key] = {'creating': holder, 'creating_since': time.time(), 'holders': {}, 'expires_at': 0}
+            return 'create', stale
+
+    def register(self, key, holder, cache_name, files, ttl_seconds):
+        with self._locked() as entries:
+            entries[key] = {'cache_name': cache_name, 'files': files, 'created_at': time.time(),
+                            'expires_at': time.time() + ttl_seconds, 'holders': {holder: time.time()}}
+            return dict(entries[key])
+
+    def abandon(self, key, holder):
+        #Creation failed and other processes may try again
+        with self._locked() as entries:
+            if entries.get(key, {}).get('creating') == holder:
+                entries.pop(key)
+
+    def extend(self, key, ttl_seconds):
+        with self._locked() as entries:
+            if key in entries:
+                entries[key]['expires_at'] = time.time() + ttl_seconds
+
+    def expire(self, key, cache_name):
+        '''
+        Marks the cache as expired when it is gone on the server, so that the next acquire recreates it and deletes the stale one
+        '''
+        with self._locked() as entries:
+            if entries.get(key, {}).get('cache_name') == cache_name:
+                entries[key]['expires_at'] = 0
+
+    def get(self, key):
+        return self._read().get(key)
+
+    def release(self, key, holder):
+        '''
+        Removes the holder. Returns the entry when it is no longer referenced so that the caller deletes the cache, else None
+        '''
+        with self._locked() as entries:
+            entry = entries.get(key)
+            if not entry or not entry.get('cache_name'):
+                return None
+            entry.get('holders', {}).pop(holder, None)
+            self._prune(entry)
+            if entry['holders'] and entry['expires_at'] > time.time():
+                print(f"Cache {entry['cache_name']} is still used by {len(entry['holders'])} holders")
+                return None
+            return entries.pop(key)
+
+    def purge(self, role = None):
+        '''
+        Removes the entries (of a role) that are expired or no longer referenced and returns them for deletion
+        '''
+        purged = []
+        with self._locked() as entries:
+            for key in list(entries):
+                entry = entries[key]
+                if not entry.get('cache_name') or (role and key.split('|')[2] != role):
+                    continue
+                self._prune(entry)
+                if not entry['holders'] or entry['expires_at'] <= time.time():
+                    purged.append(entries.pop(key))
+        return purged
@@ -0,0 +1,89 @@
+import numpy as np
+from Helpers.Deduplicator import normalizeText
+
+
+class CoverageAnalyzer:
+    '''
+    Builds a dimension value x scenario incidence matrix from the dimensions and scenarios and computes
+    single value and pairwise coverage with matrix operations. A scenario mask (e.g. the scenarios that already
+    have test cases) restricts the coverage to a subset of the scenarios.
+    Values of Independent dimensions are not combined with other dimensions and are left out of pairwise coverage.
+    '''
+    def __init__(self, dimensions, scenarios):
+        self.values, lookup = [], {}
+        for dimension in dimensions:
+            for value in dimension['values']:
+                row = len(self.values)
+                self.values.append({'dim_id': dimension['dim_id'], 'dimension': dimension['dimension'], 'value': value['dim_value'],
+                                    'dim_type': dimension.get('dim_type', '')})
+                for dim_key in [dimension['dim_id'], dimension['dimension']]:
+                    for value_key in [value['dim_val_id'], value['dim_value']]:
+                        lookup[(normalizeText(dim_key), normalizeText(value_key))] = row
+        self.scenario_ids = [str(scenario['scenario_id']) for scenario in scenarios]
+        self.matrix = np.zeros((len(self.values), len(scenarios)), dtype=bool)
+        for col, scenario in enumerate(scenarios):
+            for item in scenario['scenario_dimension']:
+                row = lookup.get((normalizeText(item['dimension']), normalizeText(item['value'])))
+                if row is not None:
+                    self.matrix[row, col] = True
+        dim_ids = np.array([value['dim_id'] for value in self.values])
+        combinable = np.array([normalizeText(value['dim_type']) != 'independent' for value in self.values], dtype=bool)
+        #Only pairs of values from two different combinable dimensions are counted, each pair once
+        self.pair_mask = np.triu((dim_ids[:, None] != dim_ids[None, :]) & combinable[:, None] & combinable[None, :], k=1)
+
+    def scenarioMask(self, scenario_ids):
+        scenario_ids = {str(scenario_id) for scenario_id in scenario_ids}
+        return np.array([scenario_id in scenario_ids for scenario_id in self.scenario_ids], dtype=bool)
+
+    def valueCoverage(self, scenario_mask = None):
+        matrix = self.matrix if scenario_mask is None else self.matrix[:, scenario_mask]
+        return matrix.any(axis=1)
+
+    def pairCoverage(self, scenario_mask = None):
+        matrix = (self.matrix if scenario_mask is None else self.matrix[:, scenario_mask]).astype(np.int32)
+        return (matrix @ matrix.T) > 0
+
+    def uncoveredValues(self, scenario_mask = None):
+        return [self.values[row] for row in np.flatnonzero(~self.valueCoverage(scenario_mask))]
+
+    def uncoveredPairs(self, scenario_mask = None):
+        rows, cols = np.nonzero(self.pair_mask & ~self.pairCoverage(scenario_mask))
+        return [(self.values[row], self.values[col]) for row, col in zip(rows, cols)]
+
+    def report(self, scenario_mask = None):
+        value_coverage = self.valueCoverage(scenario_mask)
+        pair_coverage = self.pairCoverage(scenario_mask)[self.pair_mask]
+        return {
+            'values': len(value_coverage), 'values_covered': int(value_coverage.sum()),
+            'value_coverage': float(value_coverage.mean()) if len(value_coverage) else 1.0,
+            'pairs': len(pair_coverage), 'pairs_covered': int(pair_coverage.sum()),
+            'pair_coverage': float(pair_coverage.mean()) if len(pair_coverage) else 1.0
+        }
+
+    def describeGaps(self, scenario_mask = None):
+        gaps = [f"{value['dimension']} = {value['value']}" for value in self.uncoveredValues(scenario_mask)]
+        gaps += [f"{first['dimension']} = {first['value']} with {second['dimension']} = {second['value']}"
+                 for first, second in self.uncoveredPairs(scenario_mask)]
+        return gaps
+
+    def scenariosForGaps(self, scenario_mask):
+        '''
+        Greedily picks scenarios outside the mask that cover the most uncovered values and pairs
+        till no further gap can be closed. Returns their scenario ids
+        '''
+        covered_values, covered_pairs = self.valueCoverage(scenario_mask).copy(), self.pairCoverage(scenario_mask) | ~self.pair_mask
+        candidates, selected = np.flatnonzero(~scenario_mask), []
+        while len(candidates):
+            #Gains of all the candidates at once: uncovered values of each column and uncovered pairs within each column
+            columns = self.matrix[:, candidates].astype(np.int32)
+            uncovered_pairs = (~covered_pairs).astype(np.int32)
+            gains = (~covered_values).astype(np.int32) @ columns + np.einsum('ic,ic->c', columns, uncovered_pairs @ columns)
+            best = int(np.argmax(gains))
+            if gains[best] <= 0:
+                break
+            column = self.matrix[:, candidates[best]]
+            covered_values |= column
+            covered_pairs |= np.outer(column, column)
+            selected.append(self.scenario_ids[candidates[best]])
+            candidates = np.delete(candidates, best)
+        return selected
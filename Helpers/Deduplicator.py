@@ -0,0 +1,123 @@
+import re
+import hashlib
+import random
+from Helpers.MetricsRecorder import getMetrics
+
+MERSENNE_PRIME = (1 << 61) - 1
+
+
+def normalizeText(text):
+    return ' '.join(re.sub(r'[^a-z0-9]+', ' ', str(text).lower()).split())
+
+
+def dimensionKey(scenario_dimension):
+    '''
+    Order independent key of the dimension values of a scenario e.g. [{'dimension': 'Level', 'value': 'CM'}, ...]
+    '''
+    return tuple(sorted((normalizeText(item['dimension']), normalizeText(item['value'])) for item in scenario_dimension))
+
+
+class NearDuplicateDetector:
+    '''
+    Detects duplicates among generated items before they go to the next stage.
+    Exact duplicates are found by hashing the normalized key (e.g. the dimension tuple of a scenario) and near duplicates
+    by MinHash similarity of word shingles of the text fields, using LSH banding to avoid comparing every pair.
+    Items are checked incrementally against everything seen so far, so it works across batches of a run.
+    Items are only compared within their group_function value (e.g. the scenario of a test case).
+    A detector with a key_function (e.g. the dimension values of a scenario) finds exact duplicates of that key only.
+    The key says what an item covers, so items with the same key are duplicates whatever their wording, and similar
+    wording never merges items with different keys (e.g. the same description for two currencies).
+    '''
+    def __init__(self, id_field, text_fields, key_function = None, group_function = None, threshold = 0.85, num_perm = 64, bands = 16, shingle_size = 3, seed = 7):
+        self.id_field, self.text_fields, self.key_function, self.group_function = id_field, text_fields, key_function, group_function
+        self.threshold, self.num_perm, self.bands, self.shingle_size = threshold, num_perm, bands, shingle_size
+        self.rows = num_perm // bands
+        generator = random.Random(seed)
+        self.permutations = [(generator.randrange(1, MERSENNE_PRIME), generator.randrange(0, MERSENNE_PRIME)) for _ in range(num_perm)]
+        self.exact_index, self.band_index, self.signatures, self.keys = {}, {}, {}, {}
+
+    def _shingles(self, text):
+        words = normalizeText(text).split()
+        if len(words) <= self.shingle_size:
+            return {' '.join(words)}
+        return {' '.join(words[i:i+self.shingle_size]) for i in range(len(words) - self.shingle_size + 1)}
+
+    def signature(self, text):
+        hashes = [int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), 'big') for shingle in self._shingles(text)]
+        return [min((a * h + b) % MERSENNE_PRIME for h in hashes) for a, b in self.permutations]
+
+    def similarity(self, signature_a, signature_b):
+        return sum(1 for a, b in zip(signature_a, signature_b) if a == b) / self.num_perm
+
+    def _bands(self, signature):
+        return [(band, tuple(signature[band*self.rows:(band+1)*self.rows])) for band in range(self.bands)]
+
+    def _key(self, record, text):
+        #(group, key) of the record. Items match exactly on both and near duplicates need the same group
+        group = self.group_function(record) if self.group_function else None
+        return group, self.key_function(record) if self.key_function else normalizeText(text)
+
+    def check(self, record):
+        '''
+        Returns (duplicate_of, reason, similarity) if the record duplicates an item already seen, else None
+        '''
+        text = ' '.join(str(record[field]) for field in self.text_fields)
+        key = self._key(record, text)
+        if key in self.exact_index:
+            return self.exact_index[key], 'exact', 1.0
+        if self.key_function:
+            return None
+        signature = self.signature(text)
+        best = None
+        candidates = {item_id for band in self._bands(signature) for item_id in self.band_index.get(band, [])}
+        for item_id in candidates:
+            if self.keys[item_id][0] != key[0]:
+                continue
+            score = self.similarity(signature, self.signatures[item_id])
+            if score >= self.threshold and (best is None or score > best[2]):
+                best = (item_id, 'near', score)
+        return best
+
+    def add(self, record):
+        text = ' '.join(str(record[field]) for field in self.text_fields)
+        item_id = str(record[self.id_field])
+        self.keys[item_id] = self._key(record, text)
+        self.exact_index.setdefault(self.keys[item_id], item_id)
+        if self.key_function:
+            return
+        self.signatures[item_id] = self.signature(text)
+        for band in self._bands(self.signatures[item_id]):
+            self.band_index.setdefault(band, []).append(item_id)
+
+    def filter(self, records, mode = 'drop', stage = 'dedup'):
+        '''
+        mode is drop - duplicates are removed, flag - duplicates are kept and reported, off - nothing is checked
+        Returns the records to pass on and the list of duplicates found
+        '''
+        if mode == 'off':
+            return records, []
+        kept, duplicates = [], []
+        for record in records:
+            match = self.check(record)
+            if match:
+                duplicate_of, reason, score = match
+                duplicates.append({'item_id': str(record[self.id_field]), 'duplicate_of': duplicate_of, 'reason': reason, 'similarity': score})
+                getMetrics().increment(stage, f'duplicates_{reason}')
+                getMetrics().event(stage, 'duplicate', **duplicates[-1], action = mode)
+                if mode == 'drop':
+                    continue
+            else:
+                self.add(record)
+            kept.append(record)
+        return kept, duplicates
+
+
+def reportAvoidedWork(stage, dropped, calls_per_item):
+    '''
+    Records and prints an estimate of the downstream LLM calls that were not made because of the dropped duplicates
+    '''
+    avoided = dropped * calls_per_item
+    getMetrics().increment(stage, 'downstream_calls_avoided', avoided)
+    if dropped:
+        print(f'Dropped {dropped} duplicates in {stage}, avoiding about {avoided} downstream generation and verification calls')
+    return avoided
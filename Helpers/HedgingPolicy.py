@@ -0,0 +1,116 @@
+import time
+import queue
+import threading
+from collections import deque
+from Helpers.MetricsRecorder import getMetrics
+
+
+class HedgingPolicy:
+    '''
+    Sends a duplicate of an LLM request that has not answered within a threshold and returns the first valid response.
+    The threshold is a fixed delay in seconds or a percentile of the latencies of the primary requests, in which case
+    nothing is hedged until warmup latencies are seen. Hedged requests are capped at budget (a fraction) of the calls.
+    Requests cannot be cancelled once sent, so the losing request is abandoned and its response is dropped.
+    An abandoned request still runs to its end, including the retries of the request itself (e.g. up to 10 tenacity
+    retries of a gemini turn). That spend is not counted against budget, which caps the hedges sent and not the
+    calls they cause. Abandoned requests are counted in the hedge_abandoned metric.
+    A policy keeps its latencies and counters across runs, so the connector keeps it while its spec is unchanged.
+    Specs are "p95", "p90:0.2" (percentile and budget) or "20", "20:0.05" (seconds and budget)
+    '''
+    def __init__(self, delay = None, percentile = 95, budget = 0.1, stage = '', window = 50, warmup = 10):
+        if delay is None and not 0 < percentile < 100:
+            raise Exception(f'{percentile} is an invalid hedging percentile. It must be between 0 and 100')
+        self.delay, self.percentile, self.budget, self.stage, self.warmup = delay, percentile, budget, stage, warmup
+        self.latencies = deque(maxlen = window)
+        self.calls, self.hedges = 0, 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def resolve(cls, hedge, stage):
+        '''
+        Accepts a policy, a spec or None for no hedging. An empty spec is the default p95 policy
+        '''
+        if hedge is None or isinstance(hedge, HedgingPolicy):
+            return hedge
+        threshold, _, budget = str(hedge).partition(':')
+        threshold = threshold if threshold else 'p95'
+        budget = float(budget) if budget else 0.1
+        if threshold.startswith('p'):
+            return cls(percentile = float(threshold[1:]), budget = budget, stage = stage)
+        return cls(delay = float(threshold), budget = budget, stage = stage)
+
+    def threshold(self):
+        '''
+        Seconds to wait for a request before hedging it, or None while there are too few latencies to estimate it
+        '''
+        if self.delay is not None:
+            return self.delay
+        with self.lock:
+            if len(self.latencies) < self.warmup:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))]
+
+    def _take_budget(self):
+        with self.lock:
+            if self.hedges + 1 > self.budget * self.calls:
+                return False
+            self.hedges += 1
+            return True
+
+    def run(self, request, valid = None):
+        '''
+        Calls request() and, when it is slower than the threshold, a second request() in parallel.
+        A response is valid when request() returns without an error and valid(response) holds.
+        Returns the first valid response or raises the error of the primary request when none is valid
+        '''
+        metrics = getMetrics()
+        with self.lock:
+            self.calls += 1
+        metrics.increment(self.stage, 'hedge_eligible_calls')
+        responses = queue.Queue()
+        def attempt(name):
+            try:
+                response = request()
+                if valid is not None and not valid(response):
+                    raise Exception('Invalid response')
+                if name == 'primary':
+                    #Only the latency of the primary request is observed, also when a hedge won. The winning latency
+                    #would lower the percentile with every hedge and cause still more hedging
+                    with self.lock:
+                        self.latencies.append(time.perf_counter() - start_time)
+                responses.put((name, response, None))
+            except Exception as e:
+                responses.put((name, None, e))
+        start_time, threshold = time.perf_counter(), self.threshold()
+        #Daemon threads so that an abandoned request does not keep the process alive
+        threading.Thread(target = attempt, args = ('primary',), daemon = True).start()
+        pending, errors = 1, {}
+        try:
+            outcome = responses.get(timeout = threshold)
+        except queue.Empty:
+            if self._take_budget():
+                metrics.increment(self.stage, 'hedges')
+                metrics.observe(self.stage, 'hedge_threshold_s', threshold)
+                print(f'Request slower than {threshold:.1f}s and hence hedged')
+                threading.Thread(target = attempt, args = ('hedge',), daemon = True).start()
+                pending += 1
+            else:
+                metrics.increment(self.stage, 'hedge_budget_exhausted')
+            outcome = responses.get()
+        while True:
+            name, response, error = outcome
+            pending -= 1
+            if error is None:
+                break
+            errors[name] = error
+            if not pending:
+                raise errors.get('primary', error)
+            outcome = responses.get()
+        latency = time.perf_counter() - start_time
+        if pending:
+            metrics.increment(self.stage, 'hedge_abandoned')
+        if name == 'hedge':
+            metrics.increment(self.stage, 'hedge_wins')
+        metrics.observe(self.stage, 'hedged_latency_s', latency)
+        return response
@@ -0,0 +1,95 @@
+import os
+import json
+import pandas as pd
+from pydantic import BaseModel
+from typing import Optional, Type
+from Helpers.Profiler import span
+
+
+def getStorePath(env_var):
+    '''
+    The typed store sits beside the csv configured for the stage e.g. TEST_SCENARIOS_FILE=scenarios.csv -> scenarios.jsonl
+    '''
+    return os.path.splitext(os.getenv(env_var))[0] + '.jsonl'
+
+
+class JsonlStore:
+    '''
+    Typed store for handing off the output of one stage to the next. Each record is a JSON line validated against
+    the response model of the stage, so nested fields like scenario_dimension, values and constraints are kept as is.
+    CSV is only an export format of this store.
+    '''
+    def __init__(self, filepath, model:Optional[Type[BaseModel]] = None):
+        self.filepath = filepath
+        self.model = model
+
+    def exists(self):
+        return os.path.isfile(self.filepath)
+
+    def write(self, records, append = False):
+        lines = []
+        for record in records:
+            if isinstance(record, BaseModel):
+                record = record.model_dump()
+            elif self.model:
+                record = self.model.model_validate(record).model_dump()
+            lines.append(json.dumps(record) + '\n')
+        with span('io'), open(self.filepath, 'a' if append else 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+
+    def upsert(self, records, key):
+        '''
+        Replaces the records with the same key in place and appends the new ones
+        '''
+        records = {str(record[key]): record for record in records}
+        existing = self.read() if self.exists() else []
+        merged = [records.pop(str(record[key]), record) for record in existing]
+        self.write(merged + list(records.values()))
+
+    def replaceWhere(self, records, key, value):
+        '''
+        Removes the records whose key has the given value and appends the new records at the end
+        '''
+        existing = self.read() if self.exists() else []
+        self.write([record for record in existing if str(record.get(key)) != str(value)] + list(records))
+
+    def read(self, columns = None, start = 1, end = -1, where = None, validate = False):
+        '''
+        start and end are 1-based and inclusive like the ranges given on the command line. end < 0 reads till the end.
+        where is a dict of column -> value and only the matching records are returned
+        '''
+        records = []
+        if not self.exists():
+            raise Exception(f'Intermediate store {self.filepath} not found. Run the previous stage first')
+        with open(self.filepath, 'r', encoding='utf-8') as f:
+            for line_num, line in enumerate(f, start=1):
+                if line_num < start or not line.strip():
+                    continue
+                if end > 0 and line_num > end:
+                    break
+                record = json.loads(line)
+                if where and any(record.get(key) != value for key, value in where.items()):
+                    continue
+                if validate and self.model:
+                    record = self.model.model_validate(record).model_dump()
+                if columns:
+                    record = {column: record.get(column) for column in columns}
+                records.append(record)
+        return records
+
+    def readDf(self, columns = None, start = 1, end = -1, where = None):
+        return pd.DataFrame(self.read(columns, start, end, where), columns = columns)
+
+    def count(self):
+        if not self.exists():
+            return 0
+        with open(self.filepath, 'r', encoding='utf-8') as f:
+            return sum(1 for line in f if line.strip())
+
+    def exportCsv(self, filepath):
+        df = self.readDf()
+        #Nested columns are exported as JSON so that they can still be parsed back
+        for column in df.columns:
+            if df[column].apply(lambda x: isinstance(x, (list, dict))).any():
+                df[column] = df[column].apply(json.dumps)
+        df.to_csv(filepath, index=False)
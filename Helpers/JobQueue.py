@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import sqlite3
+from contextlib import contextmanager
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    module TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL,
+    worker TEXT,
+    submitted_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, job_id);
+CREATE TABLE IF NOT EXISTS job_events (
+    job_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    at REAL NOT NULL,
+    item_id TEXT,
+    status TEXT NOT NULL,
+    data TEXT,
+    PRIMARY KEY (job_id, seq)
+);
+'''
+
+FINISHED = ('done', 'failed')
+
+
+def getJobQueuePath():
+    return os.getenv('JOB_QUEUE_DB', 'jobs.db')
+
+
+class JobQueue:
+    '''
+    Persistent queue of pipeline jobs shared by the service and its worker processes. Jobs of a module run one at a time
+    since the stages of a module share their output files. Progress of a job is kept as a sequence of events
+    '''
+    def __init__(self, filepath = None):
+        self.filepath = filepath if filepath else getJobQueuePath()
+        with self.transaction() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def transaction(self):
+        conn = sqlite3.connect(self.filepath, timeout = 30)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    def submit(self, module, stage, params):
+        with self.transaction() as conn:
+            cursor = conn.execute('INSERT INTO jobs (module, stage, params, status, submitted_at) VALUES (?, ?, ?, ?, ?)',
+                                  (module, stage, json.dumps(params), 'queued', time.time()))
+            return cursor.lastrowid
+
+    def claim(self, worker):
+        '''
+        Marks the oldest queued job of a module without a running job as running and returns it, or None
+        '''
+        with self.transaction() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('''SELECT job_id FROM jobs WHERE status = 'queued'
+                                  AND module NOT IN (SELECT module FROM jobs WHERE status = 'running')
+                                  ORDER BY job_id LIMIT 1''').fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE jobs SET status = 'running', worker = ?, started_at = ? WHERE job_id = ?", (worker, time.time(), row['job_id']))
+        return self.get(row['job_id'])
+
+    def finish(self, job_id, result = None, error = None):
+        with self.transaction() as conn:
+            conn.execute('UPDATE jobs SET status = ?, finished_at = ?, result = ?, error = ? WHERE job_id = ?',
+                         ('failed' if error else 'done', time.time(), json.dumps(result, default=str), error, job_id))
+
+    def requeueRunning(self):
+        #Jobs left running by a previous service process are run again
+        with self.transaction() as conn:
+            return conn.execute("UPDATE jobs SET status = 'queued', worker = NULL, started_at = NULL WHERE status = 'running'").rowcount
+
+    def addEvent(self, job_id, status, item_id = None, **data):
+        with self.transaction() as conn:
+            conn.execute('''INSERT INTO job_events (job_id, seq, at, item_id, status, data)
+                            SELECT ?, COALESCE(MAX(seq), 0) + 1, ?, ?, ?, ? FROM job_events WHERE job_id = ?''',
+                         (job_id, time.time(), item_id, status, json.dumps(data, default=str), job_id))
+
+    def events(self, job_id, after = 0):
+        with self.transaction() as conn:
+            rows = conn.execute('SELECT * FROM job_events WHERE job_id = ? AND seq > ? ORDER BY seq', (job_id, after)).fetchall()
+        return [dict(row, data = json.loads(row['data']) if row['data'] else {}) for row in rows]
+
+    def get(self, job_id):
+        with self.transaction() as conn:
+            row = conn.execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        return self._toJob(row) if row else None
+
+    def list(self, status = None, module = None, limit = 100):
+        query, args = 'SELECT * FROM jobs WHERE 1 = 1', []
+        if status:
+            query, args = query + ' AND status = ?', args + [status]
+        if module:
+            query, args = query + ' AND module = ?', args + [module]
+        with self.transaction() as conn:
+            rows = conn.execute(query + ' ORDER BY job_id DESC LIMIT ?', args + [limit]).fetchall()
+        return [self._toJob(row) for row in rows]
+
+    def stats(self):
+        with self.transaction() as conn:
+            rows = conn.execute('''SELECT status, COUNT(*) AS jobs, AVG(finished_at - started_at) AS mean_duration,
+                                   AVG(COALESCE(started_at, ?) - submitted_at) AS mean_wait FROM jobs GROUP BY status''', (time.time(),)).fetchall()
+        return {row['status']: {'jobs': row['jobs'], 'mean_duration_s': row['mean_duration'], 'mean_wait_s': row['mean_wait']} for row in rows}
+
+    def _toJob(self, row):
+        job = dict(row)
+        job['params'] = json.loads(job['params'])
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
@@ -1,7 +1,13 @@
+import os
+
+
 def getKnowledgeBasePath(test_module):
     if test_module == 'Collateral Blocking':
         return 'KnowledgeBase/CollateralBlocking'
     elif test_module == 'Cash Allocation':
         return 'KnowledgeBase/CashAllocation'
-    else:
-        raise Exception(f'Cannot find the Knowledge Base Path for module {test_module}')
\ No newline at end of file
+    #Other modules follow the same layout e.g. Margin Calls -> KnowledgeBase/MarginCalls
+    knowledge_base_path = os.path.join(os.getenv('KNOWLEDGE_BASE_DIR', 'KnowledgeBase'), ''.join(test_module.split()))
+    if os.path.isdir(knowledge_base_path):
+        return knowledge_base_path
+    raise Exception(f'Cannot find the Knowledge Base Path for module {test_module}')
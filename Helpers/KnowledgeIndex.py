@@ -0,0 +1,100 @@
+import os
+import re
+import json
+import math
+from collections import Counter
+from Helpers.Traceability import knowledgeBaseDigests
+
+_indexes = {}
+
+def getKnowledgeIndex(knowledge_base_path):
+    '''
+    One index per knowledge base in a process. The index is loaded from disk when the knowledge base has not changed
+    '''
+    if knowledge_base_path not in _indexes:
+        _indexes[knowledge_base_path] = KnowledgeIndex(knowledge_base_path)
+    return _indexes[knowledge_base_path]
+
+
+def tokenize(text):
+    return re.findall(r'[a-z0-9]+', str(text).lower())
+
+
+class KnowledgeIndex:
+    '''
+    Local BM25 index over chunks of the knowledge base files. Chunks are groups of lines of about chunk_size words
+    so that rows of masters and static data are not split. The index is cached in KNOWLEDGE_INDEX_DIR (default knowledge_index)
+    and rebuilt when a file of the knowledge base changes
+    '''
+    def __init__(self, knowledge_base_path, chunk_size = 200, k1 = 1.5, b = 0.75, index_directory = None):
+        self.knowledge_base_path, self.chunk_size, self.k1, self.b = knowledge_base_path, chunk_size, k1, b
+        index_directory = index_directory if index_directory else os.getenv('KNOWLEDGE_INDEX_DIR', 'knowledge_index')
+        self.index_path = os.path.join(index_directory, os.path.basename(os.path.normpath(knowledge_base_path)) + '.json')
+        digests = knowledgeBaseDigests(knowledge_base_path)
+        if not self._load(digests):
+            self._build(digests)
+            self._save(digests)
+
+    def _chunks(self, file_name):
+        with open(os.path.join(self.knowledge_base_path, file_name), 'r', encoding='utf-8', errors='ignore') as f:
+            lines = f.read().splitlines()
+        chunk, chunk_words = [], 0
+        for line in lines:
+            chunk.append(line)
+            chunk_words += len(line.split())
+            if chunk_words >= self.chunk_size:
+                yield '\n'.join(chunk)
+                chunk, chunk_words = [], 0
+        if chunk_words > 0:
+            yield '\n'.join(chunk)
+
+    def _build(self, digests):
+        self.chunks, self.postings, self.lengths = [], {}, []
+        for file_name in digests:
+            for text in self._chunks(file_name):
+                chunk_num = len(self.chunks)
+                self.chunks.append({'file': file_name, 'text': text})
+                terms = Counter(tokenize(text))
+                self.lengths.append(sum(terms.values()))
+                for term, frequency in terms.items():
+                    self.postings.setdefault(term, []).append([chunk_num, frequency])
+        print(f'Built knowledge index of {len(self.chunks)} chunks for {self.knowledge_base_path}')
+
+    def _save(self, digests):
+        os.makedirs(os.path.dirname(self.index_path) or '.', exist_ok=True)
+        with open(self.index_path, 'w', encoding='utf-8') as f:
+            json.dump({'digests': digests, 'chunk_size': self.chunk_size, 'chunks': self.chunks,
+                       'postings': self.postings, 'lengths': self.lengths}, f)
+
+    def _load(self, digests):
+        if not os.path.isfile(self.index_path):
+            return False
+        with open(self.index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        if index['digests'] != digests or index['chunk_size'] != self.chunk_size:
+            return False
+        self.chunks, self.postings, self.lengths = index['chunks'], index['postings'], index['lengths']
+        return True
+
+    def search(self, query, k = 5):
+        '''
+        Top k chunks for the query by BM25 score. Returns [{file, text, score}] in the order of the files
+        '''
+        if not self.chunks:
+            return []
+        average_length = sum(self.lengths) / len(self.lengths)
+        scores = Counter()
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term, [])
+            if not postings:
+                continue
+            idf = math.log(1 + (len(self.chunks) - len(postings) + 0.5) / (len(postings) + 0.5))
+            for chunk_num, frequency in postings:
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[chunk_num] / average_length)
+                scores[chunk_num] += idf * frequency * (self.k1 + 1) / (frequency + norm)
+        #Chunks are returned in document order so that the context reads like the source
+        top = sorted(chunk_num for chunk_num, _ in scores.most_common(k))
+        return [dict(self.chunks[chunk_num], score = scores[chunk_num]) for chunk_num in top]
+
+    def context(self, query, k = 5):
+        return '\n\n'.join(f"From {chunk['file']}:\n{chunk['text']}" for chunk in self.search(query, k))
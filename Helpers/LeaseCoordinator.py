@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+from contextlib import contextmanager, closing
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS shard_runs (
+    run_id TEXT PRIMARY KEY,
+    module TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    params TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    end INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    merged_at REAL
+);
+CREATE TABLE IF NOT EXISTS leases (
+    run_id TEXT NOT NULL,
+    shard INTEGER NOT NULL,
+    start INTEGER NOT NULL,
+    end INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    worker TEXT,
+    expires_at REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    output_path TEXT,
+    error TEXT,
+    finished_at REAL,
+    PRIMARY KEY (run_id, shard)
+);
+CREATE INDEX IF NOT EXISTS idx_leases_status ON leases(run_id, status, expires_at);
+'''
+
+
+def getCoordinatorPath():
+    return os.getenv('COORDINATOR_DB', 'coordinator.db')
+
+
+class LeaseCoordinator:
+    '''
+    Splits the item range of a stage into shards and hands them out as leases to workers on one or more hosts
+    through a SQLite database on a shared path. A worker keeps its lease alive with heartbeats. A lease that is not
+    renewed in time is handed to another worker, and a shard that failed max_attempts times is given up.
+    '''
+    def __init__(self, filepath = None, max_attempts = 3):
+        self.filepath = filepath if filepath else getCoordinatorPath()
+        self.max_attempts = max_attempts
+        with self.transaction() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def transaction(self):
+        with closing(sqlite3.connect(self.filepath, timeout = 30)) as conn:
+            conn.row_factory = sqlite3.Row
+            with conn:
+                yield conn
+
+    def plan(self, module, stage, start, end, shard_size, params = None):
+        run_id = time.strftime('%Y%m%d_%H%M%S') + '_' + uuid.uuid4().hex[:6]
+        shards = [(shard, shard_start, min(shard_start + shard_size - 1, end))
+                  for shard, shard_start in enumerate(range(start, end + 1, shard_size), start = 1)]
+        with self.transaction() as conn:
+            conn.execute('INSERT INTO shard_runs (run_id, module, stage, params, start, end, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (run_id, module, stage, json.dumps(params if params else {}), start, end, time.time()))
+            conn.executemany("INSERT INTO leases (run_id, shard, start, end, status) VALUES (?, ?, ?, ?, 'queued')",
+                             [(run_id, shard, shard_start, shard_end) for shard, shard_start, shard_end in shards])
+        return run_id
+
+    def getRun(self, run_id):
+        with self.transaction() as conn:
+            row = conn.execute('SELECT * FROM shard_runs WHERE run_id = ?', (run_id,)).fetchone()
+        if row is None:
+            raise Exception(f'Shard run {run_id} not found')
+        return dict(row, params = json.loads(row['params']))
+
+    def claim(self, run_id, worker, lease_seconds):
+        '''
+        Leases the first queued or expired shard to the worker. Returns the lease or None when no shard can be claimed now
+        '''
+        with self.transaction() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            #Expired leases that used up their attempts are given up
+            conn.execute("""UPDATE leases SET status = 'failed', error = COALESCE(error, 'lease expired') WHERE run_id = ?
+                            AND status = 'leased' AND expires_at < ? AND attempts >= ?""", (run_id, now, self.max_attempts))
+            row = conn.execute("""SELECT * FROM leases WHERE run_id = ? AND (status = 'queued' OR (status = 'leased' AND expires_at < ?))
+                                  ORDER BY shard LIMIT 1""", (run_id, now)).fetchone()
+            if row is None:
+                return None
+            if row['status'] == 'leased':
+                print(f"Lease of shard {row['shard']} held by {row['worker']} expired and is reassigned")
+            conn.execute("UPDATE leases SET status = 'leased', worker = ?, expires_at = ?, attempts = attempts + 1 WHERE run_id = ? AND shard = ?",
+                         (worker, now + lease_seconds, run_id, row['shard']))
+            return dict(row, worker = worker, attempts = row['attempts'] + 1)
+
+    def heartbeat(self, run_id, shard, worker, lease_seconds):
+        '''
+        Extends the lease. Returns False if the lease was lost to another worker
+        '''
+        with self.transaction() as conn:
+            return conn.execute("UPDATE leases SET expires_at = ? WHERE run_id = ? AND shard = ? AND worker = ? AND status = 'leased'",
+                                (time.time() + lease_seconds, run_id, shard, worker)).rowcount == 1
+
+    def complete(self, run_id, shard, worker, output_path):
+        with self.transaction() as conn:
+            return conn.execute("""UPDATE leases SET status = 'done', output_path = ?, finished_at = ?
+                                   WHERE run_id = ? AND shard = ? AND worker = ? AND status = 'leased'""",
+                                (output_path, time.time(), run_id, shard, worker)).rowcount == 1
+
+    def fail(self, run_id, shard, worker, error):
+        #The shard is queued again till it runs out of attempts
+        with self.transaction() as conn:
+            conn.execute("""UPDATE leases SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, error = ?, expires_at = NULL
+                            WHERE run_id = ? AND shard = ? AND worker = ? AND status = 'leased'""",
+                         (self.max_attempts, error, run_id, shard, worker))
+
+    def leases(self, run_id):
+        with self.transaction() as conn:
+            return [dict(row) for row in conn.execute('SELECT * FROM leases WHERE run_id = ? ORDER BY shard', (run_id,))]
+
+    def progress(self, run_id):
+        progress = {}
+        for lease in self.leases(run_id):
+            progress[lease['status']] = progress.get(lease['status'], 0) + 1
+        return progress
+
+    def isFinished(self, run_id):
+        return all(lease['status'] in ('done', 'failed') for lease in self.leases(run_id))
+
+    def markMerged(self, run_id):
+        with self.transaction() as conn:
+            conn.execute('UPDATE shard_runs SET merged_at = ? WHERE run_id = ?', (time.time(), run_id))
@@ -0,0 +1,79 @@
+import os
+import json
+import threading
+from datetime import datetime
+
+
+class MetricsRecorder:
+    '''
+    Collects counters, samples and events per pipeline stage during a run and writes them out as JSON
+    so that policies (model cascade, verification sampling etc) can be tuned across runs
+    '''
+    def __init__(self, run_id=None):
+        self.run_id = run_id if run_id else datetime.now().strftime('%Y%m%d_%H%M%S') + f'_{os.getpid()}'
+        self.counters = {}
+        self.samples = {}
+        self.events = []
+        self.lock = threading.Lock()
+
+    def increment(self, stage, name, value = 1):
+        with self.lock:
+            stage_counters = self.counters.setdefault(stage, {})
+            stage_counters[name] = stage_counters.get(name, 0) + value
+
+    def observe(self, stage, name, value):
+        with self.lock:
+            self.samples.setdefault(stage, {}).setdefault(name, []).append(value)
+
+    def event(self, stage, name, **data):
+        with self.lock:
+            self.events.append({'stage': stage, 'event': name, 'at': datetime.now().isoformat(), **data})
+
+    def count(self, stage, name):
+        with self.lock:
+            return self.counters.get(stage, {}).get(name, 0)
+
+    def rate(self, stage, numerator, denominator):
+        total = self.count(stage, denominator)
+        return self.count(stage, numerator) / total if total else 0.0
+
+    def summary(self):
+        with self.lock:
+            summary = {'run_id': self.run_id, 'counters': json.loads(json.dumps(self.counters)), 'samples': {}}
+            for stage, stage_samples in self.samples.items():
+                summary['samples'][stage] = {}
+                for name, values in stage_samples.items():
+                    ordered = sorted(values)
+                    summary['samples'][stage][name] = {
+                        'count': len(ordered),
+                        'mean': sum(ordered) / len(ordered),
+                        'p50': ordered[len(ordered) // 2],
+                        'p99': ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))],
+                        'max': ordered[-1]
+                    }
+            return summary
+
+    def save(self, directory = None):
+        directory = directory if directory else os.getenv('METRICS_DIR', 'metrics')
+        os.makedirs(directory, exist_ok=True)
+        filepath = os.path.join(directory, f'{self.run_id}.json')
+        report = self.summary()
+        with self.lock:
+            report['events'] = list(self.events)
+        with open(filepath, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+        return filepath
+
+
+_metrics = MetricsRecorder()
+
+def getMetrics():
+    return _metrics
+
+def resetMetrics(run_id = None):
+    '''
+    Starts a new recorder e.g. for each job of a long running worker
+    '''
+    global _metrics
+    _metrics = MetricsRecorder(run_id)
+    return _metrics
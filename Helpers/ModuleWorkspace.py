@@ -0,0 +1,29 @@
+import os
+import re
+
+#Env vars of the paths written by a pipeline run
+OUTPUT_ENV_VARS = ['TEST_DIMENSIONS_FILE', 'TEST_SCENARIOS_FILE', 'TEST_CASES_FILE', 'TEST_DATA_FILE']
+
+
+def moduleSlug(test_module):
+    return re.sub(r'[^a-z0-9]+', '_', test_module.lower()).strip('_')
+
+
+def useModuleWorkspace(test_module):
+    '''
+    Namespaces the output paths, artifact store and metrics of this process by module. Context caches are shared
+    across processes through the cache registry, keyed by module
+    e.g. TEST_CASES_FILE=output/test_cases.csv -> output/cash_allocation/test_cases.csv
+    Meant to be called once at the start of a process that works on a single module
+    '''
+    slug = moduleSlug(test_module)
+    for env_var in OUTPUT_ENV_VARS:
+        filepath = os.getenv(env_var)
+        if filepath:
+            os.environ[env_var] = os.path.join(os.path.dirname(filepath), slug, os.path.basename(filepath))
+            os.makedirs(os.path.dirname(os.environ[env_var]), exist_ok=True)
+    if os.getenv('ARTIFACT_DB'):
+        os.environ['ARTIFACT_DB'] = os.path.join(os.path.dirname(os.getenv('ARTIFACT_DB')), slug, os.path.basename(os.getenv('ARTIFACT_DB')))
+        os.makedirs(os.path.dirname(os.environ['ARTIFACT_DB']), exist_ok=True)
+    os.environ['METRICS_DIR'] = os.path.join(os.getenv('METRICS_DIR', 'metrics'), slug)
+    return slug
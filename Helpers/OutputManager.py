@@ -1,6 +1,8 @@
 from openpyxl import Workbook, load_workbook
 from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
+import xlsxwriter
 import pandas as pd
+from Helpers.Profiler import span
 
 class ExcelManager:
     def __init__(self, mode='new', filepath=None):
@@ -10,7 +12,8 @@ class ExcelManager:
             self.filepath = filepath
         else:
             if filepath:
-                self.wb = load_workbook(filepath)
+                with span('io'):
+                    self.wb = load_workbook(filepath)
                 self.sheetnames = self.wb.sheetnames
             else:
                 raise Exception("Filepath required to load an existing workbook")
@@ -18,6 +21,10 @@ class ExcelManager:
     def createWorksheet(self, sheetName):
         self.wb.create_sheet(sheetName)
 
+    def removeWorksheet(self, sheetName):
+        if sheetName in self.wb.sheetnames:
+            self.wb.remove(self.wb[sheetName])
+
     def writeTextToSheet(self, sheetName, objToWrite):
         ws = self.wb[sheetName]
         for key, value in objToWrite.items():
@@ -77,7 +84,10 @@ class ExcelManager:
         
         # Extract range
         data = list(ws.iter_rows(min_row=start_row+1, max_row=end_row-1, values_only=True))
-        
+        return end_row, self.blockToDf(data)
+
+    @staticmethod
+    def blockToDf(data):
         # First row is header
         headers = data[0]
         rows = data[1:]
@@ -89,7 +99,36 @@ class ExcelManager:
         # Sort by step number (assuming column is named 'step' or 'Step')
         if 'step' in df.columns:
             df = df.sort_values('step').reset_index(drop=True)
-        return end_row, df
+        return df
+
+    @staticmethod
+    def readSheetBlocks(filepath, sheetNames=None):
+        '''
+        Opens the workbook in read only mode and extracts every marker block of the requested sheets in a single pass over
+        their rows. Sheets that are not requested are never parsed.
+        Returns {sheetName: {blockName: (end_row, df)}} where blockName is the start marker without " - Start" e.g. ##Test Steps
+        '''
+        wb = load_workbook(filepath, read_only=True)
+        try:
+            blocks = {}
+            for sheetName in (sheetNames if sheetNames else wb.sheetnames):
+                if sheetName not in wb.sheetnames:
+                    print(f'Sheet {sheetName} not found in {filepath}')
+                    continue
+                sheet_blocks, block_name, block_rows = {}, None, []
+                for idx, row in enumerate(wb[sheetName].iter_rows(values_only=True), start=1):
+                    marker = row[0] if row and isinstance(row[0], str) else ''
+                    if marker.startswith('##') and marker.endswith(' - Start'):
+                        block_name, block_rows = marker[:-len(' - Start')], []
+                    elif block_name and marker == f'{block_name} - End':
+                        sheet_blocks[block_name] = (idx, ExcelManager.blockToDf(block_rows))
+                        block_name = None
+                    elif block_name:
+                        block_rows.append(row)
+                blocks[sheetName] = sheet_blocks
+            return blocks
+        finally:
+            wb.close()
 
     def deleteRange(self, sheetName, startMarker, endMarker):
         ws = self.wb[sheetName]
@@ -107,8 +146,63 @@ class ExcelManager:
         except:
             pass
 
-        self.wb.save(self.filepath)
+        with span('io'):
+            self.wb.save(self.filepath)
     
+class XlsxRenderer:
+    '''
+    Writes a test data workbook in one pass with xlsxwriter in constant memory mode. The rows of a sheet are written in order
+    and flushed, so a sheet has to be written completely with writeSheet. The layout and markers are the same as ExcelManager
+    writes, so ExcelManager.readSheetBlocks and the out stage read the rendered workbook as before
+    '''
+    def __init__(self, filepath):
+        self.wb = xlsxwriter.Workbook(filepath, {'constant_memory': True})
+        self.bold = self.wb.add_format({'bold': True})
+
+    def writeSheet(self, sheetName, textToWrite, blocks, startRow = 4):
+        '''
+        textToWrite is {text: (row, column)} as in ExcelManager.writeTextToSheet. blocks is a list of (df, startMarker, endMarker)
+        written from startRow with a blank row in between. Rows and columns are 1-based
+        '''
+        ws = self.wb.add_worksheet(sheetName)
+        for text, (row, column) in sorted(textToWrite.items(), key = lambda item: item[1]):
+            ws.write(row-1, column-1, text, self.bold)
+        curr_row = startRow
+        for dfToWrite, startMarker, endMarker in blocks:
+            curr_row = self._writeBlock(ws, dfToWrite, curr_row, startMarker, endMarker) + 1
+        return curr_row
+
+    def _writeBlock(self, ws, dfToWrite, startRow, startMarker, endMarker):
+        curr_row = startRow - 1
+        ws.write_string(curr_row, 0, startMarker, self.bold)
+        ws.write_row(curr_row + 1, 0, [str(col_name) for col_name in dfToWrite.columns], self.bold)
+        curr_row += 2
+        for row_data in self.cellValues(dfToWrite):
+            ws.write_row(curr_row, 0, row_data)
+            curr_row += 1
+        ws.write_string(curr_row, 0, endMarker, self.bold)
+        #1-based row after the end marker as returned by ExcelManager.writeDfToSheet
+        return curr_row + 2
+
+    @staticmethod
+    def cellValues(dfToWrite):
+        '''
+        Converts the values column by column before writing: lists and dicts to text, 'True' / 'False' to booleans and missing values to blanks
+        '''
+        df = dfToWrite.astype(object)
+        for column in df.columns:
+            values = df[column]
+            if values.map(lambda value: isinstance(value, (list, dict, tuple))).any():
+                df[column] = values.map(lambda value: str(value) if isinstance(value, (list, dict, tuple)) else value)
+            elif values.isin(['True', 'False']).any():
+                df[column] = values.replace({'True': True, 'False': False})
+        return df.where(df.notna(), None).values.tolist()
+
+    def close(self):
+        with span('io'):
+            self.wb.close()
+
+
 class CsvManager:
     @staticmethod
     def writeDfToCsv(df:pd.DataFrame, filepath:str):
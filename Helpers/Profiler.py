@@ -0,0 +1,144 @@
+import os
+import io
+import json
+import time
+import pstats
+import cProfile
+import threading
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+
+class Profiler:
+    '''
+    Splits the wall-clock time of each stage of a run into LLM wait, file I/O and local CPU (the rest of the time).
+    The LLM connector and the stores mark their calls as spans. Nested spans are counted once in the outermost span.
+    With cprofile the top local functions of a stage are reported. The profiler is paused while waiting on the LLM,
+    so network waits do not hide the local hot spots. With memory the peak traced memory of each stage is reported.
+    Only spans of the thread running the stage are counted, e.g. not those of hedged requests running in the background
+    '''
+    def __init__(self, run_id = None, cprofile = False, memory = False, top = 15):
+        self.run_id = run_id if run_id else datetime.now().strftime('%Y%m%d_%H%M%S') + f'_{os.getpid()}'
+        self.cprofile, self.memory, self.top = cprofile, memory, top
+        self.stages = {}
+        self.current, self.depth, self.profile, self.thread = None, 0, None, None
+
+    @contextmanager
+    def stage(self, name):
+        if self.current is not None:
+            #A stage run inside another stage is profiled as part of it
+            yield
+            return
+        record = self.stages.setdefault(name, {'runs': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'llm_wait_s': 0.0, 'io_s': 0.0,
+                                               'llm_wait_calls': 0, 'io_calls': 0})
+        self.current, self.thread = record, threading.get_ident()
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        if self.cprofile:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            record['runs'] += 1
+            record['wall_s'] += time.perf_counter() - start_wall
+            record['cpu_s'] += time.process_time() - start_cpu
+            if self.profile:
+                self.profile.disable()
+                record['hot_spots'] = self._hotSpots(self.profile)
+                record['profile_stats'] = self._dumpStats(name, self.profile)
+                self.profile = None
+            if self.memory:
+                record['peak_memory_mb'] = max(record.get('peak_memory_mb', 0), round(tracemalloc.get_traced_memory()[1] / 2**20, 1))
+            self.current = None
+
+    @contextmanager
+    def span(self, kind):
+        if self.current is None or self.depth or threading.get_ident() != self.thread:
+            yield
+            return
+        self.depth += 1
+        pause = self.profile if kind == 'llm_wait' else None
+        if pause:
+            pause.disable()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.current[f'{kind}_s'] += time.perf_counter() - start
+            self.current[f'{kind}_calls'] += 1
+            if pause:
+                pause.enable()
+            self.depth -= 1
+
+    def _hotSpots(self, profile):
+        stats = pstats.Stats(profile, stream = io.StringIO())
+        hot_spots = []
+        for (filename, line, function), (_, calls, tottime, cumtime, _) in stats.stats.items():
+            hot_spots.append({'function': f'{self._shortPath(filename)}:{line}({function})',
+                              'calls': calls, 'tottime_s': round(tottime, 3), 'cumtime_s': round(cumtime, 3)})
+        return sorted(hot_spots, key = lambda spot: spot['tottime_s'], reverse = True)[:self.top]
+
+    @staticmethod
+    def _shortPath(filename):
+        #Files of this repo relative to it, libraries from their package e.g. pandas/core/generic.py
+        if filename.startswith(os.getcwd() + os.sep):
+            return os.path.relpath(filename)
+        return filename.split('site-packages' + os.sep)[-1]
+
+    def _dumpStats(self, name, profile):
+        #Full stats for snakeviz or pstats
+        filepath = os.path.join(self._directory(), f'profile_{self.run_id}_{name}.prof')
+        profile.dump_stats(filepath)
+        return filepath
+
+    def _directory(self):
+        directory = os.getenv('METRICS_DIR', 'metrics')
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def report(self):
+        report = {'run_id': self.run_id, 'stages': {}}
+        for name, record in self.stages.items():
+            stage_report = {key: round(value, 3) if isinstance(value, float) else value for key, value in record.items()}
+            stage_report['local_s'] = round(max(0.0, record['wall_s'] - record['llm_wait_s'] - record['io_s']), 3)
+            report['stages'][name] = stage_report
+        return report
+
+    def save(self):
+        filepath = os.path.join(self._directory(), f'profile_{self.run_id}.json')
+        with open(filepath, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        return filepath
+
+    def printReport(self):
+        for name, record in self.report()['stages'].items():
+            print(f"Stage {name}: wall {record['wall_s']}s = llm wait {record['llm_wait_s']}s ({record['llm_wait_calls']} calls)"
+                  f" + io {record['io_s']}s ({record['io_calls']} calls) + local {record['local_s']}s. Process cpu {record['cpu_s']}s"
+                  + (f". Peak memory {record['peak_memory_mb']} MB" if 'peak_memory_mb' in record else ''))
+            for spot in record.get('hot_spots', [])[:5]:
+                print(f"    {spot['tottime_s']}s in {spot['calls']} calls of {spot['function']}")
+
+
+_profiler = None
+
+def getProfiler():
+    return _profiler
+
+def enableProfiling(run_id = None, cprofile = False, memory = False):
+    global _profiler
+    _profiler = Profiler(run_id, cprofile = cprofile, memory = memory)
+    return _profiler
+
+def profileStage(name):
+    return _profiler.stage(name) if _profiler else nullcontext()
+
+def span(kind):
+    '''
+    Marks a call as LLM wait or file I/O. Costs nothing when profiling is off
+    '''
+    return _profiler.span(kind) if _profiler else nullcontext()
@@ -0,0 +1,157 @@
+import re
+import json
+from typing import get_args
+from functools import lru_cache
+from pydantic import ValidationError
+
+
+def stripMarkdown(result):
+    # Clean markdown artifacts
+    result = result.strip()
+    if result.startswith('```json'):
+        result = result.split('```json')[1].split('```')[0].strip()
+    elif result.startswith('```'):
+        result = result.split('```')[1].split('```')[0].strip()
+    return result
+
+
+def repairJson(text):
+    '''
+    Local repair of a JSON response. Drops text before the first and after the last top level bracket, removes trailing
+    commas and, when the response was truncated, cuts back to the last complete element and closes the open brackets
+    '''
+    text = stripMarkdown(text)
+    starts = [index for index in (text.find('{'), text.find('[')) if index >= 0]
+    if not starts:
+        return text
+    text = text[min(starts):]
+    stack, in_string, escape, last_cut = [], False, False, None
+    for index, char in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif char == '\\':
+                escape = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in '{[':
+            stack.append('}' if char == '{' else ']')
+        elif char in '}]':
+            if stack:
+                stack.pop()
+            if not stack:
+                return _removeTrailingCommas(text[:index+1])
+            last_cut = (index+1, list(stack))
+        elif char == ',':
+            last_cut = (index, list(stack))
+    #Truncated response
+    if last_cut:
+        cut, stack = last_cut
+        text = text[:cut]
+    elif in_string:
+        text += '"'
+    return _removeTrailingCommas(text + ''.join(reversed(stack)))
+
+
+def _removeTrailingCommas(text):
+    return re.sub(r',\s*([}\]])', r'\1', text)
+
+
+@lru_cache(maxsize=None)
+def jsonSchema(response_schema):
+    '''
+    JSON schema of a response model, built on first use and cached. The returned dict is shared and must not be changed
+    '''
+    return response_schema.model_json_schema()
+
+
+#Keys of a JSON schema that only document a field. Names, types, enums and required fields are kept
+DOCUMENTATION_KEYS = ('title', 'description', 'default', 'examples')
+
+@lru_cache(maxsize=None)
+def compactSchema(response_schema):
+    '''
+    JSON schema of a response model without the field documentation, which is sent once through fieldGuide instead of on every call
+    '''
+    def strip(node, in_properties = False):
+        if isinstance(node, dict):
+            #Keys of properties and $defs are field and model names, not documentation
+            return {key: strip(value, key in ('properties', '$defs')) for key, value in node.items()
+                    if in_properties or key not in DOCUMENTATION_KEYS}
+        if isinstance(node, list):
+            return [strip(value) for value in node]
+        return node
+    return strip(jsonSchema(response_schema))
+
+
+@lru_cache(maxsize=None)
+def fieldGuide(response_schema):
+    '''
+    The field documentation of a response model and its nested models as text e.g.
+    ExpectedResultLine.unallocated (number): Collateral that is not blocked or allocated ...
+    '''
+    schema = jsonSchema(response_schema)
+    models = [(response_schema.__name__, schema)] + list(schema.get('$defs', {}).items())
+    lines = [f'Field guide of the {response_schema.__name__} response format']
+    for model_name, model_schema in models:
+        for field_name, field_schema in model_schema.get('properties', {}).items():
+            description = ' '.join(field_schema.get('description', '').split())
+            if description:
+                field_type = field_schema.get('type') or field_schema.get('$ref', '').split('/')[-1] or 'any'
+                lines.append(f'{model_name}.{field_name} ({field_type}): {description}')
+    return '\n'.join(lines)
+
+
+def estimateTokens(text):
+    #About 4 characters per token for English and JSON
+    return (len(text) + 3) // 4
+
+
+@lru_cache(maxsize=None)
+def schemaTokensSaved(response_schema):
+    return estimateTokens(json.dumps(jsonSchema(response_schema))) - estimateTokens(json.dumps(compactSchema(response_schema)))
+
+
+@lru_cache(maxsize=None)
+def listField(response_schema):
+    '''
+    Returns the name and element model of the list field (output) of a response model, or (None, None)
+    '''
+    field = response_schema.model_fields.get('output')
+    if field is None:
+        return None, None
+    args = get_args(field.annotation)
+    return ('output', args[0]) if args and hasattr(args[0], 'model_validate') else (None, None)
+
+
+def validateElements(response_schema, data):
+    '''
+    Validates every element of the list field separately.
+    Returns the validated elements (None where invalid) and {index: error} of the invalid ones.
+    errors is None if the response is not a list response or the list itself is missing
+    '''
+    field_name, element_model = listField(response_schema)
+    if field_name is None or not isinstance(data, dict) or not isinstance(data.get(field_name), list):
+        return None, None
+    elements, errors = [], {}
+    for index, element in enumerate(data[field_name]):
+        try:
+            elements.append(element_model.model_validate(element).model_dump())
+        except ValidationError as e:
+            elements.append(None)
+            errors[index] = describeErrors(e)
+    return elements, errors
+
+
+def describeErrors(validation_error):
+    return '; '.join(f"{'.'.join(str(loc) for loc in error['loc'])}: {error['msg']}" for error in validation_error.errors())
+
+
+def elementRepairPrompt(data, errors, field_name = 'output'):
+    invalid = '\n'.join(f'Element {index}: {json.dumps(data[field_name][index])}\nErrors: {error}' for index, error in errors.items())
+    return f'''The following elements of your previous response failed validation against the required format.
+{invalid}
+Return **ONLY** the corrected versions of these {len(errors)} elements, in the same order, as the "{field_name}" list of the required format.
+Keep everything that is not in error unchanged.'''
@@ -0,0 +1,45 @@
+import os
+import hashlib
+from Helpers.Deduplicator import normalizeText
+
+
+def knowledgeBaseDigests(knowledge_base_path):
+    '''
+    Content digest of every file in the knowledge base, keyed by file name
+    '''
+    digests = {}
+    for file_name in sorted(os.listdir(knowledge_base_path)):
+        file_path = os.path.join(knowledge_base_path, file_name)
+        if os.path.isfile(file_path):
+            with open(file_path, 'rb') as f:
+                digests[file_name] = hashlib.sha256(f.read()).hexdigest()
+    return digests
+
+
+def resolveSources(traceability, digests):
+    '''
+    Maps the requirement references of an artifact to the knowledge files they name. When no file can be
+    identified the artifact is treated as derived from the whole knowledge base.
+    Returns {file_name: digest}
+    '''
+    references = normalizeText(traceability if traceability else '')
+    sources = {file_name: digest for file_name, digest in digests.items()
+               if normalizeText(os.path.splitext(file_name)[0]) and normalizeText(os.path.splitext(file_name)[0]) in references}
+    return sources if sources else dict(digests)
+
+
+def computeImpact(artifact_store, knowledge_base_path):
+    '''
+    Finds the scenarios and test cases derived from knowledge files that changed (or were removed) since they were generated.
+    A changed test case is regenerated through its scenario, and the steps and expected output sheets follow the test cases
+    '''
+    digests = knowledgeBaseDigests(knowledge_base_path)
+    changed = artifact_store.changedSources(digests)
+    scenario_ids = {artifact_id for artifact_type, artifact_id in changed if artifact_type == 'scenario'}
+    test_case_ids = [artifact_id for artifact_type, artifact_id in changed if artifact_type == 'test_case']
+    test_case_scenarios = scenario_ids | {str(case['test_scenario_id']) for case in artifact_store.readTestCases(test_case_ids = test_case_ids)}
+    return {
+        'changed_files': artifact_store.changedFiles(digests),
+        'scenarios': sorted(scenario_ids),
+        'test_case_scenarios': sorted(test_case_scenarios)
+    }
@@ -0,0 +1,73 @@
+import random
+from collections import deque
+from Helpers.MetricsRecorder import getMetrics
+
+
+class VerificationPolicy:
+    '''
+    Decides which generated items are sent to the verifier. The modes are
+        all       - verify every item
+        none      - verify nothing
+        sample    - verify a random sample of the items at the given rate
+        heuristic - verify only the items flagged by the agent's local heuristics
+        adaptive  - sample at a rate that follows the rejection rate observed for the stage
+    Items flagged by the heuristics are always verified in the sample and adaptive modes.
+    Every decision and verifier outcome is recorded in the run metrics.
+    '''
+    MODES = ['all', 'none', 'sample', 'heuristic', 'adaptive']
+
+    def __init__(self, mode = 'all', rate = 0.5, stage = '', min_rate = 0.1, max_rate = 1.0, window = 20, warmup = 5, seed = None):
+        if mode not in self.MODES:
+            raise Exception(f'{mode} is an invalid verification mode. It can only be one of {self.MODES}')
+        self.mode, self.rate, self.stage = mode, rate, stage
+        self.min_rate, self.max_rate, self.warmup = min_rate, max_rate, warmup
+        self.outcomes = deque(maxlen = window)
+        self.random = random.Random(seed)
+
+    @classmethod
+    def resolve(cls, verify, stage):
+        '''
+        Accepts the verify argument of the agents - a bool, a policy or a spec such as "sample:0.3" or "adaptive"
+        '''
+        if isinstance(verify, VerificationPolicy):
+            verify.stage = verify.stage if verify.stage else stage
+            return verify
+        if isinstance(verify, bool):
+            return cls('all' if verify else 'none', stage = stage)
+        mode, _, rate = str(verify).partition(':')
+        return cls(mode, rate = float(rate) if rate else 0.5, stage = stage)
+
+    def current_rate(self):
+        if self.mode == 'adaptive':
+            if len(self.outcomes) < self.warmup:
+                return self.max_rate
+            #Verify more while the generator is being rejected, less once the stage is stable
+            rejection_rate = self.outcomes.count(False) / len(self.outcomes)
+            return min(self.max_rate, max(self.min_rate, 4 * rejection_rate))
+        return self.rate
+
+    def should_verify(self, item_id, flagged = False):
+        if self.mode in ['all', 'none']:
+            decision = self.mode == 'all'
+        elif self.mode == 'heuristic':
+            decision = flagged
+        else:
+            decision = flagged or self.random.random() < self.current_rate()
+        metrics = getMetrics()
+        metrics.increment(self.stage, 'verify_considered')
+        metrics.increment(self.stage, 'verify_sampled' if decision else 'verify_skipped')
+        if flagged:
+            metrics.increment(self.stage, 'verify_flagged')
+        metrics.event(self.stage, 'verify_decision', item_id = str(item_id), mode = self.mode, flagged = flagged,
+                      rate = self.current_rate(), verify = decision)
+        return decision
+
+    def record_outcome(self, item_id, accepted):
+        self.outcomes.append(bool(accepted))
+        metrics = getMetrics()
+        metrics.increment(self.stage, 'verify_accepted' if accepted else 'verify_rejected')
+        metrics.event(self.stage, 'verify_outcome', item_id = str(item_id), accepted = bool(accepted))
+
+    @property
+    def enabled(self):
+        return self.mode != 'none'
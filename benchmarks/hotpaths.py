@@ -0,0 +1,282 @@
+'''
+Benchmarks of the local hot paths of the pipeline on synthetic data: workbook writes and block lookups, the artifact store,
+rendering, prompt building, parsing of large responses, deduplication and knowledge base retrieval. Each path is timed
+in isolation (median of the runs) and its peak traced memory is measured in one more run. The results are compared with
+the baseline in hotpaths_baseline.json, which is recorded at the same scale.
+
+    python benchmarks/hotpaths.py                     #compare with the baseline, exits with 1 on a regression or a failed benchmark
+    python benchmarks/hotpaths.py --update            #record the baseline of this machine
+    python benchmarks/hotpaths.py --only=excel_write  #run some of the benchmarks
+    python benchmarks/hotpaths.py --scaling           #also run at twice the scale and flag paths that grow faster than the data
+
+HOTPATH_SCALE (default 1) scales the synthetic data and HOTPATH_RUNS (default 3) sets the timed runs per benchmark
+'''
+import os
+import sys
+import json
+import time
+import itertools
+import statistics
+import tempfile
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hotpaths_baseline.json')
+sys.path.insert(0, ROOT)
+
+from benchmarks.synthetic import syntheticData, knowledgeBase
+import random
+
+
+def stepFrames(data):
+    import pandas as pd
+    return {sheet: (pd.DataFrame(data['steps'][sheet][0]), pd.DataFrame(data['steps'][sheet][1])) for sheet in data['sheets']}
+
+def writeWorkbook(frames, filepath):
+    from Helpers.OutputManager import ExcelManager
+    from Helpers.ArtifactStore import TEST_STEPS_START, TEST_STEPS_END, ALLOCATION_STEPS_START, ALLOCATION_STEPS_END
+    excel = ExcelManager('new', filepath)
+    for sheet, (steps_df, allocation_df) in frames.items():
+        excel.createWorksheet(sheet)
+        excel.writeTextToSheet(sheet, {'Test Case ID': (1,1), sheet: (1,2)})
+        row = excel.writeDfToSheet(sheet, steps_df, 4, TEST_STEPS_START, TEST_STEPS_END)
+        if not allocation_df.empty:
+            excel.writeDfToSheet(sheet, allocation_df, row + 1, ALLOCATION_STEPS_START, ALLOCATION_STEPS_END)
+    excel.save_wb()
+
+def workbook(data, workdir):
+    #Written once and shared by the benchmarks that read it
+    filepath = os.path.join(workdir, 'test_data.xlsx')
+    if not os.path.isfile(filepath):
+        writeWorkbook(stepFrames(data), filepath)
+    return filepath
+
+def artifactStore(data, workdir):
+    from Helpers.ArtifactStore import ArtifactStore
+    filepath = os.path.join(workdir, 'artifacts.db')
+    if not os.path.isfile(filepath):
+        store = ArtifactStore(filepath)
+        store.writeScenarios(data['scenarios'])
+        for scenario_id in dict.fromkeys(case['test_scenario_id'] for case in data['test_cases']):
+            store.writeTestCases(scenario_id, [case for case in data['test_cases'] if case['test_scenario_id'] == scenario_id], status = 'cases_generated')
+        for test_case_id, (steps, allocation_steps) in data['steps'].items():
+            store.writeTestSteps(test_case_id, steps, allocation_steps)
+    return ArtifactStore(filepath)
+
+#-----------------------------------------Benchmarks-----------------------------------------
+#Each benchmark prepares its inputs and returns the function that is timed
+
+def excelWrite(data, workdir):
+    frames, filepath = stepFrames(data), os.path.join(workdir, 'excel_write.xlsx')
+    return lambda: writeWorkbook(frames, filepath)
+
+def excelFindBlocks(data, workdir):
+    from Helpers.OutputManager import ExcelManager
+    from Helpers.ArtifactStore import TEST_STEPS_START, TEST_STEPS_END
+    excel = ExcelManager('modify', workbook(data, workdir))
+    return lambda: [excel.excelToDfConverter(sheet, TEST_STEPS_START, TEST_STEPS_END) for sheet in data['sheets']]
+
+def excelLoad(data, workdir):
+    from Helpers.OutputManager import ExcelManager
+    filepath = workbook(data, workdir)
+    return lambda: ExcelManager('modify', filepath)
+
+def excelReadBlocks(data, workdir):
+    from Helpers.OutputManager import ExcelManager
+    filepath = workbook(data, workdir)
+    return lambda: ExcelManager.readSheetBlocks(filepath)
+
+def storeWriteSteps(data, workdir):
+    #One transaction per test case as in the stp stage
+    store = artifactStore(data, workdir)
+    return lambda: [store.writeTestSteps(sheet, *data['steps'][sheet]) for sheet in data['sheets']]
+
+def storeRead(data, workdir):
+    store = artifactStore(data, workdir)
+    return lambda: (store.readTestCases(), [store.readTestSteps(sheet) for sheet in data['sheets']])
+
+def renderWorkbook(data, workdir):
+    store, filepath = artifactStore(data, workdir), os.path.join(workdir, 'rendered.xlsx')
+    return lambda: store.renderTestDataWorkbook(filepath, data['sheets'])
+
+def promptRender(data, workdir, static_prefix = False):
+    import pandas as pd
+    from Agents.TestStepsAgent import TestStepAgent
+    #The agent is used without its LLM clients
+    agent = TestStepAgent.__new__(TestStepAgent)
+    agent.copy_model_configs()
+    agent.generate_model_config.static_prefix = agent.verify_model_config.static_prefix = static_prefix
+    def run():
+        for case in data['test_cases']:
+            values = agent.test_case_values(case)
+            agent.item_prompt(agent.generate_model_config, **values)
+            steps_json = pd.DataFrame(data['steps'][case['test_case_id']][0]).to_json()
+            agent.item_prompt(agent.verify_model_config, **values, test_steps = steps_json)
+    return run
+
+def responseParse(data, workdir):
+    from Agents.Agent import LLMClient
+    from Agents.TestOutputAgent import ExpectedResult
+    #The parsing of LLMClient without its connectors
+    client = LLMClient.__new__(LLMClient)
+    text = json.dumps(data['expected_result'], indent=2)
+    return lambda: client._parse_response(text, ExpectedResult, '')
+
+def responseRepair(data, workdir):
+    from Agents.LLMConnector import LLMConnector
+    from Agents.TestOutputAgent import ExpectedResult
+    #Local repair of a truncated response by the connector, without a connection
+    connector = LLMConnector.__new__(LLMConnector)
+    connector.stage = 'bench.repair'
+    text = json.dumps(data['expected_result'], indent=2)
+    text = text[:int(len(text) * 0.9)]
+    return lambda: connector._validate_ollama(text, ExpectedResult)
+
+def jsonlRoundTrip(data, workdir):
+    from Helpers.IntermediateStore import JsonlStore
+    from Agents.TestCasesAgent import TestCase
+    store = JsonlStore(os.path.join(workdir, 'test_cases.jsonl'), TestCase)
+    return lambda: (store.write(data['test_cases']), store.read(validate = True))
+
+def dedupScenarios(data, workdir):
+    from Helpers.Deduplicator import NearDuplicateDetector, dimensionKey
+    def run():
+        detector = NearDuplicateDetector('scenario_id', ['scenario_description'], key_function = lambda scenario: dimensionKey(scenario['scenario_dimension']))
+        return detector.filter(data['scenarios'], mode = 'flag', stage = 'bench.dedup')
+    return run
+
+def knowledgeIndexBuild(data, workdir):
+    from Helpers.KnowledgeIndex import KnowledgeIndex
+    knowledge_base_path = knowledgeBase(os.path.join(workdir, 'knowledge'), data['sizes']['knowledge_files'], data['sizes']['knowledge_lines'], random.Random(7))
+    #A new index directory per run so that the index is built and not loaded
+    runs = itertools.count()
+    return lambda: KnowledgeIndex(knowledge_base_path, index_directory = os.path.join(workdir, f'index_{next(runs)}'))
+
+def knowledgeSearch(data, workdir):
+    from Helpers.KnowledgeIndex import KnowledgeIndex
+    knowledge_base_path = knowledgeBase(os.path.join(workdir, 'knowledge'), data['sizes']['knowledge_files'], data['sizes']['knowledge_lines'], random.Random(7))
+    index = KnowledgeIndex(knowledge_base_path, index_directory = os.path.join(workdir, 'index'))
+    return lambda: [index.context(query, 8) for query in data['queries']]
+
+BENCHMARKS = {
+    'excel_write': excelWrite,
+    'excel_find_blocks': excelFindBlocks,
+    'excel_load': excelLoad,
+    'excel_read_blocks': excelReadBlocks,
+    'store_write_steps': storeWriteSteps,
+    'store_read': storeRead,
+    'render_workbook': renderWorkbook,
+    'prompt_render': promptRender,
+    'prompt_render_static': lambda data, workdir: promptRender(data, workdir, static_prefix = True),
+    'response_parse': responseParse,
+    'response_repair': responseRepair,
+    'jsonl_round_trip': jsonlRoundTrip,
+    'dedup_scenarios': dedupScenarios,
+    'knowledge_index_build': knowledgeIndexBuild,
+    'knowledge_search': knowledgeSearch,
+}
+
+
+def measure(benchmark, data, workdir, runs):
+    run = benchmark(data, workdir)
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'time_s': round(statistics.median(times), 4), 'peak_mb': round(peak / 2**20, 2)}
+
+def runBenchmarks(names, scale = 1.0, runs = 3):
+    data = syntheticData(scale)
+    print(f"Synthetic data at scale {scale}: {len(data['scenarios'])} scenarios, {len(data['test_cases'])} test cases, "
+          f"{sum(len(steps) for steps, _ in data['steps'].values())} steps, {len(data['sheets'])} sheets, "
+          f"{len(data['expected_result']['output'])} expected output lines")
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in names:
+            try:
+                results[name] = measure(BENCHMARKS[name], data, workdir, runs)
+            except Exception as e:
+                #A benchmark that no longer runs is a regression and not a skipped measurement
+                results[name] = {'error': f'{type(e).__name__}: {e}'}
+    return results
+
+def compare(results, baseline, time_tolerance = 0.5, slack_s = 0.02, memory_tolerance = 0.25, slack_mb = 1):
+    regressions = []
+    for name, result in results.items():
+        expected = baseline.get(name, {})
+        if 'error' in result:
+            regressions.append(name)
+            print(f"{name:26} failed: {result['error']}")
+            continue
+        status = 'ok'
+        if expected and result['time_s'] > expected['time_s'] * (1 + time_tolerance) + slack_s:
+            status = f"slower than the baseline {expected['time_s']}s"
+        elif expected and result['peak_mb'] > expected['peak_mb'] * (1 + memory_tolerance) + slack_mb:
+            status = f"more memory than the baseline {expected['peak_mb']} MB"
+        if status != 'ok':
+            regressions.append(name)
+        print(f"{name:26} {result['time_s']:>9}s {result['peak_mb']:>9} MB  baseline {expected.get('time_s')}s "
+              f"{expected.get('peak_mb')} MB  {status}")
+    return regressions
+
+def compareScaling(results, doubled, limit = 3.0):
+    '''
+    Flags the paths whose time grows more than limit times when the data doubles e.g. quadratic loops grow 4 times
+    '''
+    superlinear = []
+    for name, result in doubled.items():
+        if name not in results or 'error' in results[name]:
+            continue
+        if 'error' in result:
+            superlinear.append(name)
+            print(f"{name:26} failed for twice the data: {result['error']}")
+            continue
+        growth = result['time_s'] / max(results[name]['time_s'], 1e-4)
+        status = 'ok'
+        #Paths that take a few ms are too noisy to judge
+        if growth > limit and result['time_s'] > 0.05:
+            status = 'grows faster than the data'
+            superlinear.append(name)
+        print(f'{name:26} x{growth:.2f} for twice the data  {status}')
+    return superlinear
+
+
+if __name__ == '__main__':
+    scale, runs = float(os.getenv('HOTPATH_SCALE', 1)), int(os.getenv('HOTPATH_RUNS', 3))
+    only = [arg.split('=', 1)[1].split(',') for arg in sys.argv[1:] if arg.startswith('--only=')]
+    names = only[0] if only else list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        raise Exception(f'Unknown benchmarks {unknown}. They can only be {list(BENCHMARKS)}')
+    results = runBenchmarks(names, scale, runs)
+    baseline = {}
+    if os.path.isfile(BASELINE_FILE):
+        with open(BASELINE_FILE, 'r') as f:
+            baseline = json.load(f)
+    if '--update' in sys.argv:
+        #A failed benchmark keeps its previous baseline
+        measured = {name: result for name, result in results.items() if 'error' not in result}
+        baseline = {'scale': scale, 'benchmarks': {**baseline.get('benchmarks', {}), **measured}} if baseline.get('scale') == scale else \
+                   {'scale': scale, 'benchmarks': measured}
+        with open(BASELINE_FILE, 'w') as f:
+            json.dump(baseline, f, indent=2)
+        print(f'Baseline written to {BASELINE_FILE}')
+    if baseline and baseline.get('scale') != scale:
+        print(f"The baseline was recorded at scale {baseline.get('scale')} and is not compared at scale {scale}")
+        baseline = {}
+    regressions = compare(results, baseline.get('benchmarks', {}))
+    failed = [name for name, result in results.items() if 'error' in result]
+    if '--scaling' in sys.argv:
+        doubled = runBenchmarks(names, scale * 2, runs)
+        regressions += compareScaling(results, doubled)
+        failed += [name for name, result in doubled.items() if 'error' in result]
+    if failed or (regressions and '--update' not in sys.argv):
+        print(f"Hot path regressions in: {', '.join(regressions)}")
+        sys.exit(1)
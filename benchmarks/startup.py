@@ -0,0 +1,111 @@
+'''
+Cold start benchmark of the main.py commands. Each command's imports are timed in fresh interpreters with -X importtime
+and compared with the baseline in startup_baseline.json. Heavy modules a command must not load are checked as well.
+
+    python benchmarks/startup.py              #compare with the baseline, exits with 1 on a regression or a failed import
+    python benchmarks/startup.py --update     #record the baseline of this machine
+'''
+import os
+import sys
+import json
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'startup_baseline.json')
+
+#Code that loads what a command needs before it does any work
+COMMANDS = {
+    'main': 'import main',
+    'dim': "import main; main.agentClass('dim')",
+    'sen': "import main; main.agentClass('sen')",
+    'cas': "import main; main.agentClass('cas')",
+    'stp': "import main; main.agentClass('stp')",
+    'out': "import main; main.agentClass('out')",
+    'cov': 'import main; import Helpers.ArtifactStore, Helpers.CoverageAnalyzer',
+    'render': 'import main; import Helpers.ArtifactStore',
+    'impact': 'import main; import Helpers.ArtifactStore, Helpers.Traceability, Helpers.KnowledgeBaseProvider',
+    'shard': 'import main; import Helpers.LeaseCoordinator',
+    'deletecache': 'import Agents.LLMConnector',
+}
+
+#google.genai is imported only when a gemini connector is created
+FORBIDDEN = {
+    'main': ['google.genai', 'pandas', 'openpyxl', 'pydantic'],
+    'shard': ['google.genai', 'pandas'],
+    'cov': ['google.genai', 'openpyxl'],
+    'render': ['google.genai'],
+    'impact': ['google.genai'],
+    'deletecache': ['google.genai', 'pandas'],
+    **{stage: ['google.genai'] for stage in ['dim', 'sen', 'cas', 'stp', 'out']},
+}
+
+
+def measure(code):
+    '''
+    Returns the total import time in ms and the names of the imported modules of one fresh interpreter
+    '''
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd = ROOT, capture_output = True, text = True)
+    if result.returncode != 0:
+        raise Exception(result.stderr.strip().splitlines()[-1])
+    total_us, modules = 0, set()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.add(name.strip())
+        #Top level imports are not indented and their cumulative time includes the nested ones
+        if not name[1:].startswith(' '):
+            total_us += int(cumulative)
+    return total_us / 1000, modules
+
+def runBenchmark(runs = 5):
+    results = {}
+    for command, code in COMMANDS.items():
+        try:
+            samples = [measure(code) for _ in range(runs)]
+        except Exception as e:
+            #A command that no longer imports is a regression and not a skipped measurement
+            results[command] = {'error': str(e)}
+            continue
+        modules = samples[0][1]
+        results[command] = {'import_ms': round(statistics.median(sample[0] for sample in samples), 1), 'modules': len(modules),
+                            'forbidden': [name for name in FORBIDDEN.get(command, []) if name in modules]}
+    return results
+
+def compare(results, baseline, tolerance = 0.25, slack_ms = 20):
+    regressions = []
+    for command, result in results.items():
+        expected = baseline.get(command)
+        if 'error' in result:
+            regressions.append(command)
+            print(f"{command:12} failed to import: {result['error']}")
+            continue
+        limit = expected * (1 + tolerance) + slack_ms if expected else None
+        status = 'ok'
+        if result['forbidden']:
+            status = f"imports {', '.join(result['forbidden'])}"
+        elif limit and result['import_ms'] > limit:
+            status = f'slower than the baseline {expected} ms'
+        if status != 'ok':
+            regressions.append(command)
+        print(f"{command:12} {result['import_ms']:>9} ms  {result['modules']:>5} modules  baseline {expected} ms  {status}")
+    return regressions
+
+
+if __name__ == '__main__':
+    results = runBenchmark(int(os.getenv('STARTUP_RUNS', 5)))
+    baseline = {}
+    if os.path.isfile(BASELINE_FILE):
+        with open(BASELINE_FILE, 'r') as f:
+            baseline = json.load(f)
+    if '--update' in sys.argv:
+        baseline = {command: result['import_ms'] if 'error' not in result else baseline.get(command) for command, result in results.items()}
+        with open(BASELINE_FILE, 'w') as f:
+            json.dump(baseline, f, indent=2)
+        print(f'Baseline written to {BASELINE_FILE}')
+    regressions = compare(results, baseline)
+    failed = [command for command, result in results.items() if 'error' in result]
+    if failed or (regressions and '--update' not in sys.argv):
+        print(f"Start-up regressions in: {', '.join(regressions)}")
+        sys.exit(1)
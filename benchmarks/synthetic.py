@@ -0,0 +1,110 @@
+'''
+Synthetic artifacts of the pipeline for the hot path benchmarks: scenarios, test cases, test steps with allocation lines,
+expected output payloads and a knowledge base. Sizes scale linearly with scale and the data is the same for a given seed.
+'''
+import os
+import random
+
+SEGMENTS = ['CM', 'FNO', 'CD', 'COM', 'SLB']
+COLLATERAL_TYPES = ['CASH', 'FD', 'BG', 'GSEC', 'EQ']
+EVENTS = ['Deposit', 'Withdraw', 'Invoke', 'Transfer', 'Renew', 'Allocation']
+DIMENSIONS = {'member_type': ['CM', 'TM', 'CP', 'CLI'], 'segment': SEGMENTS, 'collateral_type': COLLATERAL_TYPES,
+              'event': EVENTS, 'sufficiency': ['sufficient', 'insufficient', 'exact']}
+WORDS = ('collateral allocation member segment deposit withdraw margin requirement cash fixed deposit bank guarantee securities '
+         'haircut valuation limit exposure compliance cushion blocked lent borrowed payin payout settlement clearing trading '
+         'custodial client fungible transfer renewal release invoke priority rule static master').split()
+
+#Sizes at scale 1
+SIZES = {'scenarios': 1000, 'test_cases_per_scenario': 1, 'steps_per_test_case': 8, 'sheets': 100, 'expected_lines': 2000,
+         'knowledge_files': 6, 'knowledge_lines': 2000, 'queries': 200}
+
+
+def sizes(scale = 1.0):
+    return {name: max(1, int(size * scale)) if name not in ('test_cases_per_scenario', 'steps_per_test_case', 'knowledge_files') else size
+            for name, size in SIZES.items()}
+
+def sentence(generator, words = 12):
+    return ' '.join(generator.choice(WORDS) for _ in range(words))
+
+def scenarios(count, generator):
+    records = []
+    for num in range(1, count + 1):
+        dimension = [{'dimension': name, 'value': generator.choice(values)} for name, values in DIMENSIONS.items()]
+        description = ', '.join(f"{value['dimension']} {value['value']}" for value in dimension) + '. ' + sentence(generator, 20)
+        records.append({'scenario_id': f'SC-{num:04}', 'scenario_description': description, 'scenario_dimension': dimension,
+                        'traceability': 'Requirements.md#allocation'})
+    return records
+
+def testCases(scenario_records, per_scenario, generator):
+    records = []
+    for scenario in scenario_records:
+        for num in range(1, per_scenario + 1):
+            records.append({'test_scenario_id': scenario['scenario_id'], 'target_scenario': scenario['scenario_description'],
+                            'test_case_id': f"{scenario['scenario_id']}-TC-{num:04}", 'given': sentence(generator),
+                            'given_steps': '\n'.join(sentence(generator) for _ in range(4)), 'when': sentence(generator),
+                            'when_steps': '\n'.join(sentence(generator) for _ in range(3)), 'then': sentence(generator, 20),
+                            'memberCode': f'A{generator.randint(1, 999):03}', 'traceability': 'Requirements.md#allocation'})
+    return records
+
+def testSteps(test_case_id, count, generator):
+    '''
+    Returns the steps without their allocation lines and the allocation lines, as written to the artifact store
+    '''
+    steps, allocation_steps = [], []
+    for step in range(1, count + 1):
+        event = generator.choice(EVENTS)
+        collateral_type = 'CASH' if event == 'Allocation' else generator.choice(COLLATERAL_TYPES)
+        amount = round(generator.uniform(1e4, 1e7), 2)
+        steps.append({'test_case_id': test_case_id, 'step': step, 'memberCode': f'A{step:03}', 'segment': generator.choice(SEGMENTS),
+                      'addReduce': generator.choice(['Add', 'Reduce']), 'collateralType': collateral_type, 'event': event,
+                      'collateralGroup': 'CG01', 'collateralComponent': 'CC01', 'isFungible': generator.choice(['True', 'False']),
+                      'currency': 'INR', 'amount': amount, 'amountInWords': sentence(generator, 6), 'bank': 'IDFC', 'account': 'ACC0001',
+                      'instrumentNo': generator.randint(100000, 999999), 'branch': 'Mumbai', 'isElectronic': 'False', 'quantity': 0,
+                      'isin': '', 'price': 0.0, 'value': 0.0, 'newInstrumentNo': 0, 'toSegment': '',
+                      'pass_fail': generator.choice(['PASS', 'FAIL']), 'reason': sentence(generator, 8)})
+        if event == 'Allocation':
+            for _ in range(generator.randint(1, 4)):
+                allocation_steps.append({'step': step, 'cmCode': 'CM001', 'segment': generator.choice(SEGMENTS), 'tmCode': 'TM001',
+                                         'cpCode': '', 'cliCode': 'CLI001', 'txn_type': generator.choice(['Allocate', 'De-allocate']),
+                                         'amt': amount, 'cum_amt': amount, 'exp_amt': amount, 'trfToSeg': '', 'pass_fail': 'PASS', 'reason': ''})
+    return steps, allocation_steps
+
+def expectedResult(count, generator):
+    '''
+    An ExpectedResult payload of count lines, the largest response of the pipeline
+    '''
+    lines = []
+    for num in range(count):
+        total = round(generator.uniform(1e5, 1e8), 2)
+        lines.append({'step': num // 10 + 1, 'memberCode': f'A{num % 50:03}', 'segmentGroup': 'SG01', 'segment': generator.choice(SEGMENTS),
+                      'purposeOfDeposit': 'Margin', 'collateralGroup': 'CG01', 'collateralComponent': 'CC01',
+                      'isFungible': generator.choice(['True', 'False']), 'currency': 'INR', 'applicable_limits': 'L1',
+                      'totalCollateralAmount': total, 'mlnBlockedAmount': total * 0.1, 'mlnLentAmount': 0.0, 'mlnBorrowedAmount': 0.0,
+                      'obComplianceAmount': total * 0.05, 'obCapitalCushionAmount': total * 0.05, 'obPayinAdjustmentAmount': 0.0,
+                      'obPayinLent': 0.0, 'obPayinBorrowed': 0.0, 'allocated': total * 0.5, 'allocatedLent': 0.0, 'allocatedBorrowed': 0.0,
+                      'unallocated': total * 0.3})
+    return {'output': lines, 'reason': sentence(generator, 30)}
+
+def knowledgeBase(directory, files, lines, generator):
+    '''
+    Writes knowledge base files of rules and master rows into directory and returns it
+    '''
+    os.makedirs(directory, exist_ok=True)
+    for num in range(files):
+        with open(os.path.join(directory, f'knowledge_{num}.md'), 'w', encoding='utf-8') as f:
+            for line in range(lines):
+                if line % 3:
+                    f.write(f"| A{line:04} | {generator.choice(SEGMENTS)} | {generator.choice(COLLATERAL_TYPES)} | {generator.randint(1, 10**7)} |\n")
+                else:
+                    f.write(f'Rule {num}.{line}: {sentence(generator, 25)}\n')
+    return directory
+
+def syntheticData(scale = 1.0, seed = 7):
+    generator, size = random.Random(seed), sizes(scale)
+    scenario_records = scenarios(size['scenarios'], generator)
+    test_case_records = testCases(scenario_records, size['test_cases_per_scenario'], generator)
+    steps = {case['test_case_id']: testSteps(case['test_case_id'], size['steps_per_test_case'], generator) for case in test_case_records}
+    return {'sizes': size, 'scenarios': scenario_records, 'test_cases': test_case_records, 'steps': steps,
+            'sheets': [case['test_case_id'] for case in test_case_records[:size['sheets']]],
+            'expected_result': expectedResult(size['expected_lines'], generator),
+            'queries': [sentence(generator, 10) for _ in range(size['queries'])]}
@@ -3,8 +3,9 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+#Deletes the registered caches that have expired or are no longer used by a running process
 connector = LLMConnector('gemini', 'gemini-2.5-pro', "", 'Cash Allocation', 'generator')
-connector.cleanup_files()
+connector.purge_caches()
 
 connector = LLMConnector('gemini', 'gemini-2.5-pro', "", 'Cash Allocation', 'verifier')
-connector.cleanup_files()
\ No newline at end of file
+connector.purge_caches()
@@ -1,54 +1,415 @@
 from dotenv import load_dotenv
-from Agents.TestScenariosAgent import TestScenarioAgent
-from Agents.TestDimensionsAgent import TestDimensionAgent
-from Agents.TestCasesAgent import TestCaseAgent
-from Agents.TestStepsAgent import TestStepAgent
-from Agents.TestOutputAgent import TestOutputAgent
-from Helpers.TestScenarioGenerator import TestScenarioGenerator
+from Helpers.MetricsRecorder import getMetrics
+from Helpers.Profiler import enableProfiling, getProfiler, profileStage
+from Helpers.ModuleWorkspace import useModuleWorkspace
+from Helpers.LeaseCoordinator import LeaseCoordinator
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import importlib
+import threading
+import socket
+import json
+import time
 import sys
 import os
 
 load_dotenv()
 
-def generateDimensions():
+DEFAULT_MODULE = "Cash Allocation"
+
+#Agents are imported only when their stage runs, so each command loads just the dependencies it needs
+#e.g. google.genai, pandas and the response models of the other stages are not imported for cov or render
+STAGE_AGENTS = {'dim': ('Agents.TestDimensionsAgent', 'TestDimensionAgent'), 'sen': ('Agents.TestScenariosAgent', 'TestScenarioAgent'),
+                'cas': ('Agents.TestCasesAgent', 'TestCaseAgent'), 'stp': ('Agents.TestStepsAgent', 'TestStepAgent'),
+                'out': ('Agents.TestOutputAgent', 'TestOutputAgent')}
+
+#Knowledge base chunks retrieved per item by the generators of cas, stp and out. Set by --retrieve
+retrieval_k = 0
+#Output formats without field descriptions on each call. Set by --compact-schema
+compact_schema = False
+#Role and task instructions of cas, stp and out sent once per stage. Set by --static-prefix
+static_prefix = False
+#Hedging policy of the LLM requests of all stages. Set by --hedge
+hedge = None
+#Input token budget of the configured models. Set by --token-budget
+token_budget = None
+
+def setModelOptions(options):
+    '''
+    Sets the model options above from a dict of their values. Module processes get the options of the command this way,
+    as the values set by the command line are not inherited by processes that are spawned instead of forked
+    '''
+    global retrieval_k, compact_schema, static_prefix, hedge, token_budget
+    retrieval_k, compact_schema, static_prefix = options['retrieval_k'], options['compact_schema'], options['static_prefix']
+    hedge, token_budget = options['hedge'], options['token_budget']
+
+def modelOptions():
+    return {'retrieval_k': retrieval_k, 'compact_schema': compact_schema, 'static_prefix': static_prefix, 'hedge': hedge, 'token_budget': token_budget}
+
+def agentClass(stage):
+    module_name, class_name = STAGE_AGENTS[stage]
+    return getattr(importlib.import_module(module_name), class_name)
+
+def createAgent(stage, test_module = DEFAULT_MODULE):
+    agent = agentClass(stage)(test_module)
+    if stage in ('cas', 'stp', 'out'):
+        agent.generate_model_config.retrieval_k = retrieval_k
+        agent.generate_model_config.static_prefix = agent.verify_model_config.static_prefix = static_prefix
+    agent.generate_model_config.compact_schema = agent.verify_model_config.compact_schema = compact_schema
+    agent.generate_model_config.hedge = agent.verify_model_config.hedge = hedge
+    agent.generate_model_config.token_budget = agent.verify_model_config.token_budget = token_budget
+    return agent
+
+def generateDimensions(test_module = DEFAULT_MODULE):
     print(f'Generating Test Dimensions \n')
-    test_dim_agent = TestDimensionAgent("Cash Allocation")
-    test_dim_agent.execute()
+    with profileStage('dim'):
+        test_dim_agent = createAgent('dim', test_module)
+        test_dim_agent.execute()
 
-def generateScenarios():
+def generateScenarios(dedup = 'drop', gaps_only = False, test_module = DEFAULT_MODULE):
     print(f'Generating Test Scenarios \n')
     # scenario_gen = TestScenarioGenerator()
     # scenario_gen.generateScenarios()
-    test_sc_agent = TestScenarioAgent("Cash Allocation")
-    test_sc_agent.execute()
+    with profileStage('sen'):
+        test_sc_agent = createAgent('sen', test_module)
+        test_sc_agent.execute(dedup = dedup, gaps_only = gaps_only)
 
-def generateTestCases(start, end, gen_instruct):
+def generateTestCases(start, end, gen_instruct, verify = False, dedup = 'drop', gaps_only = False, test_module = DEFAULT_MODULE):
     print(f'Generating Test Cases \n')
-    test_cs_agent = TestCaseAgent("Cash Allocation")
-    test_cs_agent.execute(start = start, end = end, gen_instruct = gen_instruct)
+    with profileStage('cas'):
+        test_cs_agent = createAgent('cas', test_module)
+        test_cs_agent.execute(start = start, end = end, gen_instruct = gen_instruct, verify = verify, dedup = dedup, gaps_only = gaps_only)
 
-def generateTestSteps(start, end):
+def generateTestSteps(start, end, verify = True, test_module = DEFAULT_MODULE):
     print(f'Generating Test Steps \n')
-    test_st_agent = TestStepAgent("Cash Allocation")
-    test_st_agent.execute(start, end)
+    with profileStage('stp'):
+        test_st_agent = createAgent('stp', test_module)
+        test_st_agent.execute(start, end, verify = verify)
 
-def generateTestOutput(sheets=None):
+def generateTestOutput(sheets=None, verify = False, test_module = DEFAULT_MODULE):
     print(f'Generating Test Output \n')
-    test_ot_agent = TestOutputAgent(test_module="Cash Allocation")
-    test_ot_agent.execute(sheets=sheets)
+    with profileStage('out'):
+        test_ot_agent = createAgent('out', test_module)
+        test_ot_agent.execute(sheets=sheets, verify = verify)
+
+def runModulePipeline(test_module, stages, verify = None, dedup = 'drop', profile = None, model_options = None):
+    '''
+    Runs the stages of one module in its own workspace. Executed in a separate process for each module by runModules.
+    model_options are the values of modelOptions() in the process that started the run
+    '''
+    useModuleWorkspace(test_module)
+    if model_options is not None:
+        setModelOptions(model_options)
+    if profile is not None:
+        enableProfiling(cprofile = 'cpu' in profile, memory = 'mem' in profile)
+    start_time, completed, status, error = time.perf_counter(), [], 'done', ''
+    try:
+        for stage in stages:
+            match stage:
+                case 'dim':
+                    generateDimensions(test_module)
+                case 'sen':
+                    generateScenarios(dedup = dedup, test_module = test_module)
+                case 'cas':
+                    generateTestCases(1, -1, '', verify = verify if verify else False, dedup = dedup, test_module = test_module)
+                case 'stp':
+                    generateTestSteps(1, -1, verify = verify if verify else True, test_module = test_module)
+                case 'out':
+                    generateTestOutput(verify = verify if verify else False, test_module = test_module)
+                case 'regen':
+                    regenerateChanged(test_module, verify = verify)
+                case _:
+                    raise Exception(f'{stage} is an invalid stage')
+            completed.append(stage)
+    except Exception as e:
+        status, error = 'failed', f'{type(e).__name__}: {e}'
+    metrics = getMetrics()
+    counters = metrics.summary()['counters']
+    return {'module': test_module, 'status': status, 'completed': ','.join(completed),
+            'duration_s': round(time.perf_counter() - start_time, 1),
+            'llm_calls': sum(stage_counters.get('calls', 0) for stage_counters in counters.values()),
+            'escalations': sum(stage_counters.get('escalations', 0) for stage_counters in counters.values()),
+            'metrics': metrics.save(), 'profile': getProfiler().save() if getProfiler() else '', 'error': error}
+
+def runModules(modules, stages, verify = None, dedup = 'drop', profile = None, model_options = None):
+    '''
+    Runs the pipelines of the modules in parallel processes and reports an aggregate summary
+    '''
+    import pandas as pd
+    results = []
+    with ProcessPoolExecutor(max_workers = len(modules)) as executor:
+        futures = {executor.submit(runModulePipeline, test_module, stages, verify, dedup, profile, model_options): test_module for test_module in modules}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {'module': futures[future], 'status': 'failed', 'error': f'{type(e).__name__}: {e}'}
+            print(f"Module {result['module']}: {result['status']} {result.get('error', '')}")
+            results.append(result)
+    print(pd.DataFrame(results).to_string(index=False))
+    summary_path = os.path.join(os.getenv('METRICS_DIR', 'metrics'), f'modules_{getMetrics().run_id}.json')
+    os.makedirs(os.path.dirname(summary_path), exist_ok=True)
+    with open(summary_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Module summary written to {summary_path}')
+    return results
+
+#Stages that can be sharded: the output file of a shard and the table of the items that are split
+SHARD_STAGES = {'cas': ('TEST_CASES_FILE', 'scenarios'), 'stp': ('TEST_DATA_FILE', 'test_cases')}
+
+def planShards(test_module, stage, start, end, shard_size, verify = None, dedup = 'drop', module_workspace = False):
+    '''
+    module_workspace is True when the run is planned in the workspace of its module (--module), which the workers and the merge then use
+    '''
+    from Helpers.ArtifactStore import ArtifactStore
+    if stage not in SHARD_STAGES:
+        raise Exception(f'{stage} cannot be sharded. Only cas and stp can')
+    if end < 0:
+        end = ArtifactStore().count(SHARD_STAGES[stage][1])
+    run_id = LeaseCoordinator().plan(test_module, stage, start, end, shard_size, {'verify': verify, 'dedup': dedup, 'module_workspace': module_workspace})
+    print(f'Planned shard run {run_id}: {stage} {start}..{end} in shards of {shard_size}')
+    return run_id
+
+def useRunWorkspace(run, test_module = None):
+    '''
+    Enters the workspace the run was planned in. test_module is the --module of the command, whose workspace is already in use
+    '''
+    module_workspace = run['params'].get('module_workspace', False)
+    if test_module and (test_module != run['module'] or not module_workspace):
+        raise Exception(f"Shard run {run['run_id']} was planned for {run['module'] if module_workspace else 'the default workspace'} and not for module {test_module}")
+    if module_workspace and not test_module:
+        useModuleWorkspace(run['module'])
+
+def shardWorkspace(run_id, shard):
+    return os.path.join(os.getenv('SHARD_DIR', 'shards'), run_id, f'{shard:04d}')
+
+def runShard(agent, run, lease):
+    '''
+    Runs one shard in its own workspace with a snapshot of the artifact store and its own output file. The workspace is the shard output
+    '''
+    from Helpers.ArtifactStore import ArtifactStore
+    workspace = shardWorkspace(run['run_id'], lease['shard'])
+    os.makedirs(workspace, exist_ok=True)
+    output_env_var = SHARD_STAGES[run['stage']][0]
+    base_env = {env_var: os.getenv(env_var) for env_var in [output_env_var, 'ARTIFACT_DB']}
+    ArtifactStore().snapshot(os.path.join(workspace, 'artifacts.db'))
+    os.environ['ARTIFACT_DB'] = os.path.join(workspace, 'artifacts.db')
+    os.environ[output_env_var] = os.path.join(workspace, os.path.basename(base_env[output_env_var]))
+    try:
+        agent.artifact_store = ArtifactStore()
+        agent.reset_run_state()
+        verify = run['params']['verify']
+        with profileStage(run['stage']):
+            if run['stage'] == 'cas':
+                agent.execute(lease['start'], lease['end'], verify = verify if verify else False, dedup = run['params']['dedup'])
+            else:
+                agent.execute(lease['start'], lease['end'], verify = verify if verify else True, cleanup = False)
+    finally:
+        for env_var, value in base_env.items():
+            if value is None:
+                os.environ.pop(env_var, None)
+            else:
+                os.environ[env_var] = value
+    return workspace
+
+def workShards(run_id, lease_seconds = 900, test_module = None):
+    '''
+    Claims and runs the shards of a run till every shard is done or given up. A heartbeat keeps the lease of the running shard
+    '''
+    coordinator = LeaseCoordinator()
+    run = coordinator.getRun(run_id)
+    useRunWorkspace(run, test_module)
+    worker, agent = f'{socket.gethostname()}:{os.getpid()}', None
+    while True:
+        lease = coordinator.claim(run_id, worker, lease_seconds)
+        if lease is None:
+            if coordinator.isFinished(run_id):
+                break
+            #Shards leased by other workers are reassigned if their lease expires
+            time.sleep(min(30, lease_seconds / 3))
+            continue
+        print(f"Worker {worker} running shard {lease['shard']} ({lease['start']}..{lease['end']}) attempt {lease['attempts']}")
+        stop = threading.Event()
+        def keepLease():
+            while not stop.wait(lease_seconds / 3):
+                if not coordinator.heartbeat(run_id, lease['shard'], worker, lease_seconds):
+                    print(f"Lease of shard {lease['shard']} was lost")
+                    return
+        threading.Thread(target = keepLease, daemon = True).start()
+        try:
+            if agent is None:
+                agent = createAgent(run['stage'], run['module'])
+            output_path = runShard(agent, run, lease)
+            stop.set()
+            if not coordinator.complete(run_id, lease['shard'], worker, output_path):
+                print(f"Shard {lease['shard']} was reassigned while running and its output is discarded")
+        except Exception as e:
+            stop.set()
+            print(f"Shard {lease['shard']} failed: {type(e).__name__}: {e}")
+            coordinator.fail(run_id, lease['shard'], worker, f'{type(e).__name__}: {e}')
+    if agent:
+        agent.generate_llm_client.cleanup_files()
+        agent.verify_llm_client.cleanup_files()
+    print(f'Shard run {run_id}: {coordinator.progress(run_id)}')
+
+def mergeShards(run_id, test_module = None):
+    '''
+    Merges the completed shards in shard order into the artifact store and renders the stage output from it
+    '''
+    from Helpers.ArtifactStore import ArtifactStore
+    from Helpers.IntermediateStore import JsonlStore, getStorePath
+    from Agents.TestCasesAgent import TestCase
+    coordinator = LeaseCoordinator()
+    run, leases = coordinator.getRun(run_id), coordinator.leases(run_id)
+    useRunWorkspace(run, test_module)
+    if not coordinator.isFinished(run_id):
+        print(f'Shard run {run_id} is not finished: {coordinator.progress(run_id)}')
+        return
+    artifact_store, merged, records = ArtifactStore(), [], []
+    for lease in leases:
+        if lease['status'] != 'done':
+            print(f"Shard {lease['shard']} ({lease['start']}..{lease['end']}) failed: {lease['error']}")
+            continue
+        shard_store = ArtifactStore(os.path.join(lease['output_path'], 'artifacts.db'))
+        merged += artifact_store.mergeShard(shard_store, run['stage'], lease['start'], lease['end'])
+        if run['stage'] == 'cas':
+            shard_cases = JsonlStore(os.path.join(lease['output_path'], os.path.basename(getStorePath('TEST_CASES_FILE'))), TestCase)
+            records += shard_cases.read() if shard_cases.exists() else []
+    if run['stage'] == 'cas':
+        test_cases_store = JsonlStore(getStorePath('TEST_CASES_FILE'), TestCase)
+        test_cases_store.write(records)
+        test_cases_store.exportCsv(os.getenv('TEST_CASES_FILE'))
+    else:
+        artifact_store.renderTestDataWorkbook(os.getenv('TEST_DATA_FILE'), test_case_ids = merged)
+    coordinator.markMerged(run_id)
+    print(f"Merged {len(merged)} {'scenarios' if run['stage'] == 'cas' else 'test cases'} of shard run {run_id}")
+
+def removeSheets(filepath, sheets):
+    from Helpers.OutputManager import ExcelManager
+    if not filepath or not os.path.isfile(filepath):
+        return
+    excel = ExcelManager('modify', filepath)
+    if any(sheet in excel.sheetnames for sheet in sheets):
+        for sheet in sheets:
+            excel.removeWorksheet(sheet)
+        excel.save_wb()
+
+def regenerateChanged(test_module = DEFAULT_MODULE, dry_run = False, verify = None):
+    '''
+    Regenerates only the scenarios, test cases, steps and sheets derived from knowledge files that changed.
+    The steps, sources and sheets of test cases that are not generated again are removed
+    '''
+    from Helpers.Traceability import computeImpact
+    from Helpers.KnowledgeBaseProvider import getKnowledgeBasePath
+    from Helpers.ArtifactStore import ArtifactStore
+    artifact_store = ArtifactStore()
+    impact = computeImpact(artifact_store, getKnowledgeBasePath(test_module))
+    print(f"Changed knowledge files: {impact['changed_files']}")
+    print(f"Scenarios to regenerate: {impact['scenarios']}")
+    print(f"Scenarios whose test cases, steps and output will be regenerated: {impact['test_case_scenarios']}")
+    if dry_run or len(impact['test_case_scenarios']) == 0:
+        return
+    if impact['scenarios']:
+        with profileStage('sen'):
+            createAgent('sen', test_module).execute(scenario_ids = impact['scenarios'])
+    replaced_ids = [case['test_case_id'] for case in artifact_store.readTestCases(scenario_ids = impact['test_case_scenarios'])]
+    with profileStage('cas'):
+        createAgent('cas', test_module).execute(scenario_ids = impact['test_case_scenarios'], verify = verify if verify else False, dedup = 'off')
+    test_case_ids = [case['test_case_id'] for case in artifact_store.readTestCases(scenario_ids = impact['test_case_scenarios'])]
+    removed_ids = sorted(set(replaced_ids) - set(test_case_ids))
+    if removed_ids:
+        print(f'Removing the steps, sources and sheets of the test cases no longer generated: {removed_ids}')
+        artifact_store.deleteTestCases(removed_ids)
+        removeSheets(os.getenv('TEST_DATA_FILE'), removed_ids)
+    with profileStage('stp'):
+        createAgent('stp', test_module).execute(test_case_ids = test_case_ids, verify = verify if verify else True)
+    with profileStage('out'):
+        createAgent('out', test_module).execute(sheets = test_case_ids, verify = verify if verify else False)
+
+def showCoverage():
+    from Helpers.CoverageAnalyzer import CoverageAnalyzer
+    from Helpers.ArtifactStore import ArtifactStore
+    artifact_store = ArtifactStore()
+    analyzer = CoverageAnalyzer(artifact_store.readDimensions(), artifact_store.readScenarios())
+    print(f'Scenario coverage: {analyzer.report()}')
+    print(f'Test case coverage: {analyzer.report(analyzer.scenarioMask(artifact_store.scenarioIdsWithTestCases()))}')
+    for gap in analyzer.describeGaps():
+        print(f'Uncovered: {gap}')
+
+def renderOutputs(output_format, filepath = None):
+    from Helpers.ArtifactStore import ArtifactStore
+    artifact_store = ArtifactStore()
+    with profileStage('render'):
+        if output_format == 'csv':
+            filepath = filepath if filepath else os.getenv('TEST_CASES_FILE')
+            artifact_store.renderTestCasesCsv(filepath)
+        elif output_format == 'xlsx':
+            filepath = filepath if filepath else os.getenv('TEST_DATA_FILE')
+            artifact_store.renderTestDataWorkbook(filepath)
+        else:
+            raise Exception(f'{output_format} is an invalid format. It can only be csv or xlsx')
+    print(f'Rendered {filepath} from {artifact_store.filepath}')
+
+def showFailedVerifications(scenario_id = None):
+    from Helpers.ArtifactStore import ArtifactStore
+    print(ArtifactStore().failedVerifications(scenario_id = scenario_id).to_string(index=False))
+
+def popOption(name, default = None):
+    '''
+    Removes an option of the form --name=value from the arguments and returns its value. A bare --name returns ''
+    '''
+    for arg in sys.argv[2:]:
+        if arg.startswith(f'--{name}='):
+            sys.argv.remove(arg)
+            return arg.split('=', 1)[1]
+        if arg == f'--{name}':
+            sys.argv.remove(arg)
+            return ''
+    return default
 
 
 if __name__ == '__main__':
     if len(sys.argv) > 1:
         arg1 = sys.argv[1]
+        #Verification policy e.g. --verify=all, --verify=sample:0.3, --verify=heuristic, --verify=adaptive
+        verify = popOption('verify')
+        #Near duplicate handling for sen and cas e.g. --dedup=drop, --dedup=flag, --dedup=off
+        dedup = popOption('dedup', 'drop')
+        #Retrieved knowledge base context for the generators e.g. --retrieve=8 sends the 8 most relevant chunks per item
+        retrieval_k = int(popOption('retrieve', 0))
+        #--compact-schema sends the field descriptions of the output formats once per stage instead of on every call
+        compact_schema = popOption('compact-schema') is not None
+        #--static-prefix sends the role and task instructions once per stage and only the values of each item on a call
+        static_prefix = popOption('static-prefix') is not None
+        #--hedge sends a duplicate of a request slower than the p95 latency of its model, capped at 10% of the calls.
+        #--hedge=p90:0.2 sets the percentile and budget, --hedge=30:0.05 hedges after 30 seconds
+        hedge = popOption('hedge')
+        #--token-budget=200000 sets the estimated input tokens allowed per request in place of the budget of the model. Larger prompts are split or rejected
+        token_budget = int(popOption('token-budget', 0)) or None
+        #--module=<name> runs a single command for a module in that module's workspace
+        test_module = popOption('module')
+        module_workspace = bool(test_module)
+        #--profile splits the time of each stage into llm wait, file io and local cpu. --profile=cpu,mem adds cProfile hot spots and peak memory
+        profile = popOption('profile')
+        if profile is not None:
+            enableProfiling(cprofile = 'cpu' in profile, memory = 'mem' in profile)
+        if test_module:
+            useModuleWorkspace(test_module)
+        else:
+            test_module = DEFAULT_MODULE
         match arg1:
             case 'dim':
-                generateDimensions()
+                generateDimensions(test_module)
             case 'sen':
-                generateScenarios()
+                #sen gaps generates only for the uncovered dimension values and pairs
+                generateScenarios(dedup = dedup, gaps_only = len(sys.argv) > 2 and sys.argv[2] == 'gaps', test_module = test_module)
             case 'cas':
-                gen_instruct = ''                
-                if len(sys.argv) == 2:
+                gen_instruct, gaps_only = '', False
+                if len(sys.argv) > 2 and sys.argv[2] == 'gaps':
+                    #cas gaps generates only for the scenarios that close the coverage gaps of the test cases
+                    start, end, gaps_only = 1, -1, True
+                    if len(sys.argv) == 4:
+                        gen_instruct = sys.argv[3]
+                elif len(sys.argv) == 2:
                     start = 1
                     end = -1
                 elif len(sys.argv) >= 4:
@@ -58,7 +419,8 @@ if __name__ == '__main__':
                         gen_instruct = sys.argv[4]                
                 else:
                     raise Exception('Invalid set of params for Test Step generation')
-                generateTestCases(gen_instruct = gen_instruct, start = start, end = end)
+                generateTestCases(gen_instruct = gen_instruct, start = start, end = end, verify = verify if verify else False, dedup = dedup, gaps_only = gaps_only,
+                                  test_module = test_module)
             case 'stp':
                 if len(sys.argv) == 2:
                     start = 1
@@ -68,12 +430,47 @@ if __name__ == '__main__':
                     end = int(sys.argv[3])
                 else:
                     raise Exception('Invalid set of params for Test Step generation')
-                generateTestSteps(start= start, end = end)
+                generateTestSteps(start= start, end = end, verify = verify if verify else True, test_module = test_module)
             case 'out':
                 if len(sys.argv) > 2:
                     sheets = sys.argv[2].split(',')
-                    generateTestOutput(sheets)
+                    generateTestOutput(sheets, verify = verify if verify else False, test_module = test_module)
                 else:
-                    generateTestOutput()
+                    generateTestOutput(verify = verify if verify else False, test_module = test_module)
+            case 'impact':
+                #Lists what a change in the knowledge base affects without regenerating
+                regenerateChanged(test_module, dry_run = True)
+            case 'regen':
+                regenerateChanged(test_module, verify = verify)
+            case 'modules':
+                #modules "Cash Allocation,Collateral Blocking" [sen,cas,stp,out] runs the modules in parallel processes
+                stages = sys.argv[3].split(',') if len(sys.argv) > 3 else ['sen', 'cas', 'stp', 'out']
+                runModules(sys.argv[2].split(','), stages, verify = verify, dedup = dedup, profile = profile, model_options = modelOptions())
+            case 'cov':
+                showCoverage()
+            case 'shard':
+                #shard plan cas|stp <start> <end> <shard_size> | shard work|merge|status <run_id>
+                match sys.argv[2]:
+                    case 'plan':
+                        planShards(test_module, sys.argv[3], int(sys.argv[4]), int(sys.argv[5]), int(sys.argv[6]), verify = verify, dedup = dedup,
+                                   module_workspace = module_workspace)
+                    case 'work':
+                        #Workers and the merge use the workspace of the run, --module is not needed but must match it when given
+                        workShards(sys.argv[3], test_module = test_module if module_workspace else None)
+                    case 'merge':
+                        mergeShards(sys.argv[3], test_module = test_module if module_workspace else None)
+                    case 'status':
+                        import pandas as pd
+                        print(pd.DataFrame(LeaseCoordinator().leases(sys.argv[3])).to_string(index=False))
+            case 'render':
+                #render csv|xlsx [filepath] from the artifact store
+                renderOutputs(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
+            case 'failed':
+                #failed [scenario_id] lists the items that failed verification
+                showFailedVerifications(sys.argv[2] if len(sys.argv) > 2 else None)
+        print(f'Run metrics written to {getMetrics().save()}')
+        if getProfiler():
+            getProfiler().printReport()
+            print(f'Profile written to {getProfiler().save()}')
     else:
         print('Invalid set of parameters passed')
\ No newline at end of file
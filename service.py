@@ -0,0 +1,243 @@
+from dotenv import load_dotenv
+from fastapi import FastAPI, HTTPException, Header
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from typing import Optional, Literal
+from contextlib import asynccontextmanager
+from Helpers.JobQueue import JobQueue, FINISHED
+from Helpers.ModuleWorkspace import useModuleWorkspace, OUTPUT_ENV_VARS
+from Helpers.MetricsRecorder import resetMetrics
+from Helpers.KnowledgeBaseProvider import getKnowledgeBasePath
+import multiprocessing
+import traceback
+import signal
+import asyncio
+import uvicorn
+import socket
+import json
+import time
+import os
+
+load_dotenv()
+
+#Default verification of each stage when the job does not give one, same as main.py
+DEFAULT_VERIFY = {'dim': True, 'sen': False, 'cas': False, 'stp': True, 'out': False}
+
+
+class JobRequest(BaseModel):
+    module: str = 'Cash Allocation'
+    stage: Literal['dim', 'sen', 'cas', 'stp', 'out']
+    start: int = 1
+    end: int = -1
+    sheets: Optional[list[str]] = None
+    scenario_ids: Optional[list[str]] = None
+    test_case_ids: Optional[list[str]] = None
+    gaps_only: bool = False
+    gen_instruct: str = ''
+    #Verification policy as in --verify e.g. all, sample:0.3, heuristic, adaptive
+    verify: Optional[str] = None
+    dedup: Literal['drop', 'flag', 'off'] = 'drop'
+    retrieve: int = 0
+    compact_schema: bool = False
+    static_prefix: bool = False
+    #Hedging policy as in --hedge e.g. p95, p90:0.2, 30:0.05
+    hedge: Optional[str] = None
+    #Input token budget as in --token-budget
+    token_budget: Optional[int] = None
+
+
+#-----------------------------------------Worker processes-----------------------------------------
+def createAgent(test_module, stage):
+    from Agents.TestDimensionsAgent import TestDimensionAgent
+    from Agents.TestScenariosAgent import TestScenarioAgent
+    from Agents.TestCasesAgent import TestCaseAgent
+    from Agents.TestStepsAgent import TestStepAgent
+    from Agents.TestOutputAgent import TestOutputAgent
+    agent_classes = {'dim': TestDimensionAgent, 'sen': TestScenarioAgent, 'cas': TestCaseAgent, 'stp': TestStepAgent, 'out': TestOutputAgent}
+    return agent_classes[stage](test_module)
+
+def executeStage(agent, stage, params):
+    verify = params['verify'] if params['verify'] else DEFAULT_VERIFY[stage]
+    match stage:
+        case 'dim':
+            agent.execute()
+        case 'sen':
+            agent.execute(dedup = params['dedup'], gaps_only = params['gaps_only'], scenario_ids = params['scenario_ids'])
+        case 'cas':
+            agent.execute(start = params['start'], end = params['end'], gen_instruct = params['gen_instruct'], verify = verify,
+                          dedup = params['dedup'], gaps_only = params['gaps_only'], scenario_ids = params['scenario_ids'])
+        case 'stp':
+            #Caches are kept for the next job and released when the worker stops
+            agent.execute(params['start'], params['end'], verify = verify, cleanup = False, test_case_ids = params['test_case_ids'])
+        case 'out':
+            agent.execute(sheets = params['sheets'], verify = verify, cleanup = False)
+
+def runJob(queue, job, agents, base_env):
+    '''
+    Runs a job in the workspace of its module with a warm agent of the module and stage
+    '''
+    job_id, test_module, stage, params = job['job_id'], job['module'], job['stage'], job['params']
+    for env_var, value in base_env.items():
+        if value is None:
+            os.environ.pop(env_var, None)
+        else:
+            os.environ[env_var] = value
+    useModuleWorkspace(test_module)
+    metrics = resetMetrics(f'job_{job_id}')
+    queue.addEvent(job_id, 'started', worker = job['worker'])
+    items, test_case_ids = {}, []
+    def progress(item_id, status, **data):
+        items.setdefault(status, []).append(item_id)
+        test_case_ids.extend(data.get('test_cases', []))
+        queue.addEvent(job_id, status, item_id, **data)
+    try:
+        if (test_module, stage) not in agents:
+            agents[(test_module, stage)] = createAgent(test_module, stage)
+        agent = agents[(test_module, stage)]
+        agent.reset_run_state()
+        agent.progress_callback = progress
+        agent.generate_model_config.retrieval_k = params['retrieve']
+        agent.generate_model_config.compact_schema = agent.verify_model_config.compact_schema = params.get('compact_schema', False)
+        agent.generate_model_config.hedge = agent.verify_model_config.hedge = params.get('hedge')
+        agent.generate_model_config.token_budget = agent.verify_model_config.token_budget = params.get('token_budget')
+        if stage in ('cas', 'stp', 'out'):
+            agent.generate_model_config.static_prefix = agent.verify_model_config.static_prefix = params.get('static_prefix', False)
+        executeStage(agent, stage, params)
+        result = {'items': items, 'outputs': {env_var: os.getenv(env_var) for env_var in OUTPUT_ENV_VARS},
+                  'metrics_file': metrics.save(), 'metrics': metrics.summary()}
+        if test_case_ids:
+            result['test_cases'] = agent.artifact_store.readTestCases(test_case_ids = test_case_ids)
+        #The last event is added before the job is marked finished so that the event stream does not miss it
+        queue.addEvent(job_id, 'finished')
+        queue.finish(job_id, result)
+    except Exception as e:
+        traceback.print_exc()
+        error = f'{type(e).__name__}: {e}'
+        queue.addEvent(job_id, 'error', error = error)
+        queue.finish(job_id, {'items': items, 'metrics_file': metrics.save(), 'metrics': metrics.summary()}, error = error)
+
+def stopOnTerminate(signum, frame):
+    #A terminated worker unwinds so that it still releases its caches
+    raise SystemExit(0)
+
+def workerLoop(worker_num, stop, poll_seconds = 1.0):
+    '''
+    Claims and runs jobs till stop is set. The caches of the warm agents are released when the loop ends
+    '''
+    signal.signal(signal.SIGTERM, stopOnTerminate)
+    load_dotenv()
+    worker = f'{socket.gethostname()}:{os.getpid()}:{worker_num}'
+    base_env = {env_var: os.getenv(env_var) for env_var in OUTPUT_ENV_VARS + ['ARTIFACT_DB', 'METRICS_DIR']}
+    queue, agents = JobQueue(), {}
+    print(f'Worker {worker} started')
+    try:
+        while not stop.is_set():
+            job = queue.claim(worker)
+            if job is None:
+                stop.wait(poll_seconds)
+                continue
+            print(f"Worker {worker} running job {job['job_id']}: {job['stage']} for {job['module']}")
+            runJob(queue, job, agents, base_env)
+    finally:
+        for agent in agents.values():
+            for client in [getattr(agent, 'generate_llm_client', None), getattr(agent, 'verify_llm_client', None)]:
+                if client:
+                    client.cleanup_files()
+        print(f'Worker {worker} stopped')
+
+
+#-----------------------------------------HTTP API-----------------------------------------
+workers = []
+
+@asynccontextmanager
+async def lifespan(app):
+    queue = JobQueue()
+    requeued = queue.requeueRunning()
+    if requeued:
+        print(f'Requeued {requeued} jobs left running')
+    context = multiprocessing.get_context('spawn')
+    stop = context.Event()
+    for worker_num in range(int(os.getenv('SERVICE_WORKERS', 2))):
+        process = context.Process(target = workerLoop, args = (worker_num, stop), daemon = True)
+        process.start()
+        workers.append(process)
+    yield
+    #Workers finish their current job and release their caches. Those still running a job after the timeout are
+    #terminated, which also releases the caches, and the job is requeued at the next start
+    stop.set()
+    deadline = time.time() + int(os.getenv('SERVICE_STOP_SECONDS', 60))
+    for process in workers:
+        process.join(timeout = max(0, deadline - time.time()))
+    for process in workers:
+        if process.is_alive():
+            process.terminate()
+            process.join(timeout = 30)
+
+app = FastAPI(title = 'Testing Assistant', lifespan = lifespan)
+
+def getJob(job_id):
+    job = JobQueue().get(job_id)
+    if job is None:
+        raise HTTPException(status_code = 404, detail = f'Job {job_id} not found')
+    return job
+
+@app.post('/jobs')
+def submitJob(request: JobRequest):
+    try:
+        getKnowledgeBasePath(request.module)
+    except Exception as e:
+        raise HTTPException(status_code = 400, detail = str(e))
+    params = request.model_dump(exclude = {'module', 'stage'})
+    return {'job_id': JobQueue().submit(request.module, request.stage, params)}
+
+@app.get('/jobs')
+def listJobs(status: Optional[str] = None, module: Optional[str] = None, limit: int = 100):
+    return JobQueue().list(status, module, limit)
+
+@app.get('/jobs/{job_id}')
+def jobStatus(job_id: int):
+    job = getJob(job_id)
+    job.pop('result')
+    return job
+
+@app.get('/jobs/{job_id}/events')
+async def jobEvents(job_id: int, last_event_id: Optional[str] = Header(default = None)):
+    '''
+    Server sent events of the progress of a job till it finishes. A reconnecting client resumes after Last-Event-ID
+    '''
+    getJob(job_id)
+    queue = JobQueue()
+    async def stream():
+        after = int(last_event_id) if last_event_id else 0
+        while True:
+            finished = queue.get(job_id)['status'] in FINISHED
+            for event in queue.events(job_id, after):
+                after = event['seq']
+                data = json.dumps({'item_id': event['item_id'], 'at': event['at'], **event['data']})
+                yield f"id: {event['seq']}\nevent: {event['status']}\ndata: {data}\n\n"
+            if finished:
+                break
+            await asyncio.sleep(0.5)
+    return StreamingResponse(stream(), media_type = 'text/event-stream')
+
+@app.get('/jobs/{job_id}/results')
+def jobResults(job_id: int):
+    job = getJob(job_id)
+    if job['status'] not in FINISHED:
+        raise HTTPException(status_code = 409, detail = f"Job {job_id} is {job['status']}")
+    return {'job_id': job_id, 'status': job['status'], 'error': job['error'], **{key: value for key, value in (job['result'] or {}).items() if key != 'metrics'}}
+
+@app.get('/jobs/{job_id}/metrics')
+def jobMetrics(job_id: int):
+    job = getJob(job_id)
+    if job['status'] not in FINISHED:
+        raise HTTPException(status_code = 409, detail = f"Job {job_id} is {job['status']}")
+    return (job['result'] or {}).get('metrics', {})
+
+@app.get('/metrics')
+def serviceMetrics():
+    return {'workers': sum(process.is_alive() for process in workers), 'jobs': JobQueue().stats()}
+
+
+if __name__ == '__main__':
+    uvicorn.run(app, host = os.getenv('SERVICE_HOST', '127.0.0.1'), port = int(os.getenv('SERVICE_PORT', 8000)))
@@ -0,0 +1,8 @@
+'''
+Unit tests of the pure helpers. They need no LLM provider, network or .env and run with
+    python -m pytest tests
+'''
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
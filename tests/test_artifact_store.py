@@ -0,0 +1,81 @@
+import sqlite3
+import pytest
+from Helpers.ArtifactStore import ArtifactStore
+
+
+def cases(scenario_id, count):
+    return [{'test_case_id': f'{scenario_id}-TC-{num:04}', 'test_scenario_id': scenario_id} for num in range(1, count + 1)]
+
+def ids(records, key = 'test_case_id'):
+    return [record[key] for record in records]
+
+@pytest.fixture
+def store(tmp_path):
+    return ArtifactStore(str(tmp_path / 'artifacts.db'))
+
+
+def test_scenarios_keep_their_order_and_appending_an_existing_id_raises(store):
+    store.writeScenarios([{'scenario_id': 'SC-002'}, {'scenario_id': 'SC-001'}])
+    store.writeScenarios([{'scenario_id': 'SC-004'}], replace = False)
+    assert ids(store.readScenarios(), 'scenario_id') == ['SC-002', 'SC-001', 'SC-004']
+    assert ids(store.readScenarios(2, 3), 'scenario_id') == ['SC-001', 'SC-004']
+    with pytest.raises(sqlite3.IntegrityError):
+        store.writeScenarios([{'scenario_id': 'SC-004', 'changed': True}], replace = False)
+    assert 'changed' not in store.readScenarios(scenario_ids = ['SC-004'])[0]
+
+def test_upsert_scenarios_keeps_the_position(store):
+    store.writeScenarios([{'scenario_id': 'SC-001'}, {'scenario_id': 'SC-002'}])
+    store.upsertScenarios([{'scenario_id': 'SC-001', 'changed': True}, {'scenario_id': 'SC-003'}])
+    assert ids(store.readScenarios(), 'scenario_id') == ['SC-001', 'SC-002', 'SC-003']
+    assert store.readScenarios(1, 1)[0]['changed']
+
+def test_regenerated_test_cases_keep_their_position(store):
+    for scenario_id in ['SC-001', 'SC-002', 'SC-003']:
+        store.writeTestCases(scenario_id, cases(scenario_id, 2), 'cases_generated')
+    store.writeTestCases('SC-001', cases('SC-001', 1), 'cases_verified')
+    assert ids(store.readTestCases()) == ['SC-001-TC-0001', 'SC-002-TC-0001', 'SC-002-TC-0002', 'SC-003-TC-0001', 'SC-003-TC-0002']
+    #More test cases than before push the following ones back
+    store.writeTestCases('SC-002', cases('SC-002', 3), 'cases_verified')
+    assert ids(store.readTestCases()) == ['SC-001-TC-0001', 'SC-002-TC-0001', 'SC-002-TC-0002', 'SC-002-TC-0003',
+                                          'SC-003-TC-0001', 'SC-003-TC-0002']
+    #A scenario without test cases is added at the end
+    store.writeTestCases('SC-004', cases('SC-004', 1), 'cases_generated')
+    assert ids(store.readTestCases(6, -1)) == ['SC-003-TC-0002', 'SC-004-TC-0001']
+    assert ids(store.readTestCases(status = 'cases_verified')) == ['SC-001-TC-0001', 'SC-002-TC-0001', 'SC-002-TC-0002', 'SC-002-TC-0003']
+
+def test_steps_round_trip_and_clear_the_expected_output(store):
+    store.writeTestCases('SC-001', cases('SC-001', 1), 'cases_generated')
+    test_case_id = 'SC-001-TC-0001'
+    store.writeExpectedOutput(test_case_id, [{'step': 1, 'allocated': 5.0}])
+    store.writeTestSteps(test_case_id, [{'step': 2, 'event': 'Withdraw'}, {'step': 1, 'event': 'Deposit'}], [{'step': 1, 'amt': 10.0}])
+    steps_df, allocation_df = store.readTestSteps(test_case_id)
+    assert steps_df['event'].tolist() == ['Deposit', 'Withdraw']
+    assert allocation_df['amt'].tolist() == [10.0]
+    assert store.readExpectedOutput(test_case_id).empty
+    assert store.getTestCase(test_case_id)['test_case_id'] == test_case_id
+    assert store.count('test_cases', {'status': 'steps_generated'}) == 1
+
+def test_delete_test_cases_removes_their_artifacts(store):
+    store.writeTestCases('SC-001', cases('SC-001', 2), 'cases_generated')
+    for test_case_id in ['SC-001-TC-0001', 'SC-001-TC-0002']:
+        store.writeTestSteps(test_case_id, [{'step': 1}], [{'step': 1}])
+        store.recordSources('test_case', test_case_id, {'Requirements.md': 'digest'})
+    store.deleteTestCases(['SC-001-TC-0002'])
+    assert ids(store.readTestCases()) == ['SC-001-TC-0001']
+    assert store.count('test_steps') == store.count('allocation_steps') == store.count('artifact_sources') == 1
+
+def test_changed_sources(store):
+    store.recordSources('scenario', 'SC-001', {'Requirements.md': 'a', 'Masters.md': 'b'})
+    store.recordSources('scenario', 'SC-002', {'Masters.md': 'b'})
+    assert store.changedSources({'Requirements.md': 'changed', 'Masters.md': 'b'}) == [('scenario', 'SC-001')]
+    assert store.changedFiles({'Masters.md': 'b'}) == ['Requirements.md']
+
+def test_failed_verifications_report_the_last_outcome_of_each_item(store):
+    store.recordVerification('stp', 'TC-001', False, 'wrong amount', scenario_id = 'SC-001', test_case_id = 'TC-001')
+    store.recordVerification('stp', 'TC-001', True, scenario_id = 'SC-001', test_case_id = 'TC-001')
+    store.recordVerification('stp', 'TC-002', False, 'first', scenario_id = 'SC-001', test_case_id = 'TC-002')
+    store.recordVerification('stp', 'TC-002', False, 'second', scenario_id = 'SC-001', test_case_id = 'TC-002')
+    store.recordVerification('cas', 'TC-001', False, 'missing case', scenario_id = 'SC-001')
+    failed = store.failedVerifications(scenario_id = 'SC-001')
+    assert list(zip(failed['stage'], failed['item_id'], failed['correction'])) == [('stp', 'TC-002', 'second'), ('cas', 'TC-001', 'missing case')]
+    assert store.failedVerifications(stage = 'stp')['item_id'].tolist() == ['TC-002']
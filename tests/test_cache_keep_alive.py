@@ -0,0 +1,75 @@
+import time
+import pytest
+from Helpers.CacheKeepAlive import CacheKeepAlive
+from Helpers.MetricsRecorder import resetMetrics, getMetrics
+
+INTERVAL = 0.02
+
+
+@pytest.fixture(autouse = True)
+def metrics():
+    resetMetrics('keep_alive')
+
+@pytest.fixture
+def new_keep_alive():
+    #The threads never stop, so their caches are untracked to leave them idle after the test
+    created = []
+    def create(interval_seconds, idle_seconds):
+        created.append(CacheKeepAlive(interval_seconds, idle_seconds))
+        return created[-1]
+    yield create
+    for keep_alive in created:
+        for key, cache in list(keep_alive.caches.items()):
+            for holder in list(cache['holders']):
+                keep_alive.untrack(key, holder)
+
+def waitFor(condition, seconds = 2):
+    end = time.time() + seconds
+    while not condition() and time.time() < end:
+        time.sleep(INTERVAL / 2)
+    return condition()
+
+
+def test_tracked_caches_are_refreshed_in_the_background(new_keep_alive):
+    keep_alive, refreshes = new_keep_alive(INTERVAL, 60), []
+    keep_alive.track('key', 'holder', lambda: refreshes.append('key') or True)
+    assert waitFor(lambda: len(refreshes) >= 2)
+    assert getMetrics().count('cache', 'keep_alive_refreshes') >= 2
+
+def test_cache_shared_by_holders_is_refreshed_once_with_the_latest_refresh(new_keep_alive):
+    keep_alive, refreshes = new_keep_alive(60, 60), []
+    keep_alive.track('key', 'first', lambda: refreshes.append('first') or True)
+    keep_alive.track('key', 'second', lambda: refreshes.append('second') or True)
+    assert len(keep_alive.caches) == 1
+    keep_alive.untrack('key', 'first')
+    assert keep_alive.caches['key']['holders'] == {'second'}
+    keep_alive.untrack('key', 'second')
+    assert keep_alive.caches == {}
+
+def test_touch_reports_whether_the_holder_tracks_the_cache(new_keep_alive):
+    keep_alive = new_keep_alive(60, 60)
+    assert not keep_alive.touch('key', 'holder')
+    keep_alive.track('key', 'holder', lambda: True)
+    keep_alive.caches['key']['last_used'] = 0
+    assert keep_alive.touch('key', 'holder') and keep_alive.touch('key')
+    assert keep_alive.caches['key']['last_used'] > 0
+    assert not keep_alive.touch('key', 'other holder')
+
+def test_idle_caches_are_left_to_expire(new_keep_alive):
+    keep_alive, refreshes = new_keep_alive(INTERVAL, 0.05), []
+    keep_alive.track('key', 'holder', lambda: refreshes.append('key') or True)
+    keep_alive.caches['key']['last_used'] = time.time() - 1
+    time.sleep(INTERVAL * 5)
+    assert refreshes == []
+    keep_alive.touch('key')
+    assert waitFor(lambda: refreshes)
+
+def test_gone_and_failing_caches_are_counted_and_the_thread_keeps_running(new_keep_alive):
+    keep_alive, refreshes = new_keep_alive(INTERVAL, 60), []
+    def failing():
+        raise ValueError('rate limited')
+    keep_alive.track('gone', 'holder', lambda: False)
+    keep_alive.track('failing', 'holder', failing)
+    keep_alive.track('live', 'holder', lambda: refreshes.append('live') or True)
+    assert waitFor(lambda: getMetrics().count('cache', 'keep_alive_failures') >= 4 and len(refreshes) >= 2)
+    assert keep_alive.thread.is_alive()
@@ -0,0 +1,73 @@
+import socket
+import pytest
+from Helpers.CacheRegistry import CacheRegistry, cacheKey, holderId
+
+KEY = 'Cash Allocation|gemini-2.5-pro|generator|digest'
+DEAD_HOLDER = f'{socket.gethostname()}:999999999:1'
+
+
+@pytest.fixture
+def registry(tmp_path):
+    return CacheRegistry(str(tmp_path / 'registry.json'))
+
+def owner():
+    #Owners are kept alive so that their ids are not reused within a test
+    _owners.append(object())
+    return _owners[-1]
+
+_owners = []
+
+def register(registry, holder):
+    state, stale = registry.acquire(KEY, holder)
+    assert (state, stale) == ('create', None)
+    registry.register(KEY, holder, 'cachedContents/1', [{'name': 'files/1', 'display_name': 'Requirements.md'}], 600)
+
+
+def test_cache_key_depends_on_the_knowledge_base_and_instructions(tmp_path):
+    (tmp_path / 'Requirements.md').write_text('v1')
+    first = cacheKey('Cash Allocation', 'gemini-2.5-pro', 'generator', str(tmp_path))
+    assert cacheKey('Cash Allocation', 'gemini-2.5-pro', 'generator', str(tmp_path), 'instructions') != first
+    (tmp_path / 'Requirements.md').write_text('v2')
+    assert cacheKey('Cash Allocation', 'gemini-2.5-pro', 'generator', str(tmp_path)) != first
+
+def test_second_holder_shares_the_live_cache(registry):
+    first, second = holderId(owner()), holderId(owner())
+    register(registry, first)
+    state, entry = registry.acquire(KEY, second)
+    assert state == 'live' and entry['cache_name'] == 'cachedContents/1'
+    assert set(entry['holders']) == {first, second}
+
+def test_others_wait_while_a_cache_is_created(registry):
+    creator = holderId(owner())
+    assert registry.acquire(KEY, creator)[0] == 'create'
+    assert registry.acquire(KEY, holderId(owner())) == ('wait', None)
+    registry.abandon(KEY, creator)
+    assert registry.acquire(KEY, holderId(owner()))[0] == 'create'
+
+def test_cache_is_returned_for_deletion_only_by_its_last_holder(registry):
+    first, second = holderId(owner()), holderId(owner())
+    register(registry, first)
+    registry.acquire(KEY, second)
+    assert registry.release(KEY, first) is None
+    entry = registry.release(KEY, second)
+    assert entry['cache_name'] == 'cachedContents/1' and entry['files'][0]['name'] == 'files/1'
+    assert registry.get(KEY) is None
+
+def test_holders_of_dead_processes_are_dropped(registry):
+    register(registry, DEAD_HOLDER)
+    assert registry.release(KEY, holderId(owner()))['cache_name'] == 'cachedContents/1'
+
+def test_expired_cache_is_recreated_and_the_stale_entry_returned(registry):
+    holder = holderId(owner())
+    register(registry, holder)
+    registry.expire(KEY, 'cachedContents/other')
+    assert registry.acquire(KEY, holder)[0] == 'live'
+    registry.expire(KEY, 'cachedContents/1')
+    state, stale = registry.acquire(KEY, holderId(owner()))
+    assert state == 'create' and stale['cache_name'] == 'cachedContents/1'
+
+def test_purge_removes_unreferenced_caches_of_the_role(registry):
+    register(registry, DEAD_HOLDER)
+    registry.acquire('Cash Allocation|gemini-2.5-pro|verifier|digest', holderId(owner()))
+    assert registry.purge('verifier') == []
+    assert [entry['cache_name'] for entry in registry.purge('generator')] == ['cachedContents/1']
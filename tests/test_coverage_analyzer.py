@@ -0,0 +1,50 @@
+import numpy as np
+from Helpers.CoverageAnalyzer import CoverageAnalyzer
+
+DIMENSIONS = [
+    {'dim_id': 'D1', 'dimension': 'Currency', 'dim_type': 'cartesian',
+     'values': [{'dim_val_id': 'D1V1', 'dim_value': 'INR'}, {'dim_val_id': 'D1V2', 'dim_value': 'USD'}]},
+    {'dim_id': 'D2', 'dimension': 'Segment', 'dim_type': 'cartesian',
+     'values': [{'dim_val_id': 'D2V1', 'dim_value': 'CM'}, {'dim_val_id': 'D2V2', 'dim_value': 'FNO'}]},
+    {'dim_id': 'D3', 'dimension': 'Holiday', 'dim_type': 'independent',
+     'values': [{'dim_val_id': 'D3V1', 'dim_value': 'Yes'}]},
+]
+
+
+def scenario(scenario_id, **dimensions):
+    return {'scenario_id': scenario_id, 'scenario_dimension': [{'dimension': name, 'value': value} for name, value in dimensions.items()]}
+
+
+def test_report_and_gaps():
+    analyzer = CoverageAnalyzer(DIMENSIONS, [scenario('SC-001', Currency = 'INR', Segment = 'CM'),
+                                             scenario('SC-002', currency = 'usd', segment = 'cm')])
+    report = analyzer.report()
+    #Independent values are counted as values but are never part of a pair
+    assert (report['values'], report['values_covered']) == (5, 3)
+    assert (report['pairs'], report['pairs_covered']) == (4, 2)
+    assert analyzer.describeGaps() == ['Segment = FNO', 'Holiday = Yes',
+                                       'Currency = INR with Segment = FNO', 'Currency = USD with Segment = FNO']
+
+def test_dimension_and_value_ids_are_matched():
+    analyzer = CoverageAnalyzer(DIMENSIONS, [{'scenario_id': 'SC-001', 'scenario_dimension': [{'dimension': 'D1', 'value': 'D1V2'}]}])
+    assert [value['value'] for value in analyzer.uncoveredValues()] == ['INR', 'CM', 'FNO', 'Yes']
+
+def test_scenario_mask_restricts_coverage():
+    analyzer = CoverageAnalyzer(DIMENSIONS, [scenario('SC-001', Currency = 'INR', Segment = 'CM'), scenario('SC-002', Currency = 'USD', Segment = 'FNO')])
+    mask = analyzer.scenarioMask(['SC-002'])
+    assert mask.tolist() == [False, True]
+    assert analyzer.report(mask)['values_covered'] == 2
+
+def test_scenarios_for_gaps_picks_the_fewest_scenarios_that_close_the_gaps():
+    scenarios = [scenario('SC-001', Currency = 'INR', Segment = 'CM'), scenario('SC-002', Currency = 'INR', Segment = 'CM'),
+                 scenario('SC-003', Currency = 'USD', Segment = 'FNO'), scenario('SC-004', Currency = 'INR', Segment = 'FNO'),
+                 scenario('SC-005', Currency = 'USD', Segment = 'CM'), scenario('SC-006', Holiday = 'Yes')]
+    analyzer = CoverageAnalyzer(DIMENSIONS, scenarios)
+    #SC-001 already has test cases and SC-002 adds nothing. SC-003 closes the most gaps, the others one each in order
+    selected = analyzer.scenariosForGaps(analyzer.scenarioMask(['SC-001']))
+    assert selected == ['SC-003', 'SC-004', 'SC-005', 'SC-006']
+    assert analyzer.uncoveredPairs(analyzer.scenarioMask(['SC-001'] + selected)) == []
+
+def test_scenarios_for_gaps_without_gaps():
+    analyzer = CoverageAnalyzer(DIMENSIONS, [scenario('SC-001', Currency = 'INR', Segment = 'CM')])
+    assert analyzer.scenariosForGaps(np.array([True])) == []
@@ -0,0 +1,66 @@
+from Helpers.Deduplicator import NearDuplicateDetector, dimensionKey
+
+DESCRIPTION = ('Clearing member deposits cash collateral in the CM segment and requests an allocation to the trading member '
+               'that covers the full margin requirement of the segment in currency')
+STEPS = ' '.join(f'step {num} deposits collateral amount {num * 1000} in the segment' for num in range(1, 8))
+
+
+def scenario(scenario_id, description, **dimensions):
+    return {'scenario_id': scenario_id, 'scenario_description': description,
+            'scenario_dimension': [{'dimension': name, 'value': value} for name, value in dimensions.items()]}
+
+def scenarioDetector():
+    return NearDuplicateDetector('scenario_id', ['scenario_description'], key_function = lambda item: dimensionKey(item['scenario_dimension']))
+
+def caseDetector():
+    return NearDuplicateDetector('test_case_id', ['given_steps', 'when_steps'], group_function = lambda case: str(case['test_scenario_id']))
+
+
+def test_dimension_key_ignores_order_and_formatting():
+    first = [{'dimension': 'Currency', 'value': 'INR'}, {'dimension': 'Segment', 'value': 'CM'}]
+    second = [{'dimension': 'segment ', 'value': 'cm'}, {'dimension': 'currency', 'value': 'inr'}]
+    assert dimensionKey(first) == dimensionKey(second)
+
+def test_same_dimensions_are_exact_duplicates():
+    kept, duplicates = scenarioDetector().filter([scenario('SC-001', DESCRIPTION, currency = 'INR'),
+                                                  scenario('SC-002', 'Entirely different wording', currency = 'INR')])
+    assert [item['scenario_id'] for item in kept] == ['SC-001']
+    assert duplicates[0]['duplicate_of'] == 'SC-001' and duplicates[0]['reason'] == 'exact'
+
+def test_similar_wording_with_different_dimensions_is_kept():
+    records = [scenario('SC-001', DESCRIPTION + ' INR', currency = 'INR'), scenario('SC-002', DESCRIPTION + ' USD', currency = 'USD')]
+    detector = scenarioDetector()
+    assert detector.similarity(detector.signature(records[0]['scenario_description']), detector.signature(records[1]['scenario_description'])) >= 0.85
+    kept, duplicates = detector.filter(records)
+    assert len(kept) == 2 and duplicates == []
+
+def test_keyed_detectors_skip_the_near_duplicate_pass():
+    detector = scenarioDetector()
+    detector.add(scenario('SC-001', DESCRIPTION, currency = 'INR'))
+    assert detector.signatures == {} and detector.band_index == {}
+    assert detector.check(scenario('SC-002', DESCRIPTION, currency = 'USD')) is None
+
+def test_near_duplicate_test_cases_within_a_scenario_are_dropped():
+    cases = [{'test_case_id': 'SC-001-TC-0001', 'test_scenario_id': 'SC-001', 'given_steps': STEPS, 'when_steps': 'withdraw'},
+             {'test_case_id': 'SC-001-TC-0002', 'test_scenario_id': 'SC-001', 'given_steps': STEPS + ' again', 'when_steps': 'withdraw'}]
+    kept, duplicates = caseDetector().filter(cases)
+    assert [case['test_case_id'] for case in kept] == ['SC-001-TC-0001']
+    assert duplicates[0]['reason'] == 'near'
+
+def test_test_cases_of_different_scenarios_are_not_compared():
+    cases = [{'test_case_id': f'{scenario_id}-TC-0001', 'test_scenario_id': scenario_id, 'given_steps': STEPS, 'when_steps': 'withdraw'}
+             for scenario_id in ['SC-001', 'SC-002']]
+    kept, duplicates = caseDetector().filter(cases)
+    assert len(kept) == 2 and duplicates == []
+
+def test_flag_mode_keeps_duplicates_and_off_checks_nothing():
+    records = [scenario('SC-001', DESCRIPTION, currency = 'INR'), scenario('SC-002', DESCRIPTION, currency = 'INR')]
+    kept, duplicates = scenarioDetector().filter(records, mode = 'flag')
+    assert len(kept) == 2 and len(duplicates) == 1
+    assert scenarioDetector().filter(records, mode = 'off') == (records, [])
+
+def test_items_added_from_earlier_batches_are_checked():
+    detector = scenarioDetector()
+    detector.add(scenario('SC-001', DESCRIPTION, currency = 'INR'))
+    kept, duplicates = detector.filter([scenario('SC-005', 'New wording', currency = 'INR')])
+    assert kept == [] and duplicates[0]['duplicate_of'] == 'SC-001'
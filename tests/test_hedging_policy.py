@@ -0,0 +1,86 @@
+import time
+import threading
+import pytest
+from Helpers.HedgingPolicy import HedgingPolicy
+from Agents.LLMConnector import LLMConnector
+
+
+def slowPrimary(delay = 0.3):
+    #The first request is slow and the ones after it answer at once
+    calls, lock = [], threading.Lock()
+    def request():
+        with lock:
+            calls.append(len(calls))
+            first = len(calls) == 1
+        if first:
+            time.sleep(delay)
+            return 'primary'
+        return 'hedge'
+    return request, calls
+
+
+def test_resolve_specs():
+    assert HedgingPolicy.resolve(None, 'stage') is None
+    policy = HedgingPolicy.resolve('p90:0.2', 'stage')
+    assert (policy.delay, policy.percentile, policy.budget) == (None, 90.0, 0.2)
+    policy = HedgingPolicy.resolve('20', 'stage')
+    assert (policy.delay, policy.budget) == (20.0, 0.1)
+    assert HedgingPolicy.resolve(policy, 'stage') is policy
+    with pytest.raises(Exception):
+        HedgingPolicy.resolve('p100', 'stage')
+
+def test_percentile_threshold_waits_for_warmup():
+    policy = HedgingPolicy(percentile = 50, warmup = 3)
+    policy.latencies.extend([1.0, 2.0])
+    assert policy.threshold() is None
+    policy.latencies.append(3.0)
+    assert policy.threshold() == 2.0
+
+def test_slow_request_is_hedged_and_the_hedge_wins():
+    policy = HedgingPolicy(delay = 0.05, budget = 1.0)
+    request, calls = slowPrimary()
+    assert policy.run(request) == 'hedge'
+    assert len(calls) == 2 and policy.hedges == 1
+
+def test_hedges_are_capped_by_the_budget():
+    policy = HedgingPolicy(delay = 0.02, budget = 0.5)
+    hedged = 0
+    for _ in range(4):
+        request, calls = slowPrimary(0.05)
+        policy.run(request)
+        hedged += len(calls) - 1
+    #At most half of the calls are hedged and the first call has no budget yet
+    assert policy.hedges == hedged == 2
+
+def test_only_primary_latencies_feed_the_percentile():
+    policy = HedgingPolicy(delay = 0.05, budget = 1.0)
+    request, _ = slowPrimary(0.2)
+    policy.run(request)
+    assert len(policy.latencies) == 0
+    time.sleep(0.3)
+    assert len(policy.latencies) == 1 and policy.latencies[0] >= 0.2
+
+def test_invalid_responses_fall_back_to_the_other_request():
+    policy = HedgingPolicy(delay = 0.02, budget = 1.0)
+    request, _ = slowPrimary(0.1)
+    assert policy.run(request, valid = lambda response: response == 'primary') == 'primary'
+
+def test_error_of_the_primary_is_raised_when_nothing_is_valid():
+    policy = HedgingPolicy(delay = 1.0)
+    def request():
+        raise ValueError('primary failed')
+    with pytest.raises(ValueError, match = 'primary failed'):
+        policy.run(request)
+
+def test_connector_keeps_the_policy_while_the_spec_is_unchanged():
+    connector = LLMConnector.__new__(LLMConnector)
+    connector.stage, connector.hedging, connector.hedge_spec = 'stage', None, None
+    connector.set_hedging('p90')
+    policy = connector.hedging
+    policy.latencies.append(1.0)
+    connector.set_hedging('p90')
+    assert connector.hedging is policy
+    connector.set_hedging('p95')
+    assert connector.hedging is not policy and connector.hedging.percentile == 95
+    connector.set_hedging(None)
+    assert connector.hedging is None
@@ -0,0 +1,57 @@
+import pytest
+from pydantic import BaseModel
+from Helpers.IntermediateStore import JsonlStore
+
+
+class DimensionValue(BaseModel):
+    dimension: str
+    value: str
+
+class Scenario(BaseModel):
+    scenario_id: str
+    scenario_description: str
+    scenario_dimension: list[DimensionValue]
+    traceability: str = ''
+
+
+def scenario(scenario_id, description = 'description', currency = 'INR'):
+    return {'scenario_id': scenario_id, 'scenario_description': description, 'scenario_dimension': [{'dimension': 'currency', 'value': currency}]}
+
+@pytest.fixture
+def store(tmp_path):
+    store = JsonlStore(str(tmp_path / 'scenarios.jsonl'), Scenario)
+    store.write([scenario('SC-001'), scenario('SC-002'), scenario('SC-003')])
+    return store
+
+
+def test_write_validates_and_keeps_nested_fields(store):
+    records = store.read()
+    assert [record['scenario_id'] for record in records] == ['SC-001', 'SC-002', 'SC-003']
+    assert records[0]['scenario_dimension'] == [{'dimension': 'currency', 'value': 'INR'}]
+    #Defaults of the model are filled in
+    assert records[0]['traceability'] == ''
+
+def test_read_range_and_where(store):
+    assert [record['scenario_id'] for record in store.read(start = 2, end = 3)] == ['SC-002', 'SC-003']
+    assert store.read(columns = ['scenario_id'], where = {'scenario_id': 'SC-002'}) == [{'scenario_id': 'SC-002'}]
+
+def test_append(store):
+    store.write([scenario('SC-004')], append = True)
+    assert store.count() == 4
+
+def test_upsert_replaces_in_place_and_appends_new_records(store):
+    store.upsert([scenario('SC-004', 'new'), scenario('SC-002', 'changed')], 'scenario_id')
+    records = store.read()
+    assert [record['scenario_id'] for record in records] == ['SC-001', 'SC-002', 'SC-003', 'SC-004']
+    assert records[1]['scenario_description'] == 'changed'
+
+def test_replace_where_removes_the_matching_records_and_appends_the_new_ones(store):
+    store.write([scenario('SC-004', currency = 'USD')], append = True)
+    store.replaceWhere([scenario('SC-002', 'regenerated')], 'scenario_id', 'SC-002')
+    records = store.read()
+    assert [record['scenario_id'] for record in records] == ['SC-001', 'SC-003', 'SC-004', 'SC-002']
+    assert records[-1]['scenario_description'] == 'regenerated'
+
+def test_missing_store_raises(tmp_path):
+    with pytest.raises(Exception, match = 'Run the previous stage first'):
+        JsonlStore(str(tmp_path / 'missing.jsonl')).read()
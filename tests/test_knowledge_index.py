@@ -0,0 +1,52 @@
+import pytest
+from Helpers.KnowledgeIndex import KnowledgeIndex, tokenize
+
+
+@pytest.fixture
+def knowledge_base(tmp_path):
+    path = tmp_path / 'Cash Allocation'
+    path.mkdir()
+    (path / 'Requirements.md').write_text('Allocation of cash collateral to trading members\n'
+                                          'Deallocation reduces the allocated amount\n'
+                                          'Transfers move allocations between segments\n')
+    (path / 'Masters.md').write_text('Member A001 has bank account IDFC001\nMember A002 has bank account IDFC002\n')
+    return path
+
+def index(knowledge_base, tmp_path, chunk_size = 5):
+    return KnowledgeIndex(str(knowledge_base), chunk_size = chunk_size, index_directory = str(tmp_path / 'index'))
+
+
+def test_tokenize():
+    assert tokenize('Cash-Allocation, A001!') == ['cash', 'allocation', 'a001']
+
+def test_chunks_are_groups_of_whole_lines(knowledge_base, tmp_path):
+    chunks = index(knowledge_base, tmp_path, chunk_size = 12).chunks
+    assert [(chunk['file'], chunk['text'].count('\n') + 1) for chunk in chunks] == [('Masters.md', 2), ('Requirements.md', 2), ('Requirements.md', 1)]
+
+def test_search_ranks_the_chunk_with_the_query_terms(knowledge_base, tmp_path):
+    knowledge_index = index(knowledge_base, tmp_path)
+    results = knowledge_index.search('bank account of member A002', k = 1)
+    assert [(result['file'], result['text']) for result in results] == [('Masters.md', 'Member A002 has bank account IDFC002')]
+    assert knowledge_index.search('nothing matches this', k = 3) == []
+
+def test_results_are_in_document_order(knowledge_base, tmp_path):
+    #Transfers scores highest but comes after the allocation lines of the same file
+    results = index(knowledge_base, tmp_path).search('transfers move allocations between segments deallocation cash', k = 3)
+    assert [result['text'].split()[0] for result in results] == ['Allocation', 'Deallocation', 'Transfers']
+    assert results[2]['score'] == max(result['score'] for result in results)
+
+def test_context_names_the_source_file(knowledge_base, tmp_path):
+    assert index(knowledge_base, tmp_path).context('IDFC001', k = 1) == 'From Masters.md:\nMember A001 has bank account IDFC001'
+
+def test_index_is_loaded_until_the_knowledge_base_changes(knowledge_base, tmp_path, monkeypatch):
+    index(knowledge_base, tmp_path)
+    builds = []
+    monkeypatch.setattr(KnowledgeIndex, '_build', lambda self, digests: builds.append(digests) or setattr(self, 'chunks', []) or
+                        setattr(self, 'postings', {}) or setattr(self, 'lengths', []))
+    index(knowledge_base, tmp_path)
+    assert builds == []
+    #A different chunk size or a changed file rebuilds the index
+    index(knowledge_base, tmp_path, chunk_size = 50)
+    (knowledge_base / 'Masters.md').write_text('Member A003 has bank account IDFC003\n')
+    index(knowledge_base, tmp_path)
+    assert len(builds) == 2
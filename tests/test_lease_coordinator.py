@@ -0,0 +1,55 @@
+import time
+import pytest
+from Helpers.LeaseCoordinator import LeaseCoordinator
+
+
+@pytest.fixture
+def coordinator(tmp_path):
+    return LeaseCoordinator(str(tmp_path / 'coordinator.db'), max_attempts = 2)
+
+
+def test_plan_splits_the_range_into_shards(coordinator):
+    run_id = coordinator.plan('Cash Allocation', 'cas', 1, 10, 4, {'dedup': 'drop'})
+    assert [(lease['start'], lease['end']) for lease in coordinator.leases(run_id)] == [(1, 4), (5, 8), (9, 10)]
+    assert coordinator.getRun(run_id)['params'] == {'dedup': 'drop'}
+
+def test_shards_are_claimed_in_order_and_finish_the_run(coordinator):
+    run_id = coordinator.plan('Cash Allocation', 'stp', 1, 4, 2)
+    first, second = coordinator.claim(run_id, 'worker-a', 60), coordinator.claim(run_id, 'worker-b', 60)
+    assert (first['shard'], second['shard']) == (1, 2)
+    assert coordinator.claim(run_id, 'worker-c', 60) is None
+    assert coordinator.complete(run_id, 1, 'worker-a', 'shards/1')
+    assert not coordinator.isFinished(run_id)
+    assert coordinator.complete(run_id, 2, 'worker-b', 'shards/2')
+    assert coordinator.isFinished(run_id) and coordinator.progress(run_id) == {'done': 2}
+
+def test_expired_lease_is_reassigned_and_the_old_worker_loses_it(coordinator):
+    run_id = coordinator.plan('Cash Allocation', 'stp', 1, 2, 2)
+    coordinator.claim(run_id, 'worker-a', 0.05)
+    assert coordinator.claim(run_id, 'worker-b', 60) is None
+    time.sleep(0.1)
+    lease = coordinator.claim(run_id, 'worker-b', 60)
+    assert (lease['worker'], lease['attempts']) == ('worker-b', 2)
+    assert not coordinator.heartbeat(run_id, 1, 'worker-a', 60)
+    assert not coordinator.complete(run_id, 1, 'worker-a', 'shards/a')
+    assert coordinator.heartbeat(run_id, 1, 'worker-b', 60)
+    assert coordinator.complete(run_id, 1, 'worker-b', 'shards/b')
+    assert coordinator.leases(run_id)[0]['output_path'] == 'shards/b'
+
+def test_failed_shard_is_retried_till_it_runs_out_of_attempts(coordinator):
+    run_id = coordinator.plan('Cash Allocation', 'cas', 1, 1, 1)
+    coordinator.fail(run_id, 1, coordinator.claim(run_id, 'worker-a', 60)['worker'], 'boom')
+    assert coordinator.leases(run_id)[0]['status'] == 'queued'
+    coordinator.fail(run_id, 1, coordinator.claim(run_id, 'worker-b', 60)['worker'], 'boom again')
+    lease = coordinator.leases(run_id)[0]
+    assert (lease['status'], lease['error']) == ('failed', 'boom again')
+    assert coordinator.claim(run_id, 'worker-c', 60) is None and coordinator.isFinished(run_id)
+
+def test_expired_lease_without_attempts_left_is_given_up(coordinator):
+    run_id = coordinator.plan('Cash Allocation', 'cas', 1, 1, 1)
+    coordinator.claim(run_id, 'worker-a', 0.01)
+    time.sleep(0.05)
+    coordinator.claim(run_id, 'worker-b', 0.01)
+    time.sleep(0.05)
+    assert coordinator.claim(run_id, 'worker-c', 60) is None
+    assert coordinator.leases(run_id)[0]['status'] == 'failed'
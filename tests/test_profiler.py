@@ -0,0 +1,77 @@
+import json
+import time
+import threading
+import pytest
+import Helpers.Profiler as profiler_module
+from Helpers.Profiler import Profiler, enableProfiling, profileStage, span
+
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+@pytest.fixture(autouse = True)
+def no_profiler(monkeypatch, tmp_path):
+    monkeypatch.setattr(profiler_module, '_profiler', None)
+    monkeypatch.setenv('METRICS_DIR', str(tmp_path))
+
+
+def test_stage_time_is_split_into_llm_wait_io_and_local():
+    profiler = Profiler('run')
+    with profiler.stage('stp'):
+        with profiler.span('llm_wait'):
+            time.sleep(0.05)
+        with profiler.span('io'):
+            time.sleep(0.02)
+        busy(0.03)
+    record = profiler.report()['stages']['stp']
+    assert (record['runs'], record['llm_wait_calls'], record['io_calls']) == (1, 1, 1)
+    assert record['llm_wait_s'] >= 0.05 and record['io_s'] >= 0.02 and record['local_s'] >= 0.03
+    assert record['wall_s'] == pytest.approx(record['llm_wait_s'] + record['io_s'] + record['local_s'], abs = 0.002)
+
+def test_nested_spans_and_stages_are_counted_once():
+    profiler = Profiler('run')
+    with profiler.stage('out'):
+        with profiler.stage('inner'):
+            with profiler.span('llm_wait'):
+                with profiler.span('io'):
+                    time.sleep(0.01)
+    record = profiler.report()['stages']['out']
+    assert list(profiler.stages) == ['out']
+    assert (record['llm_wait_calls'], record['io_calls'], record['io_s']) == (1, 0, 0.0)
+
+def test_spans_of_other_threads_and_outside_stages_are_ignored():
+    profiler = Profiler('run')
+    with profiler.span('io'):
+        pass
+    def background():
+        with profiler.span('llm_wait'):
+            pass
+    with profiler.stage('cas'):
+        thread = threading.Thread(target = background)
+        thread.start()
+        thread.join()
+    assert profiler.report()['stages']['cas']['llm_wait_calls'] == 0
+
+def test_cprofile_reports_hot_spots_without_llm_waits(tmp_path):
+    profiler = Profiler('run', cprofile = True, memory = True)
+    with profiler.stage('sen'):
+        with profiler.span('llm_wait'):
+            time.sleep(0.02)
+        busy(0.05)
+    record = profiler.report()['stages']['sen']
+    functions = [spot['function'] for spot in record['hot_spots']]
+    assert any('busy' in function for function in functions)
+    assert not any('sleep' in function for function in functions)
+    assert record['profile_stats'].startswith(str(tmp_path)) and 'peak_memory_mb' in record
+
+def test_module_functions_cost_nothing_until_enabled(tmp_path):
+    with profileStage('dim'), span('io'):
+        pass
+    profiler = enableProfiling('run')
+    with profileStage('dim'), span('io'):
+        pass
+    assert profiler.stages['dim']['io_calls'] == 1
+    with open(profiler.save(), 'r') as f:
+        assert json.load(f)['stages']['dim']['runs'] == 1
@@ -0,0 +1,73 @@
+import json
+from pydantic import BaseModel, Field
+from Helpers.ResponseRepair import repairJson, validateElements, stripMarkdown, compactSchema, fieldGuide, jsonSchema, schemaTokensSaved
+
+
+class Line(BaseModel):
+    step: int
+    amount: float
+
+class LineList(BaseModel):
+    output: list[Line]
+
+class Verdict(BaseModel):
+    correct: bool
+
+class Transaction(BaseModel):
+    step: int = Field(description='Step   number\n of the transaction')
+    kind: str = Field(default='Deposit', title='Kind', description='Deposit or Withdraw', examples=['Deposit'])
+
+class Transactions(BaseModel):
+    output: list[Transaction] = Field(description='Transactions of the test case')
+    #A field named like a documentation key is kept
+    title: str
+
+
+def test_strip_markdown_fence():
+    assert stripMarkdown('```json\n{"a": 1}\n```') == '{"a": 1}'
+
+def test_repair_drops_surrounding_text_and_trailing_commas():
+    assert json.loads(repairJson('Here you go: {"output": [{"step": 1,}, ],} Hope it helps')) == {'output': [{'step': 1}]}
+
+def test_repair_cuts_a_truncated_response_back_to_the_last_complete_member():
+    text = json.dumps({'output': [{'step': 1, 'amount': 10.0}, {'step': 2, 'amount': 20.0}]})
+    repaired = json.loads(repairJson(text[:text.index('20.0')]))
+    assert repaired == {'output': [{'step': 1, 'amount': 10.0}, {'step': 2}]}
+    #The partial element is then found by the element validation and re-asked
+    assert set(validateElements(LineList, repaired)[1]) == {1}
+
+def test_repair_keeps_brackets_inside_strings():
+    assert json.loads(repairJson('{"reason": "a [b] {c}", "output": [1, 2')) == {'reason': 'a [b] {c}', 'output': [1]}
+
+def test_repair_leaves_valid_json_unchanged():
+    text = '{"output": [{"step": 1, "amount": 1.5}]}'
+    assert repairJson(text) == text
+
+def test_validate_elements_reports_only_the_invalid_indices():
+    elements, errors = validateElements(LineList, {'output': [{'step': 1, 'amount': 1}, {'step': 'x', 'amount': 2}, {'step': 3}]})
+    assert elements[0] == {'step': 1, 'amount': 1.0}
+    assert elements[1] is None and elements[2] is None
+    assert set(errors) == {1, 2}
+    assert 'step' in errors[1] and 'amount' in errors[2]
+
+def test_validate_elements_of_a_response_without_a_list():
+    assert validateElements(Verdict, {'correct': True}) == (None, None)
+    assert validateElements(LineList, {'other': []}) == (None, None)
+
+def test_compact_schema_keeps_names_types_and_required_fields_only():
+    assert compactSchema(Transactions) == {
+        '$defs': {'Transaction': {'properties': {'step': {'type': 'integer'}, 'kind': {'type': 'string'}}, 'required': ['step'], 'type': 'object'}},
+        'properties': {'output': {'items': {'$ref': '#/$defs/Transaction'}, 'type': 'array'}, 'title': {'type': 'string'}},
+        'required': ['output', 'title'], 'type': 'object'}
+    #The cached full schema is not changed by stripping it
+    assert jsonSchema(Transactions)['properties']['output']['description'] == 'Transactions of the test case'
+
+def test_field_guide_lists_the_documented_fields_of_nested_models():
+    assert fieldGuide(Transactions).splitlines() == ['Field guide of the Transactions response format',
+                                                     'Transactions.output (array): Transactions of the test case',
+                                                     'Transaction.step (integer): Step number of the transaction',
+                                                     'Transaction.kind (string): Deposit or Withdraw']
+
+def test_schema_tokens_saved():
+    assert schemaTokensSaved(Transactions) > 0
+    assert schemaTokensSaved(Verdict) == (len(json.dumps(jsonSchema(Verdict))) + 3) // 4 - (len(json.dumps(compactSchema(Verdict))) + 3) // 4
@@ -0,0 +1,90 @@
+import time
+import threading
+import pytest
+from Agents import TestStepsAgent
+from Helpers.ArtifactStore import ArtifactStore
+from Helpers.VerificationPolicy import VerificationPolicy
+
+
+class FakeGenerator:
+    def __init__(self, delay = 0.0):
+        self.delay, self.prompts, self.tiers = delay, [], []
+
+    def generate_content(self, prompt, response_schema = None, check = None, tier = 0, context = None):
+        time.sleep(self.delay)
+        self.prompts.append(prompt)
+        self.tiers.append(tier)
+        test_case_id = prompt.split('{test_case_id}: ')[1].split()[0]
+        return {'output': [{'test_case_id': test_case_id, 'step': 1, 'event': 'Deposit', 'addReduce': 'Add', 'pass_fail': 'PASS', 'allocation': []}]}
+
+class FakeVerifier:
+    def __init__(self, verdicts):
+        #test case id -> list of correctness verdicts in order. Missing ones are correct, an exception is raised
+        self.verdicts, self.prompts = verdicts, []
+
+    def generate_content(self, prompt, response_schema = None):
+        self.prompts.append(prompt)
+        test_case_id = prompt.split('{test_case_id}: ')[1].split()[0]
+        verdict = self.verdicts.get(test_case_id, [True]).pop(0) if self.verdicts.get(test_case_id) else True
+        if isinstance(verdict, Exception):
+            raise verdict
+        return {'correctness': verdict, 'correction': '' if verdict else f'fix {test_case_id}'}
+
+
+def stepCase(num):
+    return {'test_case_id': f'TC-{num:03}', 'test_scenario_id': 'SC-001', 'target_scenario': 'scenario', 'given': 'given',
+            'given_steps': 'steps', 'when': 'when', 'when_steps': 'steps', 'then': 'then', 'memberCode': 'A001'}
+
+def stepAgent(tmp_path, count, generator, verifier):
+    agent = TestStepsAgent.TestStepAgent.__new__(TestStepsAgent.TestStepAgent)
+    agent.copy_model_configs()
+    for model_config in [agent.generate_model_config, agent.verify_model_config]:
+        #The item values end up in the prompt, where the fake clients find the test case id
+        model_config.static_prefix, model_config.retrieval_k = True, 0
+    agent.generate_llm_client, agent.verify_llm_client = generator, verifier
+    agent.artifact_store = ArtifactStore(str(tmp_path / 'artifacts.db'))
+    agent.test_cases = [stepCase(num) for num in range(1, count + 1)]
+    agent.artifact_store.writeTestCases('SC-001', agent.test_cases, 'cases_verified')
+    return agent
+
+
+def test_every_test_case_is_generated_verified_and_written(tmp_path):
+    generator, verifier = FakeGenerator(), FakeVerifier({})
+    agent = stepAgent(tmp_path, 5, generator, verifier)
+    written = agent.run_pipeline(VerificationPolicy('all'), tries = 2, max_in_flight = 2)
+    assert sorted(written) == [f'TC-{num:03}' for num in range(1, 6)]
+    assert len(generator.prompts) == len(verifier.prompts) == 5
+    assert agent.artifact_store.count('test_steps') == 5
+
+def test_rejected_steps_are_regenerated_with_the_feedback_on_the_next_tier(tmp_path):
+    generator, verifier = FakeGenerator(), FakeVerifier({'TC-002': [False, True]})
+    agent = stepAgent(tmp_path, 3, generator, verifier)
+    written = agent.run_pipeline(VerificationPolicy('all'), tries = 2, max_in_flight = 3)
+    assert sorted(written) == ['TC-001', 'TC-002', 'TC-003']
+    retries = [num for num, prompt in enumerate(generator.prompts) if 'fix TC-002' in prompt]
+    assert len(retries) == 1 and generator.tiers[retries[0]] == 1
+    assert [prompt for prompt in verifier.prompts if '{test_case_id}: TC-002' in prompt][1].endswith('fix TC-002')
+
+def test_test_case_is_failed_when_it_runs_out_of_tries(tmp_path):
+    generator, verifier = FakeGenerator(), FakeVerifier({'TC-001': [False, False]})
+    agent = stepAgent(tmp_path, 2, generator, verifier)
+    assert agent.run_pipeline(VerificationPolicy('all'), tries = 2, max_in_flight = 2) == ['TC-002']
+    assert [case['test_case_id'] for case in agent.artifact_store.readTestCases(status = 'steps_failed')] == ['TC-001']
+
+def test_unverified_test_cases_skip_the_verifier(tmp_path):
+    generator, verifier = FakeGenerator(), FakeVerifier({})
+    agent = stepAgent(tmp_path, 3, generator, verifier)
+    assert len(agent.run_pipeline(VerificationPolicy('none'), tries = 2, max_in_flight = 2)) == 3
+    assert verifier.prompts == []
+
+def test_a_failure_stops_the_workers_before_the_queued_items(tmp_path):
+    generator, verifier = FakeGenerator(delay = 0.05), FakeVerifier({'TC-001': [ValueError('verifier down')]})
+    agent = stepAgent(tmp_path, 6, generator, verifier)
+    threads = threading.active_count()
+    with pytest.raises(ValueError, match = 'verifier down'):
+        agent.run_pipeline(VerificationPolicy('all'), tries = 2, max_in_flight = 6)
+    #The workers are joined, so nothing is left calling the clients of the agent
+    assert threading.active_count() == threads
+    calls = len(generator.prompts)
+    time.sleep(0.2)
+    assert len(generator.prompts) == calls < 6
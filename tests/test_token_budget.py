@@ -0,0 +1,67 @@
+import json
+import pytest
+from pydantic import BaseModel
+from Agents.Agent import LLMClient, mergeResults
+
+
+class FakeConnector:
+    '''
+    Estimates a token per character of the prompt and answers with the lines of the prompt as the output list
+    '''
+    def __init__(self, model, token_budget):
+        self.model, self.token_budget, self.prompts = model, token_budget, []
+
+    def estimate_tokens(self, prompt, context = None):
+        return len(prompt) + len(context or '')
+
+    def chat(self, prompt, response_schema, session = 'new', context = None):
+        self.prompts.append(prompt)
+        return json.dumps({'output': prompt.splitlines(), 'reason': f'from {self.model}'})
+
+class Lines(BaseModel):
+    output: list[str]
+    reason: str
+
+def client(*connectors):
+    llm_client = LLMClient.__new__(LLMClient)
+    llm_client.tiers, llm_client.llm_connector, llm_client.stage = list(connectors), connectors[-1], 'test'
+    return llm_client
+
+def render(items):
+    return '\n'.join(items)
+
+
+def test_merge_results_joins_lists_and_distinct_text():
+    merged = mergeResults([{'output': [1, 2], 'reason': 'a', 'correct': True}, {'output': [3], 'reason': 'a', 'correct': False},
+                           {'output': [], 'reason': 'b', 'correct': False}])
+    assert merged == {'output': [1, 2, 3], 'reason': 'a\nb', 'correct': True}
+
+def test_prompt_within_the_budget_is_not_split():
+    llm_client = client(FakeConnector('model', 100))
+    assert llm_client.split_items(render, ['a', 'b', 'c']) == [['a', 'b', 'c']]
+
+def test_prompt_over_the_budget_is_halved_till_every_part_fits():
+    items = [f'item{num}' for num in range(8)]
+    llm_client = client(FakeConnector('model', 11))
+    parts = llm_client.split_items(render, items)
+    assert [len(part) for part in parts] == [2, 2, 2, 2]
+    assert sum(parts, []) == items
+    #The retrieved context counts against the budget as well
+    assert len(client(FakeConnector('model', 21)).split_items(render, items, context = 'x' * 10)) == 4
+    #A single item is sent as it is and left to the budget check of the request
+    assert client(FakeConnector('model', 1)).split_items(render, ['item0']) == [['item0']]
+
+def test_generate_split_merges_the_parts_in_order():
+    connector = FakeConnector('model', 11)
+    items = [f'item{num}' for num in range(6)]
+    result = client(connector).generate_split(render, items, Lines)
+    assert connector.prompts == ['item0', 'item1\nitem2', 'item3', 'item4\nitem5']
+    assert result == {'output': items, 'reason': 'from model'}
+
+def test_over_budget_tiers_are_skipped_and_the_last_one_raises():
+    cheap, configured = FakeConnector('cheap', 5), FakeConnector('configured', 100)
+    llm_client = client(cheap, configured)
+    assert llm_client.generate_content('a long prompt', None) == json.dumps({'output': ['a long prompt'], 'reason': 'from configured'})
+    assert cheap.prompts == []
+    with pytest.raises(Exception, match = 'over the budget of 5 tokens of cheap'):
+        client(FakeConnector('cheap', 5)).generate_content('a long prompt', None)
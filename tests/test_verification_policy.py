@@ -0,0 +1,32 @@
+import pytest
+from Helpers.VerificationPolicy import VerificationPolicy
+
+
+def test_resolve():
+    assert VerificationPolicy.resolve(True, 'cas.verifier').mode == 'all'
+    assert not VerificationPolicy.resolve(False, 'cas.verifier').enabled
+    policy = VerificationPolicy.resolve('sample:0.3', 'cas.verifier')
+    assert (policy.mode, policy.rate, policy.stage) == ('sample', 0.3, 'cas.verifier')
+    with pytest.raises(Exception):
+        VerificationPolicy.resolve('sometimes', 'cas.verifier')
+
+def test_heuristic_verifies_only_flagged_items():
+    policy = VerificationPolicy('heuristic')
+    assert policy.should_verify('SC-001', flagged = True)
+    assert not policy.should_verify('SC-002', flagged = False)
+
+def test_sample_rate_and_flagged_items():
+    policy = VerificationPolicy('sample', rate = 0.3, seed = 7)
+    decisions = [policy.should_verify(num) for num in range(1000)]
+    assert 0.25 < sum(decisions) / len(decisions) < 0.35
+    assert all(VerificationPolicy('sample', rate = 0.0).should_verify(num, flagged = True) for num in range(10))
+
+def test_adaptive_rate_follows_the_rejections():
+    policy = VerificationPolicy('adaptive', warmup = 5, min_rate = 0.1)
+    assert policy.current_rate() == 1.0
+    for num in range(10):
+        policy.record_outcome(num, True)
+    assert policy.current_rate() == 0.1
+    for num in range(2):
+        policy.record_outcome(num, False)
+    assert policy.current_rate() == pytest.approx(4 * 2 / 12)
@@ -0,0 +1,49 @@
+import pandas as pd
+from openpyxl import load_workbook
+from Helpers.OutputManager import ExcelManager, XlsxRenderer
+
+STEPS = pd.DataFrame({'step': [2, 1], 'event': ['Withdraw', 'Deposit'], 'isFungible': ['False', 'True'],
+                      'allocation': [[], [{'amt': 10.0}]], 'amount': [5.0, None]})
+ALLOCATIONS = pd.DataFrame({'step': [1], 'amt': [10.0]})
+TEXT = {'Test Case: TC-001': (1, 1), 'Given: member A001': (2, 1)}
+BLOCKS = [(STEPS, '##Test Steps - Start', '##Test Steps - End'), (ALLOCATIONS, '##Allocation Steps - Start', '##Allocation Steps - End')]
+
+
+def rows(filepath, sheet):
+    wb = load_workbook(filepath)
+    try:
+        return [row for row in wb[sheet].iter_rows(values_only = True)]
+    finally:
+        wb.close()
+
+
+def test_cell_values_convert_lists_booleans_and_blanks():
+    assert XlsxRenderer.cellValues(STEPS) == [[2, 'Withdraw', False, '[]', 5.0], [1, 'Deposit', True, "[{'amt': 10.0}]", None]]
+
+def test_rendered_sheet_matches_the_openpyxl_layout(tmp_path):
+    renderer = XlsxRenderer(str(tmp_path / 'rendered.xlsx'))
+    next_row = renderer.writeSheet('TC-001', TEXT, BLOCKS)
+    renderer.close()
+    excel = ExcelManager('new', str(tmp_path / 'written.xlsx'))
+    excel.createWorksheet('TC-001')
+    excel.writeTextToSheet('TC-001', TEXT)
+    row = 4
+    for df, start_marker, end_marker in BLOCKS:
+        row = excel.writeDfToSheet('TC-001', df, row, start_marker, end_marker) + 1
+    excel.save_wb()
+    assert next_row == row
+    #openpyxl writes NaN for the missing amount where the renderer leaves the cell blank
+    written = [tuple(None if value != value else value for value in row) for row in rows(str(tmp_path / 'written.xlsx'), 'TC-001')]
+    assert rows(str(tmp_path / 'rendered.xlsx'), 'TC-001') == written
+
+def test_rendered_blocks_are_read_back(tmp_path):
+    filepath = str(tmp_path / 'rendered.xlsx')
+    renderer = XlsxRenderer(filepath)
+    for sheet in ['TC-001', 'TC-002']:
+        renderer.writeSheet(sheet, TEXT, BLOCKS)
+    renderer.close()
+    blocks = ExcelManager.readSheetBlocks(filepath, ['TC-002'])
+    assert list(blocks) == ['TC-002']
+    steps_df = blocks['TC-002']['##Test Steps'][1]
+    assert steps_df['step'].tolist() == [1, 2] and steps_df['event'].tolist() == ['Deposit', 'Withdraw']
+    assert blocks['TC-002']['##Allocation Steps'][1]['amt'].tolist() == [10.0]